@@ -27,11 +27,42 @@ int steps_per_square = -255;
 
 #define UPDATE_INTERVAL_MS 100
 
+// Trajectories (see add_waypoint)
+#define MAX_WAYPOINTS 32
+#define MIN_SPEED_STEPS_PER_SEC 20
+#define JUNCTION_JERK_STEPS_PER_SEC 60 // The most either motor's speed can change at once, at a corner
+#define HOLD_SETTLE_MS 100 // How long to give the electromagnet to switch after we're told to resume
+
+#define CMD_WAYPOINT (1 << 12)
+#define CMD_WAYPOINT_LAST (1 << 11)
+#define CMD_WAYPOINT_HOLD (1 << 10)
+#define CMD_WAYPOINT_INDEX_SHIFT 14
+#define CMD_WAYPOINT_TRAJECTORY (1L << 19)
+#define CMD_RESUME (1 << 13)
+
+#define MSG_WAYPOINT_ACK 0xB0
+#define MSG_HOLDING 0xC0
+#define MSG_WAYPOINT_REACHED 0xE0
+#define MSG_TRAJECTORY_DONE 0xF2
+
 //
 // State Variables
 //
-int current_pos_x = 7; // 0-9, where 0 is A, 7 is H, and 8-9 are the graveyard
-int current_pos_y = 7; // 0-7, where 0 is Rank 1 and 7 is Rank 7
+// Positions are in half squares, so the gantry can go between squares
+int current_pos_x = 14; // 0-18, where 0 is A, 14 is H, and 16-18 are the graveyard
+int current_pos_y = 14; // 0-14, where 0 is Rank 1 and 14 is Rank 8
+
+struct Waypoint
+{
+	int x; // In half squares, like current_pos_x
+	int y;
+	bool hold;
+};
+
+Waypoint waypoints[MAX_WAYPOINTS];
+int num_waypoints = 0;
+bool trajectory_id = false; // Flips with every trajectory the Game Controller sends (see add_waypoint)
+bool trajectory_done = false; // Until the next command, so a lost MSG_TRAJECTORY_DONE gets resent
 
 //
 // Motors
@@ -65,11 +96,14 @@ void loop()
 	// Check for Serial communication
 	if (Serial.available())
 	{
-		uint8_t cmd = Serial.parseInt();
+		long cmd = Serial.parseInt();
 
+		if (cmd & CMD_WAYPOINT)
+		{
+			add_waypoint(cmd);
+		}
 		/**
-		 * The only valid command for the gantry is to move to a location, which is an 8-bit message in
-		 * the form:
+		 * Otherwise, the command is to move to a location, which is an 8-bit message in the form:
 		 *   0bAAAABBBB where:
 		 * AAAA is the index of the form to move to (one-indexed), and
 		 * BBBB is the index of the rank to move to (one-indexed)
@@ -77,15 +111,16 @@ void loop()
 		 * Both ranks and files are one-indexed to ensure that 0b00000000 is not a valid command, since
 		 * it's often produced unintentionally and so is ignored.
 		 */
-		if (cmd != 0)
+		else if (cmd > 0 && cmd <= 0xFF)
 		{
-			uint8_t new_pos_x = min(7, (cmd >> 4) - 1);
-			uint8_t new_pos_y = min(7, (cmd & 0b1111) - 1);
-			int diff_pos_x = new_pos_x - current_pos_x;
-			int diff_pos_y = new_pos_y - current_pos_y;
+			trajectory_done = false;
+
+			// Files 8-9 are the graveyard, beside the board
+			int new_pos_x = 2 * min(9, (cmd >> 4) - 1);
+			int new_pos_y = 2 * min(7, (cmd & 0b1111) - 1);
 
-			int steps_x = diff_pos_x * steps_per_square;
-			int steps_y = diff_pos_y * steps_per_square;
+			long steps_x = steps_to(new_pos_x) - steps_to(current_pos_x);
+			long steps_y = steps_to(new_pos_y) - steps_to(current_pos_y);
 
 			moveXYWithCoordination(steps_x, steps_y, SPEED_STEPS_PER_SEC, ACCEL_STEPS_PER_SEC_PER_SEC);
 
@@ -102,6 +137,8 @@ void loop()
 	if (millis() - last_update_time >= UPDATE_INTERVAL_MS)
 	{
 		send_position();
+		if (trajectory_done)
+			Serial.write(MSG_TRAJECTORY_DONE);
 		last_update_time = millis();
 	}
 }
@@ -117,7 +154,243 @@ void send_position()
 	 * Both ranks and files are one-indexed to ensure that 0b00000000 is not a valid message, since
 	 * it's often produced unintentionally and so is ignored.
 	 */
-	Serial.write(((current_pos_x + 1) << 4) | (current_pos_y + 1));
+	Serial.write(((current_pos_x / 2 + 1) << 4) | (current_pos_y / 2 + 1));
+}
+
+/**
+ * Steps from the home position to a position (in half squares).
+ */
+long steps_to(int pos)
+{
+	return (long)pos * steps_per_square / 2;
+}
+
+/**
+ * Add a waypoint to the trajectory being sent, from a command in the form:
+ *   0bTIIIII01LHXXXXXYYYYY where:
+ * T flips with every trajectory (so we can tell a new one from a resent waypoint of the last one),
+ * IIIII is the index of the waypoint in the trajectory,
+ * L is set on the last waypoint, which starts the trajectory,
+ * H is set if the gantry should stop and hold at the waypoint (see hold),
+ * XXXXX is the file to go to, in half squares (one-indexed), and
+ * YYYYY is the rank to go to, in half squares (one-indexed)
+ *
+ * Every waypoint is acknowledged with MSG_WAYPOINT_ACK (with its index in the low 4 bits), and the
+ * Game Controller waits for that before sending the next, so it never overflows our serial buffer
+ * (ex. while we're still busy moving). If an acknowledgement gets lost, the waypoint is sent again,
+ * and only acknowledged again.
+ *
+ * The gantry goes through the waypoints without stopping, except where it holds (and at the end).
+ * Progress is reported asynchronously: MSG_WAYPOINT_REACHED (with the waypoint's index in the low
+ * 4 bits) as each waypoint is reached, MSG_HOLDING while holding (see hold), and
+ * MSG_TRAJECTORY_DONE at the end (and then with every position update until the next command).
+ */
+void add_waypoint(long cmd)
+{
+	bool id = cmd & CMD_WAYPOINT_TRAJECTORY;
+	int index = (cmd >> CMD_WAYPOINT_INDEX_SHIFT) & 0b11111;
+	if (id != trajectory_id)
+	{
+		trajectory_id = id;
+		num_waypoints = 0;
+	}
+
+	// Already have it (and the Game Controller missed our acknowledgement), or missed one before it
+	if (index != num_waypoints || num_waypoints == MAX_WAYPOINTS)
+	{
+		if (index < num_waypoints)
+			Serial.write(MSG_WAYPOINT_ACK | (index & 0xF));
+		return;
+	}
+	trajectory_done = false;
+
+	Waypoint &waypoint = waypoints[num_waypoints++];
+	waypoint.x = constrain(((cmd >> 5) & 0b11111) - 1, 0, 18);
+	waypoint.y = constrain((cmd & 0b11111) - 1, 0, 14);
+	waypoint.hold = cmd & CMD_WAYPOINT_HOLD;
+	Serial.write(MSG_WAYPOINT_ACK | (index & 0xF));
+
+	if (cmd & CMD_WAYPOINT_LAST)
+	{
+		run_trajectory();
+		trajectory_done = true;
+	}
+}
+
+void run_trajectory()
+{
+	// Each run of waypoints up to a hold (or the end) is one continuous motion
+	int first = 0;
+	int holds = 0;
+	for (int i = 0; i < num_waypoints; i++)
+	{
+		if (waypoints[i].hold || i == num_waypoints - 1)
+		{
+			run_continuously(first, i);
+			if (waypoints[i].hold)
+				hold(holds++);
+			first = i + 1;
+		}
+	}
+	// Position first, so the Game Controller knows where we are as soon as we're done
+	send_position();
+	Serial.write(MSG_TRAJECTORY_DONE);
+}
+
+/**
+ * Go through waypoints first to last without stopping at any but the last, slowing down at corners
+ * just enough to keep each motor's change in speed under JUNCTION_JERK_STEPS_PER_SEC.
+ *
+ * Distances and speeds are measured along whichever motor has further to go, like in
+ * moveXYWithCoordination, so straight moves are just as fast as with it.
+ */
+void run_continuously(int first, int last)
+{
+	static long steps_x[MAX_WAYPOINTS], steps_y[MAX_WAYPOINTS], length[MAX_WAYPOINTS];
+	static float entry_speed[MAX_WAYPOINTS];
+
+	int pos_x = current_pos_x, pos_y = current_pos_y;
+	for (int i = first; i <= last; i++)
+	{
+		steps_x[i] = steps_to(waypoints[i].x) - steps_to(pos_x);
+		steps_y[i] = steps_to(waypoints[i].y) - steps_to(pos_y);
+		length[i] = max(abs(steps_x[i]), abs(steps_y[i]));
+		pos_x = waypoints[i].x;
+		pos_y = waypoints[i].y;
+	}
+
+	// The fastest we could be going at the start of each segment, given the corner before it...
+	int previous = -1;
+	for (int i = first; i <= last; i++)
+	{
+		entry_speed[i] = 0;
+		if (length[i] == 0)
+			continue;
+		if (previous != -1)
+		{
+			float change_x = abs((float)steps_x[i] / length[i] - (float)steps_x[previous] / length[previous]);
+			float change_y = abs((float)steps_y[i] / length[i] - (float)steps_y[previous] / length[previous]);
+			float change = max(change_x, change_y);
+			entry_speed[i] = change > 0 ? min(SPEED_STEPS_PER_SEC, JUNCTION_JERK_STEPS_PER_SEC / change) : SPEED_STEPS_PER_SEC;
+		}
+		previous = i;
+	}
+
+	// ...and that we can still stop in time at the end...
+	float exit_speed = 0;
+	for (int i = last; i >= first; i--)
+	{
+		if (length[i] == 0)
+			continue;
+		entry_speed[i] = min(entry_speed[i], sqrt(exit_speed * exit_speed + 2.0 * ACCEL_STEPS_PER_SEC_PER_SEC * length[i]));
+		exit_speed = entry_speed[i];
+	}
+
+	// ...and that we can get up to from the start
+	float max_speed = 0;
+	for (int i = first; i <= last; i++)
+	{
+		if (length[i] == 0)
+			continue;
+		entry_speed[i] = min(entry_speed[i], max_speed);
+		max_speed = sqrt(entry_speed[i] * entry_speed[i] + 2.0 * ACCEL_STEPS_PER_SEC_PER_SEC * length[i]);
+	}
+
+	for (int i = first; i <= last; i++)
+	{
+		if (length[i] != 0)
+		{
+			// The next segment's entry speed is this one's exit speed
+			exit_speed = 0;
+			for (int j = i + 1; j <= last; j++)
+			{
+				if (length[j] != 0)
+				{
+					exit_speed = entry_speed[j];
+					break;
+				}
+			}
+			move_segment(steps_x[i], steps_y[i], entry_speed[i], exit_speed);
+		}
+		current_pos_x = waypoints[i].x;
+		current_pos_y = waypoints[i].y;
+		Serial.write(MSG_WAYPOINT_REACHED | (i & 0xF));
+	}
+}
+
+/**
+ * Move in a straight line, starting at entry_speed and ending at exit_speed (in steps per second of
+ * the motor with further to go), accelerating to full speed in between if there's room.
+ */
+void move_segment(long steps_x, long steps_y, float entry_speed, float exit_speed)
+{
+	// NOTE: Same direction convention as SpeedyStepper
+	digitalWrite(X_DIR_PIN, steps_x < 0 ? HIGH : LOW);
+	digitalWrite(Y_DIR_PIN, steps_y < 0 ? HIGH : LOW);
+
+	bool x_is_major = abs(steps_x) >= abs(steps_y);
+	long major = x_is_major ? abs(steps_x) : abs(steps_y);
+	long minor = x_is_major ? abs(steps_y) : abs(steps_x);
+	int major_pin = x_is_major ? X_STEP_PIN : Y_STEP_PIN;
+	int minor_pin = x_is_major ? Y_STEP_PIN : X_STEP_PIN;
+
+	// Step the minor motor in proportion to the major one (Bresenham's line algorithm)
+	long error = major / 2;
+	unsigned long next_step_us = micros();
+	for (long i = 0; i < major; i++)
+	{
+		float distance = i + 0.5;
+		float speed = min((float)SPEED_STEPS_PER_SEC, sqrt(entry_speed * entry_speed + 2.0 * ACCEL_STEPS_PER_SEC_PER_SEC * distance));
+		speed = min(speed, sqrt(exit_speed * exit_speed + 2.0 * ACCEL_STEPS_PER_SEC_PER_SEC * (major - distance)));
+		speed = max(speed, (float)MIN_SPEED_STEPS_PER_SEC);
+
+		while ((long)(micros() - next_step_us) < 0)
+			;
+
+		error -= minor;
+		bool step_minor = error < 0;
+		if (step_minor)
+			error += major;
+
+		digitalWrite(major_pin, HIGH);
+		if (step_minor)
+			digitalWrite(minor_pin, HIGH);
+		delayMicroseconds(2);
+		digitalWrite(major_pin, LOW);
+		digitalWrite(minor_pin, LOW);
+
+		next_step_us += (unsigned long)(1000000.0 / speed);
+	}
+}
+
+/**
+ * Stop and wait for the Game Controller to switch the electromagnet (which is on the other Arduino)
+ * and send CMD_RESUME with the same hold number (counting from 0 in each trajectory) in the low 4
+ * bits. MSG_HOLDING (with the hold number in its low 4 bits) is resent with every position update,
+ * in case it gets lost, and the number means a late CMD_RESUME for an earlier hold is ignored.
+ */
+void hold(int number)
+{
+	Serial.write(MSG_HOLDING | (number & 0xF));
+	send_position();
+
+	unsigned long last_update_time = millis();
+	while (true)
+	{
+		if (Serial.available())
+		{
+			long cmd = Serial.parseInt();
+			if ((cmd & CMD_RESUME) && (cmd & 0xF) == (number & 0xF))
+				break;
+		}
+		if (millis() - last_update_time >= UPDATE_INTERVAL_MS)
+		{
+			Serial.write(MSG_HOLDING | (number & 0xF));
+			send_position();
+			last_update_time = millis();
+		}
+	}
+	delay(HOLD_SETTLE_MS);
 }
 
 void home() {
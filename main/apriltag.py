@@ -3,9 +3,17 @@ A cross-platform wrapper for Apriltag libraries.
 
 dt_apriltags only works on Linux while apriltag only works on macOS (arm64). They have very similar
 APIs, so this module wraps them for seamless use.
+
+Creating a detector is surprisingly expensive (it allocates the family's lookup tables and a worker
+pool), so detectors are cached for the life of the process, keyed by family and tuning options. Use
+get_detector instead of constructing one directly.
 """
 from typing import *
+from copy import copy
 from collections import defaultdict
+from dataclasses import dataclass
+from threading import Lock
+import numpy as np
 
 try:
 	import lib.apriltag.python.apriltag as apriltag
@@ -14,17 +22,119 @@ except ModuleNotFoundError:
 	import dt_apriltags as apriltag
 	is_linux = True
 
-def scan_for_apriltags(family: str, image) -> apriltag.Detection:
-	if is_linux:
-		# TODO: use family
-		return apriltag.Detector().detect(image)
-	else:
-		return apriltag.Detector(options=apriltag.DetectorOptions(families=family)).detect(image)
+@dataclass(frozen=True)
+class DetectorOptions:
+	"""
+	Tuning knobs for the Apriltag detector. Frozen (and therefore hashable) so it can be used as part
+	of the detector cache key.
+
+	Defaults match dt_apriltags' defaults, which is what the Raspberry Pi has always used.
+	"""
+	nthreads: int = 1
+	""" Number of threads the detector may use internally. """
+
+	quad_decimate: float = 2.0
+	"""
+	Detect quads on an image downscaled by this factor. Much faster, at the cost of not finding very
+	small tags. Decoding is still done at full resolution.
+	"""
+
+	quad_sigma: float = 0.0
+	""" Standard deviation of the Gaussian blur applied before quad detection (0 to disable). """
+
+	refine_edges: bool = True
+	""" Snap quad edges to strong image gradients. Cheap, and helps a lot when decimating. """
+
+DEFAULT_DETECTOR_OPTIONS = DetectorOptions()
+
+class PooledDetector:
+	"""
+	A cached Apriltag detector. The underlying C detectors aren't safe to use from more than one
+	thread at a time, so every detection holds a per-detector lock.
+	"""
+	family: str
+	options: DetectorOptions
+
+	def __init__(self, family: str, options: DetectorOptions):
+		self.family = family
+		self.options = options
+		self._lock = Lock()
+
+		if is_linux:
+			self._detector = apriltag.Detector(
+				families=family,
+				nthreads=options.nthreads,
+				quad_decimate=options.quad_decimate,
+				quad_sigma=options.quad_sigma,
+				refine_edges=int(options.refine_edges))
+		else:
+			self._detector = apriltag.Detector(options=apriltag.DetectorOptions(
+				families=family,
+				nthreads=options.nthreads,
+				quad_decimate=options.quad_decimate,
+				quad_blur=options.quad_sigma,
+				refine_edges=options.refine_edges))
+
+	def detect(self, image) -> List[apriltag.Detection]:
+		with self._lock:
+			return self._detector.detect(image)
 
-def detect_apriltags(family: str, image) -> Dict[int, Optional[apriltag.Detection]]:
+_detectors: Dict[Tuple[str, DetectorOptions], PooledDetector] = {}
+_detectors_lock = Lock()
+
+def get_detector(family: str, options: DetectorOptions = DEFAULT_DETECTOR_OPTIONS) -> PooledDetector:
+	"""
+	Get the process-wide detector for a family and set of options, creating it if nessecary.
+	"""
+	key = (family, options)
+	with _detectors_lock:
+		if key not in _detectors:
+			_detectors[key] = PooledDetector(family, options)
+		return _detectors[key]
+
+def scan_for_apriltags(family: str, image, options: DetectorOptions = DEFAULT_DETECTOR_OPTIONS) -> List[apriltag.Detection]:
+	return get_detector(family, options).detect(image)
+
+def detect_apriltags(family: str, image, options: DetectorOptions = DEFAULT_DETECTOR_OPTIONS) -> Dict[int, Optional[apriltag.Detection]]:
 	tags: Dict[int, Optional[apriltag.Detection]] = defaultdict(lambda: None)
-	
-	for tag in scan_for_apriltags(family, image):
+
+	for tag in scan_for_apriltags(family, image, options):
 		tags[tag.tag_id] = tag
-	
-	return tags
\ No newline at end of file
+
+	return tags
+
+def with_undistorted_points(detection: apriltag.Detection, undistort_points: Callable) -> apriltag.Detection:
+	"""
+	Return a copy of a detection with its center and corners passed through undistort_points (which
+	takes and returns an (N, 2) array), for use when tags were detected on a still-distorted image.
+	"""
+	points = undistort_points([detection.center, *detection.corners])
+	center, corners = points[0], points[1:]
+
+	# macOS' Detection is a namedtuple, dt_apriltags' is a normal (mutable) object
+	if hasattr(detection, '_replace'):
+		return detection._replace(center=center, corners=corners)
+
+	detection = copy(detection)
+	detection.center = center
+	detection.corners = corners
+	return detection
+
+def with_translated_points(detection: apriltag.Detection, offset) -> apriltag.Detection:
+	"""
+	Return a copy of a detection shifted by offset (x, y) pixels, ex. to move a detection made on a
+	crop of an image back into the coordinates of the full image.
+	"""
+	offset = np.asarray(offset, dtype=np.float64)
+	return with_undistorted_points(detection, lambda points: np.asarray(points, dtype=np.float64) + offset)
+
+def detection_to_json(detection: apriltag.Detection) -> Dict[str, Any]:
+	"""
+	Convert a detection into a JSON-serializable dict (ex. to send it over the network).
+	"""
+	return {
+		'tag_id': int(detection.tag_id),
+		'center': [float(x) for x in detection.center],
+		'corners': [[float(x), float(y)] for x, y in detection.corners],
+		'decision_margin': float(detection.decision_margin),
+	}
@@ -63,6 +63,36 @@ class Arduino:
 		sleep(0) # see above
 		return [int(x) for x in self.serial.read() if int(x) != 0]
 
+# Keep in sync with gantry.ino
+GANTRY_CMD_WAYPOINT = 1 << 12
+GANTRY_CMD_WAYPOINT_LAST = 1 << 11
+GANTRY_CMD_WAYPOINT_HOLD = 1 << 10
+GANTRY_CMD_WAYPOINT_INDEX_SHIFT = 14
+GANTRY_CMD_WAYPOINT_TRAJECTORY = 1 << 19
+GANTRY_CMD_RESUME = 1 << 13
+GANTRY_MSG_WAYPOINT_ACK = 0xB0
+GANTRY_MSG_HOLDING = 0xC0
+GANTRY_MSG_WAYPOINT_REACHED = 0xE0
+GANTRY_MSG_TRAJECTORY_DONE = 0xF2
+
+WAYPOINT_ACK_TIMEOUT = 0.25
+"""
+How long (in seconds) to wait for the gantry to acknowledge a waypoint before sending it again. Doubles
+every time, so we don't flood the gantry's serial buffer while it's busy moving (and can't read it).
+"""
+
+TRAJECTORY_TIMEOUT = 60
+""" How long (in seconds) run_trajectory waits for a trajectory to finish by default. """
+
+MAX_TRAJECTORY_WAYPOINTS = 32
+""" The most waypoints the gantry can take in one trajectory (see ArduinoManager.run_trajectory). """
+
+Waypoint = Tuple[float, float, Optional[bool]]
+"""
+A point on a trajectory: a gantry position (file and rank, which may be halfway between squares)
+and, if the gantry should stop there, whether the electromagnet should then be on or off.
+"""
+
 # Keep in sync with board.ino:led_set_pallete
 class LEDPallete(IntEnum):
 	"""
@@ -100,6 +130,17 @@ class ArduinoManager:
 	gantry_pos: Tuple[int, int] = (0, 0)
 	""" Most recent known position of the gantry. """
 
+	trajectory_running: bool = False
+	""" Whether the gantry is still running a trajectory (see run_trajectory). """
+
+	trajectory_progress: int = -1
+	""" The index of the most recent waypoint the current (or last) trajectory reached. """
+
+	_trajectory_id: bool = False
+	_trajectory_length: int = 0
+	_waypoints_acknowledged: int = 0
+	_holds_resumed: int = 0
+
 	electromagnet_enabled: bool = False
 	""" Status of the electromagnet. """
 
@@ -132,6 +173,7 @@ class ArduinoManager:
 		self.handlers = button_handlers
 		self.on_ready = on_ready
 		self.startup_wait_timeout = time() + ARDUINO_STARTUP_WAIT
+		self._holds: List[bool] = []
 
 	def on_button_press(self, button: Button, handler: Callable):
 		"""
@@ -156,6 +198,58 @@ class ArduinoManager:
 			while self.gantry_pos != (x, y):
 				self.update()
 	
+	def run_trajectory(self, waypoints: List[Waypoint], block: bool=True, timeout: float=TRAJECTORY_TIMEOUT):
+		"""
+		Send the gantry along a whole trajectory at once. It goes through the waypoints without
+		stopping, except at those with an electromagnet state (and the end): there, it stops, we
+		switch the electromagnet and it carries on. If block=True, this method will block until the
+		gantry has reached the end. Otherwise, progress is tracked (in trajectory_progress and
+		trajectory_running) as long as update is called.
+
+		Waypoints are sent one at a time, each once the gantry has acknowledged the one before, since
+		its serial buffer only fits a few. That part always blocks. Raises an IOError if the gantry
+		hasn't taken every waypoint (or, if block=True, finished) within timeout seconds.
+		"""
+		self._assert_ready()
+		if not 0 < len(waypoints) <= MAX_TRAJECTORY_WAYPOINTS:
+			raise ValueError(f"Trajectories must have between 1 and {MAX_TRAJECTORY_WAYPOINTS} waypoints!")
+
+		deadline = time() + timeout
+		self._holds = [magnet for _, _, magnet in waypoints if magnet is not None]
+		self._holds_resumed = 0
+		self._trajectory_id = not self._trajectory_id
+		self._trajectory_length = len(waypoints)
+		self._waypoints_acknowledged = 0
+		self.trajectory_progress = -1
+		self.trajectory_running = True
+		for i, (x, y, magnet) in enumerate(waypoints):
+			# Positions are sent in half squares (one-indexed, like move_gantry)
+			command = GANTRY_CMD_WAYPOINT | (i << GANTRY_CMD_WAYPOINT_INDEX_SHIFT) | ((round(x * 2) + 1) << 5) | (round(y * 2) + 1)
+			if self._trajectory_id:
+				command |= GANTRY_CMD_WAYPOINT_TRAJECTORY
+			if magnet is not None:
+				command |= GANTRY_CMD_WAYPOINT_HOLD
+			if i == len(waypoints) - 1:
+				command |= GANTRY_CMD_WAYPOINT_LAST
+
+			ack_timeout = WAYPOINT_ACK_TIMEOUT
+			while self._waypoints_acknowledged <= i:
+				self.gantry.write(command)
+				resend_time = time() + ack_timeout
+				while self._waypoints_acknowledged <= i and time() < resend_time:
+					if time() > deadline:
+						self.trajectory_running = False
+						raise IOError(f"Gantry never acknowledged waypoint {i} of its trajectory!")
+					self.update_gantry()
+				ack_timeout *= 2
+
+		if block:
+			while self.trajectory_running:
+				if time() > deadline:
+					self.trajectory_running = False
+					raise IOError("Gantry never finished its trajectory!")
+				self.update()
+
 	def set_electromagnet(self, enabled: bool, block: bool=True):
 		"""
 		Enable/Disable the electromagnet. If block=True, this method will block until that has been done.
@@ -194,6 +288,59 @@ class ArduinoManager:
 		if self.startup_wait_timeout > time():
 			return
 
+		self._update_board()
+		self.update_gantry()
+
+		if self.is_board_ready and self.is_gantry_ready and not self.is_ready:
+			self.is_ready = True
+			self.on_ready()
+			self.on_ready = None
+
+	def update_gantry(self):
+		"""
+		Process only the pending messages from the gantry (its position and trajectory progress).
+		Unlike update, this never triggers button handlers, so it's safe to call from anywhere (ex. in
+		the middle of a search).
+		"""
+		if self.startup_wait_timeout > time():
+			return
+
+		for message in self.gantry.read():
+			if message == 0: continue
+			self.is_gantry_ready = True
+			message = message & 0xFF
+			if message & 0xF0 == GANTRY_MSG_WAYPOINT_ACK:
+				# Only ever one waypoint waiting to be acknowledged (see run_trajectory)
+				if message & 0xF == self._waypoints_acknowledged & 0xF:
+					self._waypoints_acknowledged += 1
+				continue
+			if message & 0xF0 == GANTRY_MSG_WAYPOINT_REACHED:
+				# It only starts once it has every waypoint, even if we missed an acknowledgement
+				self._waypoints_acknowledged = self._trajectory_length
+				self.trajectory_progress += 1
+				continue
+			if message & 0xF0 == GANTRY_MSG_HOLDING:
+				self._waypoints_acknowledged = self._trajectory_length
+				# The electromagnet is on the other Arduino, so the gantry waits for us to switch it.
+				# It keeps telling us it's holding until we resume, in case either message gets lost.
+				number = message & 0xF
+				if number == self._holds_resumed & 0xF and self._holds_resumed < len(self._holds):
+					self.set_electromagnet(self._holds[self._holds_resumed], block=False)
+					self._holds_resumed += 1
+				if number == (self._holds_resumed - 1) & 0xF:
+					self.gantry.write(GANTRY_CMD_RESUME | number)
+				continue
+			if message == GANTRY_MSG_TRAJECTORY_DONE:
+				# Resent until the next command, so it may be from the last trajectory if we haven't
+				# even finished sending this one
+				if self._waypoints_acknowledged == self._trajectory_length:
+					self.trajectory_running = False
+				continue
+			x = (message >> 4) - 1
+			y = (message & 0xF) - 1
+			self.gantry_pos = (x, y)
+
+	def _update_board(self):
 		for message in self.board.read():
 			if message == 0: continue
 			self.is_board_ready = True
@@ -207,19 +354,6 @@ class ArduinoManager:
 						self.handlers[button]()
 
 			self.electromagnet_enabled = bool(message & (1 << 4))
-
-		for message in self.gantry.read():
-			if message == 0: continue
-			self.is_gantry_ready = True
-			message = message & 0xFF
-			x = (message >> 4) - 1
-			y = (message & 0xF) - 1
-			self.gantry_pos = (x, y)
-		
-		if self.is_board_ready and self.is_gantry_ready and not self.is_ready:
-			self.is_ready = True
-			self.on_ready()
-			self.on_ready = None
 	
 	def _assert_ready(self):
 		if not self.is_ready:
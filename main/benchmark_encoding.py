@@ -0,0 +1,84 @@
+"""
+Benchmark the image encodings supported by the Vision Service (see image_encoding.py): how long each
+takes to encode and decode, and how many bytes it puts on the wire.
+
+Run this on the Raspberry Pi, since that's where encoding happens:
+
+    python3 benchmark_encoding.py                  # Capture frames from the camera
+    python3 benchmark_encoding.py img1.jpg ...     # Use images from disk instead
+    python3 benchmark_encoding.py --json out.json  # Also write the results as JSON
+"""
+from typing import *
+import json
+import cv2
+import numpy as np
+from time import perf_counter
+from image_encoding import encode_image, decode_image
+
+# (encoding, quality)
+CONFIGURATIONS = [
+	('png', None),
+	('jpg', 95),
+	('jpg', 90),
+	('jpg', 75),
+	('webp', 95),
+	('webp', 75),
+	('gray', None),
+]
+
+def benchmark_encodings(images: List, iterations=5) -> List[Dict[str, Any]]:
+	results = []
+	for encoding, quality in CONFIGURATIONS:
+		encode_times = []
+		decode_times = []
+		sizes = []
+		for img in images:
+			for _ in range(iterations):
+				start = perf_counter()
+				data, headers = encode_image(img, encoding, quality)
+				encode_times.append(perf_counter() - start)
+
+				start = perf_counter()
+				decode_image(data, headers)
+				decode_times.append(perf_counter() - start)
+
+				sizes.append(len(data))
+
+		results.append({
+			'encoding': encoding,
+			'quality': quality,
+			'encode_ms': 1000 * float(np.mean(encode_times)),
+			'decode_ms': 1000 * float(np.mean(decode_times)),
+			'bytes': int(np.mean(sizes)),
+		})
+	return results
+
+if __name__ == '__main__':
+	from sys import argv
+	args = argv[1:]
+
+	json_file = None
+	if '--json' in args:
+		json_file = args[args.index('--json') + 1]
+		args.remove('--json')
+		args.remove(json_file)
+
+	if len(args) > 0:
+		images = [cv2.imread(file) for file in args]
+	else:
+		from camera import Camera
+		print("Capturing frames...")
+		cam = Camera()
+		images = [cam.capture_frame() for _ in range(3)]
+
+	print(f"Benchmarking {len(images)} images...")
+	results = benchmark_encodings(images)
+
+	print(f"{'Encoding':<10} {'Quality':>7} {'Encode (ms)':>12} {'Decode (ms)':>12} {'Size (KiB)':>11}")
+	for result in results:
+		print(f"{result['encoding']:<10} {str(result['quality'] or '-'):>7} {result['encode_ms']:>12.1f} {result['decode_ms']:>12.1f} {result['bytes'] / 1024:>11.1f}")
+
+	if json_file is not None:
+		with open(json_file, 'w') as f:
+			json.dump(results, f, indent=2)
+		print("Wrote results to", json_file)
@@ -0,0 +1,94 @@
+"""
+Benchmark the chess engine: how fast the single-process SearchEngine and the ParallelSearchEngine
+search, on a fixed set of positions.
+
+    python3 benchmark_engine.py                    # Defaults (see below)
+    python3 benchmark_engine.py --depth 6          # Time how long each takes to reach depth 6
+    python3 benchmark_engine.py --time 5           # Measure nodes per second over 5 seconds
+    python3 benchmark_engine.py --processes 4      # Number of processes for the parallel search
+    python3 benchmark_engine.py --json out.json    # Also write the results as JSON
+
+For every position, each engine is timed searching to a fixed depth (time to depth, which is what
+actually matters) and run for a fixed time (nodes per second and the depth it got to). Every search
+starts with an empty transposition table.
+"""
+from typing import *
+import sys
+import json
+import chess
+from multiprocessing import cpu_count
+from engine import SearchEngine
+from parallel_search import ParallelSearchEngine
+
+POSITIONS = [
+	('Starting position', chess.STARTING_FEN),
+	('Italian game', 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'),
+	("Queen's gambit declined", 'rnbqkb1r/ppp2ppp/4pn2/3p4/2PP4/2N5/PP2PPPP/R1BQKBNR w KQkq - 2 4'),
+	('Open middlegame', 'r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1 w - - 0 10'),
+	('Tactical', 'r1b1k2r/ppppnppp/2n2q2/2b5/3NP3/2P1B3/PP3PPP/RN1QKB1R w KQkq - 3 7'),
+	('Rook endgame', '8/5pk1/6p1/R7/5P2/6P1/r5K1/8 w - - 0 40'),
+]
+
+DEFAULT_DEPTH = 5
+DEFAULT_TIME = 3.0
+
+def benchmark_engine(engine: SearchEngine, depth: int, time_limit: float) -> List[Dict[str, Any]]:
+	results = []
+	for name, fen in POSITIONS:
+		board = chess.Board(fen)
+
+		engine.table.clear()
+		to_depth = engine.search(board, time_limit=3600, max_depth=depth)
+
+		engine.table.clear()
+		timed = engine.search(board, time_limit=time_limit)
+
+		results.append({
+			'position': name,
+			'time_to_depth': to_depth.time,
+			'move': to_depth.move.uci() if to_depth.move is not None else None,
+			'nodes_per_second': timed.nodes / timed.time,
+			'depth_reached': timed.depth,
+		})
+	return results
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+
+	def pop_option(name: str) -> Optional[str]:
+		if name not in args:
+			return None
+		value = args[args.index(name) + 1]
+		args.remove(name)
+		args.remove(value)
+		return value
+
+	json_file = pop_option('--json')
+	depth = int(pop_option('--depth') or DEFAULT_DEPTH)
+	time_limit = float(pop_option('--time') or DEFAULT_TIME)
+	processes = int(pop_option('--processes') or cpu_count())
+
+	parallel = ParallelSearchEngine(processes)
+	engines = [('single', SearchEngine()), (f'parallel ({processes})', parallel)]
+	all_results = {}
+	try:
+		for engine_name, engine in engines:
+			print(f"Benchmarking {engine_name}...")
+			all_results[engine_name] = benchmark_engine(engine, depth, time_limit)
+	finally:
+		parallel.close()
+
+	print(f"{'Position':<26} {'Engine':<14} {f'Depth {depth}':>9} {'Move':>6} {'Nodes/s':>9} {f'Depth@{time_limit:g}s':>9}")
+	for i, (name, _) in enumerate(POSITIONS):
+		for engine_name, results in all_results.items():
+			result = results[i]
+			print(f"{name:<26} {engine_name:<14} {result['time_to_depth']:>8.2f}s {result['move'] or '-':>6} {result['nodes_per_second']:>9.0f} {result['depth_reached']:>9}")
+
+	(single_name, single), (parallel_name, parallel_results) = all_results.items()
+	speedup = sum(result['time_to_depth'] for result in single) / sum(result['time_to_depth'] for result in parallel_results)
+	print(f"Time to depth {depth}: {parallel_name} is {speedup:.2f}x as fast as {single_name} overall")
+
+	if json_file is not None:
+		with open(json_file, 'w') as f:
+			json.dump({ 'depth': depth, 'time_limit': time_limit, 'results': all_results }, f, indent=2)
+		print("Wrote results to", json_file)
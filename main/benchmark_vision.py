@@ -0,0 +1,224 @@
+"""
+Benchmark the computer vision pipeline, stage by stage, over a corpus of board images.
+
+    python3 benchmark_vision.py                                  # Use calibration_test_images/
+    python3 benchmark_vision.py frames/ img.png ...              # Any mix of images and directories
+    python3 benchmark_vision.py path/to/recording                # Every frame of a recording (see recording.py)
+    python3 benchmark_vision.py --json results.json              # Write machine-readable results
+    python3 benchmark_vision.py --baseline baseline.json         # Fail if slower than a previous run
+    python3 benchmark_vision.py --undistorted frames/            # Images are already undistorted
+    python3 benchmark_vision.py --coarse-to-fine                 # See Detector.coarse_to_fine
+
+Each stage is timed separately (see STAGES), and reported as mean, p50, p95 and p99 in milliseconds.
+When comparing against a baseline, a stage counts as a regression if its p50 is more than
+REGRESSION_TOLERANCE slower than it was, and the script exits with a non-zero status so it can be
+used as a check before changes to the Detector reach the board.
+
+Runs headless: nothing is ever shown.
+"""
+from typing import *
+import os
+import sys
+import json
+import cv2
+import numpy as np
+from time import perf_counter
+from collections import defaultdict
+from os.path import dirname, join, isdir, exists
+from detector import Detector
+from recording import Recording, INDEX_FILE
+from camera_calibration import CameraCalibration
+
+STAGES = [
+	'decode',
+	'undistort',
+	'grayscale',
+	'apriltag_scan',
+	'calculate_square_locations',
+	'assign_squares',
+	'generate_board',
+	'total',
+]
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+DEFAULT_CORPUS = [join(dirname(__file__), 'calibration_test_images')]
+
+REGRESSION_TOLERANCE = 0.2
+""" A stage's p50 may get this much (as a fraction) slower than the baseline before it's a regression. """
+
+def is_recording(path: str) -> bool:
+	return isdir(path) and exists(join(path, INDEX_FILE))
+
+def find_images(paths: List[str]) -> List[str]:
+	"""
+	Expand directories into the images in them. Recordings are kept as they are (see load_images).
+	"""
+	files = []
+	for path in paths:
+		if is_recording(path):
+			files.append(path)
+		elif isdir(path):
+			files += sorted(
+				join(path, file) for file in os.listdir(path)
+				if file.lower().endswith(IMAGE_EXTENSIONS))
+		else:
+			files.append(path)
+	return files
+
+def load_images(files: List[str]) -> Iterator[Union[bytes, np.ndarray]]:
+	"""
+	Every image in files (see find_images): encoded, as read from an image file, or already decoded,
+	as each frame of a recording is.
+	"""
+	for file in files:
+		if is_recording(file):
+			recording = Recording(file)
+			try:
+				for i in range(len(recording)):
+					yield recording.frame(i)
+			finally:
+				recording.close()
+		else:
+			with open(file, 'rb') as f:
+				yield f.read()
+
+def benchmark_image(data: Union[bytes, np.ndarray], detector: Detector, undistort_maps) -> Dict[str, float]:
+	"""
+	Run the pipeline on one (encoded, or already decoded) image, timing each stage. Stages after the
+	board couldn't be found are left out, as are decoding if the image already was and undistortion if
+	undistort_maps is None.
+	"""
+	timings = {}
+
+	def timed(stage: str, fn: Callable, *args):
+		start = perf_counter()
+		result = fn(*args)
+		timings[stage] = perf_counter() - start
+		return result
+
+	start = perf_counter()
+	if isinstance(data, np.ndarray):
+		img = data
+	else:
+		img = timed('decode', cv2.imdecode, np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+	if undistort_maps is not None:
+		img = timed('undistort', cv2.remap, img, *undistort_maps, cv2.INTER_LINEAR)
+	# Recordings may already be grayscale
+	gray = timed('grayscale', cv2.cvtColor, img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+	tags = timed('apriltag_scan', detector.detect_tags, gray)
+
+	# Measure actually fitting the board, not just hitting the cache
+	detector.geometry = None
+	try:
+		geometry = timed('calculate_square_locations', detector.locate_board, tags)
+	except ValueError:
+		return timings
+
+	positions = timed('assign_squares', detector.assign_squares, tags, geometry)
+	timed('generate_board', detector.generate_board, [(square, tag_id) for square, tag_id, _ in positions])
+	timings['total'] = perf_counter() - start
+
+	return timings
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+	ms = 1000 * np.array(samples)
+	return {
+		'n': len(samples),
+		'mean_ms': float(np.mean(ms)),
+		'p50_ms': float(np.percentile(ms, 50)),
+		'p95_ms': float(np.percentile(ms, 95)),
+		'p99_ms': float(np.percentile(ms, 99)),
+	}
+
+def run_benchmark(files: List[str], iterations=3, undistort=True, coarse_to_fine=False) -> Dict[str, Any]:
+	"""
+	Benchmark every image in files (see find_images). Set undistort=False if the images were already
+	undistorted (ex. frames recorded from the Vision Service, as opposed to straight from the camera).
+	"""
+	undistort_maps = None
+	if undistort:
+		calibration = CameraCalibration.read(join(dirname(__file__), 'calibration.json'))
+		undistort_maps = calibration.undistortion_maps()
+	detector = Detector()
+	detector.coarse_to_fine = coarse_to_fine
+
+	samples: Dict[str, List[float]] = defaultdict(list)
+	images = 0
+	boards_found = 0
+
+	for data in load_images(files):
+		images += 1
+		for _ in range(iterations):
+			timings = benchmark_image(data, detector, undistort_maps)
+			for stage, seconds in timings.items():
+				samples[stage].append(seconds)
+		if 'total' in timings:
+			boards_found += 1
+
+	return {
+		'images': images,
+		'iterations': iterations,
+		'boards_found': boards_found,
+		'stages': {stage: summarize(samples[stage]) for stage in STAGES if len(samples[stage]) > 0},
+	}
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+	"""
+	Returns a description of every stage that regressed.
+	"""
+	regressions = []
+	for stage, stats in results['stages'].items():
+		if stage not in baseline['stages']:
+			continue
+		before = baseline['stages'][stage]['p50_ms']
+		after = stats['p50_ms']
+		if after > before * (1 + REGRESSION_TOLERANCE):
+			regressions.append(f"{stage}: p50 {before:.2f}ms -> {after:.2f}ms")
+	return regressions
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+
+	def pop_option(name: str) -> Optional[str]:
+		if name not in args:
+			return None
+		value = args[args.index(name) + 1]
+		args.remove(name)
+		args.remove(value)
+		return value
+
+	json_file = pop_option('--json')
+	baseline_file = pop_option('--baseline')
+	iterations = int(pop_option('--iterations') or 3)
+	undistort = '--undistorted' not in args
+	if not undistort:
+		args.remove('--undistorted')
+	coarse_to_fine = '--coarse-to-fine' in args
+	if coarse_to_fine:
+		args.remove('--coarse-to-fine')
+
+	files = find_images(args if len(args) > 0 else DEFAULT_CORPUS)
+	print(f"Benchmarking {len(files)} images and recordings ({iterations} iterations each)...")
+	results = run_benchmark(files, iterations, undistort, coarse_to_fine)
+	print(f"Found the board in {results['boards_found']} of {results['images']} images.")
+
+	print(f"{'Stage':<28} {'n':>5} {'Mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+	for stage, stats in results['stages'].items():
+		print(f"{stage:<28} {stats['n']:>5} {stats['mean_ms']:>9.2f} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+	if json_file is not None:
+		with open(json_file, 'w') as f:
+			json.dump(results, f, indent=2)
+		print("Wrote results to", json_file)
+
+	if baseline_file is not None:
+		with open(baseline_file, 'r') as f:
+			baseline = json.load(f)
+		regressions = compare_to_baseline(results, baseline)
+		if len(regressions) > 0:
+			print("REGRESSIONS:")
+			for regression in regressions:
+				print("  " + regression)
+			sys.exit(1)
+		print("No regressions against", baseline_file)
@@ -0,0 +1,130 @@
+"""
+Combining detections from several frames into one confident read of the board.
+
+Any single frame can be bad (motion blur, a hand over the board, a tag that just wasn't picked up),
+but it's unlikely that several frames in a row are bad in the same way. BoardFusion has every frame
+vote on what's in each square, weighting each vote by how sure the Apriltag detector was about it
+(its decision margin), and reports how much agreement there was for every square.
+"""
+from typing import *
+from collections import defaultdict
+from board_geometry import SQUARE_NAMES
+
+EMPTY = None
+""" The "tag ID" that votes for a square being empty. """
+
+EMPTY_VOTE_WEIGHT = 20.0
+"""
+How much weight a frame's vote for a square being empty gets. Missing a tag is much more common than
+seeing one that isn't there, so this is deliberately lower than the decision margin of a clearly
+visible tag (which is usually 50+).
+"""
+
+class BoardFusion:
+	"""
+	Accumulates per-square votes from detection summaries (see Detector.detect_summary).
+	"""
+	min_confidence: float
+	""" Every square needs at least this share of its votes for the board to be considered stable. """
+
+	stable_frames: int
+	""" The board is only stable once this many frames in a row have seen exactly the fused result. """
+
+	votes: Dict[str, Dict[Optional[int], float]]
+	""" For each square, the total weight of the votes for each tag ID (or EMPTY). """
+
+	frames: int = 0
+	""" Number of frames that have been added. """
+
+	frames_with_board: int = 0
+	""" Number of frames in which the board was actually found (the others don't vote). """
+
+	last_error: Optional[str] = None
+	""" Why the board couldn't be found in the most recent frame that it wasn't. """
+
+	def __init__(self, min_confidence=0.75, stable_frames=2):
+		self.min_confidence = min_confidence
+		self.stable_frames = stable_frames
+		self.votes = {square: defaultdict(float) for square in SQUARE_NAMES}
+		self._agreeing_frames = 0
+
+	def add(self, summary: Dict[str, Any]):
+		"""
+		Add one frame's detections.
+		"""
+		self.frames += 1
+		if not summary['ok']:
+			self.last_error = summary['error']
+			self._agreeing_frames = 0
+			return
+		self.frames_with_board += 1
+
+		margins = {tag['tag_id']: tag['decision_margin'] for tag in summary['tags']}
+		occupied = set()
+		for piece in summary['pieces']:
+			self.votes[piece['square']][piece['tag_id']] += margins.get(piece['tag_id'], EMPTY_VOTE_WEIGHT)
+			occupied.add(piece['square'])
+		for square in SQUARE_NAMES:
+			if square not in occupied:
+				self.votes[square][EMPTY] += EMPTY_VOTE_WEIGHT
+
+		# Count how many frames in a row have seen exactly what the fused result says
+		frame_positions = {piece['square']: piece['tag_id'] for piece in summary['pieces']}
+		fused_positions, _ = self.result()
+		if frame_positions == dict(fused_positions):
+			self._agreeing_frames += 1
+		else:
+			self._agreeing_frames = 0
+
+	def is_stable(self) -> bool:
+		"""
+		Whether enough frames have agreed, confidently enough, that there's no point looking at more.
+		"""
+		if self._agreeing_frames < self.stable_frames:
+			return False
+		_, confidence = self.result()
+		return min(confidence.values()) >= self.min_confidence
+
+	def result(self) -> Tuple[List[Tuple[str, int]], Dict[str, float]]:
+		"""
+		The fused board, as a list of (square, tag ID) positions (like Detector.detect_piece_positions),
+		and the confidence (share of the vote, 0 to 1) in what was decided for every square.
+		"""
+		winners = self._winners()
+		positions = [(square, tag_id) for square, tag_id in winners.items() if tag_id is not EMPTY]
+		square_for_tag = {tag_id: square for square, tag_id in winners.items() if tag_id is not EMPTY}
+		confidence = {}
+		for square, tag_id in winners.items():
+			# Votes for a piece that turned out to be somewhere else aren't really votes against this
+			# square's winner
+			total = sum(
+				weight for candidate, weight in self.votes[square].items()
+				if candidate is EMPTY or square_for_tag.get(candidate, square) == square)
+			confidence[square] = self.votes[square][tag_id] / total if total > 0 else 0.0
+		return positions, confidence
+
+	def _winners(self) -> Dict[str, Optional[int]]:
+		"""
+		Decide what's in each square. A physical piece can only be in one place, so if the same tag
+		wins more than one square, the square with the most weight for it keeps it and the others
+		fall back to their next best option.
+		"""
+		# Every (weight, square, tag) vote, strongest first
+		candidates = sorted(
+			((weight, square, tag_id) for square, votes in self.votes.items() for tag_id, weight in votes.items()),
+			key=lambda candidate: candidate[0],
+			reverse=True)
+
+		winners = {}
+		used_tags = set()
+		for _, square, tag_id in candidates:
+			if square in winners or (tag_id is not EMPTY and tag_id in used_tags):
+				continue
+			winners[square] = tag_id
+			if tag_id is not EMPTY:
+				used_tags.add(tag_id)
+
+		# Squares that nobody voted for (or whose only candidates were taken) are empty
+		for square in SQUARE_NAMES:
+			winners.setdefault(square, EMPTY)
+		return winners
@@ -0,0 +1,105 @@
+"""
+Where the chess board is in the image, as inferred from the four corner Apriltags.
+
+The board and the camera are both fixed to the frame, so the geometry almost never changes between
+frames. The Detector keeps the most recent BoardGeometry around and only re-fits it when the corner
+tags move.
+"""
+from typing import *
+import cv2
+import chess
+import numpy as np
+
+SQUARE_NAMES: List[str] = [file + rank for rank in chess.RANK_NAMES for file in chess.FILE_NAMES]
+""" Every square on the board, in the same order as BoardGeometry.square_centers (a1, b1, ..., h8). """
+
+# Board-space coordinates are measured in square widths, with the a0 corner tag at the origin. Board
+# corner tracking tags are centered in (imaginary) squares one rank and one file off the edge of the
+# board (α0, I0, α9, I9), which leaves them 9 square widths apart on each axis.
+_CORNERS_BOARD_SPACE = np.array([[0, 0], [9, 0], [9, 9], [0, 9]], dtype=np.float32)
+_SQUARES_BOARD_SPACE = np.array(
+	[[file_i, rank_i] for rank_i in range(1, 9) for file_i in range(1, 9)],
+	dtype=np.float32)
+
+class BoardGeometry:
+	"""
+	A homography from board-space to image-space, fitted from the centers of the four corner tags,
+	along with the resulting location of the center of every square.
+
+	A homography is the correct model for a flat board seen through an (undistorted) pinhole camera,
+	so this replaces the old second-order heuristic, which was close but not quite right.
+	"""
+	corners: np.array
+	""" (4, 2) pixel locations of the corner tags, in the order a0, I0, I9, a9. """
+
+	homography: np.array
+	""" 3x3 matrix mapping board-space to image-space. """
+
+	square_centers: np.array
+	""" (64, 2) pixel locations of the center of each square, in the order of SQUARE_NAMES. """
+
+	def __init__(self, corners: np.array):
+		self.corners = np.asarray(corners, dtype=np.float32).reshape(4, 2)
+		self.homography = cv2.getPerspectiveTransform(_CORNERS_BOARD_SPACE, self.corners)
+		self.square_centers = self.to_image_space(_SQUARES_BOARD_SPACE)
+		self._squares = None
+
+	def to_image_space(self, points: np.array) -> np.array:
+		"""
+		Map an (N, 2) array of board-space points to pixel locations.
+		"""
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+		return cv2.perspectiveTransform(points, self.homography).reshape(-1, 2).astype(np.float64)
+
+	def to_board_space(self, points: np.array) -> np.array:
+		"""
+		Map an (N, 2) array of pixel locations to board-space (in square widths from the a0 tag).
+		"""
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+		inverse = np.linalg.inv(self.homography)
+		return cv2.perspectiveTransform(points, inverse).reshape(-1, 2).astype(np.float64)
+
+	@property
+	def squares(self) -> Dict[str, np.array]:
+		"""
+		Mapping of square names (ex. 'c3') to center locations (in pixels).
+		"""
+		if self._squares is None:
+			self._squares = dict(zip(SQUARE_NAMES, self.square_centers))
+		# Callers are allowed to modify the dict, so hand out a copy
+		return dict(self._squares)
+
+	@property
+	def center(self) -> np.array:
+		""" The center of the board (where d4, d5, e4 and e5 meet), in pixels. """
+		return self.to_image_space([[4.5, 4.5]])[0]
+
+	def square_bounds(self, margin=0.0) -> np.array:
+		"""
+		(64, 4) integer pixel bounding boxes (x0, y0, x1, y1) of every square, in the order of
+		SQUARE_NAMES, grown by margin square widths on every side. Not clipped to the image.
+		"""
+		return self._cell_bounds(_SQUARES_BOARD_SPACE, margin)
+
+	def corner_bounds(self, margin=0.0) -> np.array:
+		"""
+		(4, 4) integer pixel bounding boxes (x0, y0, x1, y1) of the (imaginary) squares the corner tags
+		are centered in, in the same order as corners.
+		"""
+		return self._cell_bounds(_CORNERS_BOARD_SPACE, margin)
+
+	def _cell_bounds(self, centers: np.array, margin: float) -> np.array:
+		half = 0.5 + margin
+		offsets = np.array([[-half, -half], [half, -half], [half, half], [-half, half]], dtype=np.float32)
+		cell_corners = self.to_image_space((centers[:, None, :] + offsets[None, :, :]).reshape(-1, 2)).reshape(-1, 4, 2)
+		return np.concatenate([
+			np.floor(cell_corners.min(axis=1)),
+			np.ceil(cell_corners.max(axis=1)),
+		], axis=1).astype(int)
+
+	def max_corner_shift(self, corners: np.array) -> float:
+		"""
+		How far (in pixels) the furthest-moved corner is from where it was when this geometry was fitted.
+		"""
+		deltas = np.asarray(corners, dtype=np.float32).reshape(4, 2) - self.corners
+		return float(np.max(np.linalg.norm(deltas, axis=1)))
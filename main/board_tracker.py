@@ -0,0 +1,158 @@
+"""
+Keeping track of the game between turns, rather than re-reading the board from scratch every time.
+
+Detector.generate_board only knows where the pieces are, so a board built from it has no castling
+rights, no en passant square and no move history, and any square that was misread goes straight
+into the next search. BoardTracker instead keeps the chess.Board from the previous turn (along with
+which physical piece, by tag ID, is on each square), looks only at the squares whose tags changed,
+and works out which single legal move explains them. The whole board is only re-read from the
+detections when no move (or more than one) does.
+"""
+from typing import *
+import chess
+from detector import Piece
+
+class BoardTracker:
+	"""
+	The game as it has actually been played, updated from detections (see update) and from the moves
+	the computer makes itself (see push).
+	"""
+	board: Optional[chess.Board] = None
+	""" The tracked game, or None if we haven't seen the board yet. """
+
+	tags: Dict[chess.Square, int]
+	""" The tag ID of the physical piece on each occupied square of board. """
+
+	min_confidence: float
+	"""
+	A changed square that no move explains is assumed to be a misread (and ignored) if the detection
+	was less confident than this about it. Otherwise, the board really isn't what we think it is.
+	"""
+
+	last_move: Optional[chess.Move] = None
+	""" The move update most recently worked out was made, if any. """
+
+	def __init__(self, min_confidence=0.75):
+		self.min_confidence = min_confidence
+		self.tags = {}
+
+	def reset(self):
+		"""
+		Forget the tracked game (ex. when a new one starts).
+		"""
+		self.board = None
+		self.tags = {}
+		self.last_move = None
+
+	def update(self, positions: List[Tuple[str, int]], turn: chess.Color, confidence: Dict[str, float] = {}) -> bool:
+		"""
+		Bring the tracked board up to date with newly detected (square, tag ID) positions (like
+		Detector.detect_piece_positions) on which it's turn's turn. If it isn't turn's turn on the
+		tracked board, the other side must have made exactly one move since, which is pushed onto it.
+
+		Returns whether the positions could be explained that way. If they couldn't, the tracked board
+		is rebuilt from the positions (losing the move history) and False is returned.
+		"""
+		self.last_move = None
+		moves = self.explanations(positions, turn, confidence)
+		if len(moves) != 1:
+			self.sync(positions, turn)
+			return False
+		if moves[0] is not None:
+			self.push(moves[0])
+			self.last_move = moves[0]
+		return True
+
+	def explanations(self, positions: List[Tuple[str, int]], turn: chess.Color, confidence: Dict[str, float] = {}) -> List[Optional[chess.Move]]:
+		"""
+		Every way the tracked board could have become the detected positions, with it now being turn's
+		turn: each is either a legal move, or None if nothing should have changed. Anything other than
+		exactly one means the positions are ambiguous (or simply wrong).
+		"""
+		if self.board is None:
+			return []
+		observed = {chess.parse_square(square): tag_id for square, tag_id in positions}
+		changed = {square for square in chess.SQUARES if observed.get(square) != self.tags.get(square)}
+
+		def is_misread(square: chess.Square):
+			return confidence.get(chess.SQUARE_NAMES[square], 1.0) < self.min_confidence
+
+		# Nobody else has moved since the last time we looked (ex. we just moved for them in autoplay)
+		if self.board.turn == turn:
+			return [None] if all(is_misread(square) for square in changed) else []
+		if len(changed) == 0:
+			return []
+
+		matches = []
+		for move in self.board.legal_moves:
+			expected = self._apply(self.tags, move)
+			touched = {square for square in chess.SQUARES if expected.get(square) != self.tags.get(square)}
+			# Cheap check first: every square this move changes must have changed
+			if not touched <= changed:
+				continue
+			if move.promotion is not None:
+				# The promoted piece has a different tag, but it had better be ours
+				promoted = observed.get(move.to_square)
+				if promoted is None or Piece(promoted).symbol.isupper() != (self.board.turn == chess.WHITE):
+					continue
+			elif any(observed.get(square) != expected.get(square) for square in touched):
+				continue
+			if all(is_misread(square) for square in changed - touched):
+				matches.append(move)
+
+		return self._pick_promotions(matches, observed)
+
+	def push(self, move: chess.Move):
+		"""
+		Make a move on the tracked board (ex. one the computer just made physically).
+		"""
+		self.tags = self._apply(self.tags, move)
+		self.board.push(move)
+
+	def sync(self, positions: List[Tuple[str, int]], turn: chess.Color):
+		"""
+		Throw away the tracked game and start again from the detected positions. Castling rights are
+		assumed for any king and rook that are still on their starting squares.
+		"""
+		self.tags = {chess.parse_square(square): tag_id for square, tag_id in positions}
+		self.board = chess.Board(fen=None)
+		for square, tag_id in self.tags.items():
+			self.board.set_piece_at(square, chess.Piece.from_symbol(Piece(tag_id).symbol))
+		self.board.turn = turn
+		self.board.castling_rights = self.board.rooks & chess.BB_CORNERS
+		self.board.castling_rights = self.board.clean_castling_rights()
+
+	def _apply(self, tags: Dict[chess.Square, int], move: chess.Move) -> Dict[chess.Square, int]:
+		"""
+		Where every tag would be after move is made on the tracked board.
+		"""
+		tags = dict(tags)
+		tag_id = tags.pop(move.from_square, None)
+		if self.board.is_en_passant(move):
+			tags.pop(move.to_square - 8 if self.board.turn == chess.WHITE else move.to_square + 8, None)
+		if self.board.is_castling(move):
+			rank = chess.square_rank(move.from_square)
+			rook_from, rook_to = (chess.H1, chess.F1) if self.board.is_kingside_castling(move) else (chess.A1, chess.D1)
+			rook_from, rook_to = rook_from + 8 * rank, rook_to + 8 * rank
+			tags[rook_to] = tags.pop(rook_from, None)
+		if tag_id is not None:
+			tags[move.to_square] = tag_id
+		return tags
+
+	def _pick_promotions(self, matches: List[chess.Move], observed: Dict[chess.Square, int]) -> List[chess.Move]:
+		"""
+		A pawn reaching the last rank looks the same no matter what it's promoted to, so keep only the
+		promotion to whatever piece was put there (or a queen, if that's not one of the options).
+		"""
+		promotions = [move for move in matches if move.promotion is not None]
+		if len(promotions) <= 1:
+			return matches
+		others = [move for move in matches if move.promotion is None]
+		picked = []
+		for from_square, to_square in {(move.from_square, move.to_square) for move in promotions}:
+			piece_type = chess.Piece.from_symbol(Piece(observed[to_square]).symbol).piece_type
+			options = [move for move in promotions if (move.from_square, move.to_square) == (from_square, to_square)]
+			picked.append(next(
+				(move for move in options if move.promotion == piece_type),
+				next(move for move in options if move.promotion == chess.QUEEN)))
+		return others + picked
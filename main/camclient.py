@@ -0,0 +1,122 @@
+"""
+Client for the Grandmaster Vision Service (camserver.py, running on the Raspberry Pi).
+"""
+from typing import *
+from helpers import print_to_dashboard as print
+
+import cv2
+import requests
+from time import time
+from urllib.parse import urlencode
+from threading import Thread, Condition
+from image_encoding import decode_image
+
+VISION_SERVICE_URL = 'http://grandmaster.local:5555'
+
+def fetch_image(encoding='png', quality: Optional[int] = None, grayscale=False, base_url=VISION_SERVICE_URL, **params):
+	"""
+	Fetch a single frame from the Vision Service in the given encoding (see image_encoding.ENCODINGS).
+	If grayscale is set, the Vision Service sends (and we decode) a single channel. Extra keyword
+	arguments are passed as query parameters (ex. max_age).
+	"""
+	if quality is not None:
+		params['quality'] = quality
+	if grayscale:
+		params['gray'] = 1
+	r = requests.get(f'{base_url}/camera.{encoding}', params=params)
+	r.raise_for_status()
+	return decode_image(r.content, r.headers, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+
+def fetch_detections(base_url=VISION_SERVICE_URL, raise_on_error=True, **params) -> Dict[str, Any]:
+	"""
+	Have the Vision Service detect the board itself and return the results (see camserver.detections).
+	Raises a ValueError if the board couldn't be found, unless raise_on_error is False.
+	"""
+	r = requests.get(f'{base_url}/detections.json', params=params)
+	if r.status_code != 422:
+		r.raise_for_status()
+	data = r.json()
+	if raise_on_error and not data['ok']:
+		raise ValueError(data['error'])
+	return data
+
+class MJPEGStream:
+	"""
+	Stay subscribed to the Vision Service's MJPEG stream on a background thread, always keeping the
+	newest frame on hand. This saves a new connection and a full encode for every image we want.
+
+	Frame times are local (ie. when the frame was received), not the Pi's clock.
+	"""
+	url: str
+
+	def __init__(self, quality: Optional[int] = None, grayscale=False, base_url=VISION_SERVICE_URL):
+		self.decode_flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+		params = {}
+		if quality is not None:
+			params['quality'] = quality
+		if grayscale:
+			params['gray'] = 1
+		self.url = f'{base_url}/camera.mjpg' + (f'?{urlencode(params)}' if len(params) > 0 else '')
+		self._new_frame = Condition()
+		self._frame = None
+		self._frame_time = 0.0
+		self._error = None
+		self._running = True
+		self._thread = Thread(target=self._run, name='mjpeg-stream', daemon=True)
+		self._thread.start()
+
+	def latest_frame(self, newer_than: float = 0, timeout: float = 5):
+		"""
+		Get the newest frame and the time it was received. Waits (up to timeout seconds) if the newest
+		frame was received before newer_than.
+		"""
+		with self._new_frame:
+			if not self._new_frame.wait_for(lambda: self._frame_time > newer_than, timeout):
+				raise IOError(f"Timed out waiting for a frame from the Vision Service! ({self._error})")
+			return self._frame, self._frame_time
+
+	def close(self):
+		self._running = False
+
+	def _run(self):
+		while self._running:
+			try:
+				with requests.get(self.url, stream=True, timeout=10) as r:
+					r.raise_for_status()
+					for data in self._read_parts(r.raw):
+						frame = decode_image(data, flags=self.decode_flags)
+						with self._new_frame:
+							self._frame = frame
+							self._frame_time = time()
+							self._error = None
+							self._new_frame.notify_all()
+						if not self._running:
+							return
+			except Exception as err:
+				# The Vision Service is often flakey, just reconnect
+				print("MJPEG stream disconnected, reconnecting:", err)
+				with self._new_frame:
+					self._error = err
+
+	@staticmethod
+	def _read_parts(stream) -> Iterator[bytes]:
+		"""
+		Split a multipart/x-mixed-replace stream into the bodies of each part. Relies on each part
+		having a Content-Length header, which camserver always sends.
+		"""
+		while True:
+			content_length = None
+			# Read headers (skipping the boundary line and any blank lines before it)
+			while True:
+				line = stream.readline()
+				if line == b'':
+					return
+				line = line.strip()
+				if line == b'':
+					if content_length is not None:
+						break
+					continue
+				name, _, value = line.partition(b':')
+				if name.strip().lower() == b'content-length':
+					content_length = int(value.strip())
+			yield stream.read(content_length)
@@ -1,4 +1,9 @@
 import cv2
+import numpy as np
+from enum import Enum
+from typing import *
+from time import time
+from threading import Thread, Condition
 from helpers import print_to_dashboard as print
 from os.path import dirname, join
 from camera_calibration import CameraCalibration
@@ -6,6 +11,20 @@ from camera_calibration import CameraCalibration
 class CameraError(Exception):
     pass
 
+class UndistortMode(Enum):
+    """
+    How (and whether) the Camera corrects for lens distortion.
+    """
+    FRAME = 'frame'
+    """ Undistort every frame using precomputed remap tables. """
+
+    POINTS = 'points'
+    """
+    Return raw (distorted) frames. Whoever consumes them is responsible for undistorting the points
+    they care about (see CameraCalibration.undistort_points and Detector.calibration), which is far
+    cheaper than undistorting millions of pixels.
+    """
+
 class Camera:
     """
     Light wrapper around OpenCV's camera APIs to make them slightly nicer to use, and to integrate
@@ -13,14 +32,51 @@ class Camera:
     """
     camera: cv2.VideoCapture
     calibration: CameraCalibration
+    undistort_mode: UndistortMode
+
+    continuous: bool
+    """
+    In continuous mode, a background thread reads frames as fast as the camera produces them and
+    keeps only the newest one, so callers never have to wait for the sensor (see latest_frame).
+    """
+
+    grayscale: bool
+    """
+    Produce single-channel (luma) frames. Apriltags are only ever detected in grayscale, and a third
+    of the pixels means a third of the work to undistort, encode, transfer and decode.
+    """
 
-    def __init__(self, camera_idx=0, calibration_file=join(dirname(__file__), 'calibration.json')):
+    def __init__(self, camera_idx=0, calibration_file=join(dirname(__file__), 'calibration.json'), undistort_mode=UndistortMode.FRAME, continuous=False, grayscale=False):
         self.calibration = CameraCalibration.read(calibration_file)
+        self.undistort_mode = UndistortMode(undistort_mode)
+        # Building the undistortion maps is the expensive part of cv2.undistort, so only do it once
+        self.undistort_map_xy, self.undistort_map_weights = self.calibration.undistortion_maps()
         self.camera = cv2.VideoCapture(camera_idx)
         self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
 
+        self.grayscale = grayscale
+        if grayscale:
+            # Ask for frames as the camera sends them (ex. YUYV or MJPEG), so we can pull the luma
+            # out directly instead of having OpenCV convert to BGR first. Not every backend supports
+            # this, so _to_grayscale copes with whatever we get.
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+        self.continuous = continuous
+        # Protects everything below. Notified whenever a new frame arrives.
+        self._new_frame = Condition()
+        self._frame = None
+        self._frame_time = 0.0
+        self._frame_number = 0
+        self._error = None
+        self._processed = (-1, None)  # (frame number, processed frame), so we only undistort once
+        self._listeners: List[Callable[[Optional[float]], None]] = []
+        self._running = continuous
+        if continuous:
+            self._capture_thread = Thread(target=self._capture_loop, name='camera-capture', daemon=True)
+            self._capture_thread.start()
+
     @property
     def width(self):
         return self.calibration.width
@@ -33,7 +89,13 @@ class Camera:
         """
         Capture a frame from the camera. Image is guaranteed to be captured while this method is
         executing (ie. not buffered).
+
+        In UndistortMode.POINTS, the frame is returned as-is (still distorted).
         """
+        if self.continuous:
+            frame, _ = self.latest_frame(newer_than=time())
+            return frame
+
         # There's an annoying frame buffer we want to drain
         for _ in range(1):
             self.camera.read()
@@ -43,7 +105,117 @@ class Camera:
         if not success:
             raise CameraError("Failed to read camera frame!")
 
-        undistorted = cv2.undistort(
-            frame, self.calibration.camera_matrix, self.calibration.distortion)
+        return self._process(frame)
+
+    def latest_frame(self, newer_than: float = 0, timeout: float = 5) -> Tuple[Any, float]:
+        """
+        Get the newest frame from the background capture thread, along with the time (as in
+        time.time()) that it was read. Only available in continuous mode.
+
+        If the newest frame was captured before newer_than, this waits (up to timeout seconds) for
+        the next one. With the default, the newest frame is returned immediately.
+        """
+        if not self.continuous:
+            raise CameraError("latest_frame is only available in continuous mode!")
+
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._frame_time > newer_than or self._error is not None or not self._running, timeout):
+                raise CameraError("Timed out waiting for a camera frame!")
+            if self._frame_time <= newer_than:
+                raise CameraError(f"Capture thread stopped: {self._error}")
+
+            frame, frame_time, frame_number = self._frame, self._frame_time, self._frame_number
+
+            processed_number, processed = self._processed
+            if processed_number == frame_number:
+                return processed, frame_time
 
-        return undistorted
\ No newline at end of file
+        processed = self._process(frame)
+
+        with self._new_frame:
+            # Another caller may have processed a newer frame in the meantime
+            if frame_number > self._processed[0]:
+                self._processed = (frame_number, processed)
+
+        return processed, frame_time
+
+    def add_frame_listener(self, listener: Callable[[Optional[float]], None]):
+        """
+        Call listener (from the capture thread) with the time of every new frame as soon as it's
+        read, and with None if the capture thread stops. This lets callers that can't block, like an
+        event loop, wait for frames (see camserver_async.SharedResults). The listener must be quick,
+        and must not raise. Only available in continuous mode.
+        """
+        if not self.continuous:
+            raise CameraError("Frame listeners are only available in continuous mode!")
+        with self._new_frame:
+            self._listeners.append(listener)
+
+    def remove_frame_listener(self, listener: Callable[[Optional[float]], None]):
+        with self._new_frame:
+            self._listeners.remove(listener)
+
+    def close(self):
+        """
+        Stop the capture thread (if any) and release the camera.
+        """
+        with self._new_frame:
+            self._running = False
+            self._new_frame.notify_all()
+        if self.continuous:
+            self._capture_thread.join()
+        self.camera.release()
+
+    def _capture_loop(self):
+        while self._running:
+            success, frame = self.camera.read()
+            frame_time = time()
+
+            with self._new_frame:
+                if not success:
+                    self._error = "Failed to read camera frame!"
+                    self._running = False
+                else:
+                    self._frame = frame
+                    self._frame_time = frame_time
+                    self._frame_number += 1
+                self._new_frame.notify_all()
+                listeners = list(self._listeners) if success else []
+
+            for listener in listeners:
+                listener(frame_time)
+
+        with self._new_frame:
+            listeners = list(self._listeners)
+        # Stopped (by close or an error), so nobody should wait for another frame
+        for listener in listeners:
+            listener(None)
+
+    def _process(self, frame):
+        if self.grayscale:
+            frame = self._to_grayscale(frame)
+
+        if self.undistort_mode == UndistortMode.POINTS:
+            return frame
+
+        return self.undistort(frame)
+
+    def undistort(self, frame):
+        """
+        Undistort a full frame. Equivalent to cv2.undistort, but reuses the precomputed maps.
+        """
+        return cv2.remap(frame, self.undistort_map_xy, self.undistort_map_weights, cv2.INTER_LINEAR)
+
+    def _to_grayscale(self, frame):
+        """
+        Extract a single-channel image from a frame in whatever format the camera gave us.
+        """
+        if frame.ndim == 2 and frame.shape[0] == 1:
+            # Still-encoded (MJPEG) buffer. Decoding straight to grayscale skips the chroma entirely.
+            return cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
+        if frame.ndim == 2:
+            return frame
+        if frame.shape[2] == 2:
+            # YUYV: luma is every other byte
+            return np.ascontiguousarray(frame[:, :, 0])
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
@@ -33,6 +33,27 @@ class CameraCalibration:
             assert data['type'] == cls.JSON_TYPE
             return cls(np.array(data['camera_matrix']), np.array(data['distortion']), data['width'], data['height'])
 
+    def undistortion_maps(self):
+        """
+        Precompute the lookup tables to undistort a full frame with cv2.remap.
+
+        The maps are in OpenCV's compact fixed-point format (CV_16SC2 integer coordinates plus a
+        CV_16UC1 table of interpolation weights), which is both smaller and faster to remap with
+        than floating point maps.
+        """
+        return cv2.initUndistortRectifyMap(
+            self.camera_matrix, self.distortion, None, self.camera_matrix,
+            (self.width, self.height), cv2.CV_16SC2)
+
+    def undistort_points(self, points):
+        """
+        Undistort an (N, 2) array of pixel locations. The result is in the same pixel coordinates
+        that cv2.undistort would have produced, so it's interchangeable with undistorting the image.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.undistortPoints(
+            points, self.camera_matrix, self.distortion, P=self.camera_matrix).reshape(-1, 2)
+
 
 def calibrate(images, draw=False):
     """
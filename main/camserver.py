@@ -1,37 +1,158 @@
 """
 This file runs on the Raspberry Pi and serves images from the PiCam.
+
+If more than one client will be using the camera at once, run camserver_async.py instead.
+
+    python3 camserver.py [--gray] [--incremental]
+    flask --app camserver run --host 0.0.0.0 --port 5555    # Color, not incremental
+
+--gray captures grayscale frames, and --incremental only re-scans the squares of the board that
+changed between frames for detections (see Detector.incremental). Without --gray, clients can still
+ask for any image in grayscale with the gray query parameter (ex. /camera.png?gray=1).
 """
-import cv2
-from time import time
+from typing import *
+from time import time, perf_counter
+from threading import Lock
 from random import randint
-from flask import Flask, make_response
+from sys import argv
+from flask import Flask, Response, make_response, request
 from camera import Camera
+from detector import Detector
+from frame_quality import FrameQualityGate
+from image_encoding import ENCODINGS, encode_image
+
+# Frames younger than this (in seconds) are served immediately. Clients can override this with the
+# max_age query parameter (ex. /camera.png?max_age=0 to wait for a brand new frame).
+DEFAULT_MAX_FRAME_AGE = 0.1
+
+MJPEG_BOUNDARY = 'grandmaster-frame'
 
 app = Flask(__name__)
-cam = Camera()
+
+# Created by setup rather than on import, so the constants and helpers here can be imported (ex. by
+# camserver_async.py) without grabbing the camera.
+cam: Optional[Camera] = None
+detector: Optional[Detector] = None
+setup_lock = Lock()
+
+# (frame time, detections), so we only run the detector once per frame no matter how many clients ask.
+# The lock also protects the detector itself, which remembers things between frames (ex. the board
+# geometry) and so can't be used by more than one request thread at a time.
+last_detections = (None, None)
+last_detections_lock = Lock()
+
+def setup(grayscale=False, incremental=False):
+	"""
+	Open the camera and set up the detector, unless that's already been done.
+	"""
+	global cam, detector
+	with setup_lock:
+		if cam is not None:
+			return
+		detector = Detector()
+		detector.incremental = incremental
+		detector.quality_gate = FrameQualityGate()
+		cam = Camera(continuous=True, grayscale=grayscale)
+
+@app.before_request
+def setup_on_first_request():
+	# When started some other way than below (ex. flask run), set up with the defaults
+	if cam is None:
+		setup()
+
+def get_frame():
+	"""
+	Get a recent enough frame from the camera's background capture thread.
+	"""
+	frame, _ = get_frame_and_time()
+	return frame
+
+def get_frame_and_time():
+	max_age = float(request.args.get('max_age', DEFAULT_MAX_FRAME_AGE))
+	return cam.latest_frame(newer_than=time() - max_age)
 
 start_time = time()
 fav_number = randint(1, 1000)
 
-@app.route('/camera.png')
-def camera():
-	img = cam.capture_frame()
-	success, buffer = cv2.imencode('.png', img)
+def get_quality():
+	quality = request.args.get('quality')
+	return int(quality) if quality is not None else None
+
+def get_grayscale():
+	return is_truthy(request.args.get('gray'))
+
+def is_truthy(value: Optional[str]) -> bool:
+	""" Whether a query parameter is set (ex. ?gray=1 or ?gray=true). """
+	return value is not None and value.lower() not in ('', '0', 'false', 'no')
 
-	if not success:
-		return 500
+@app.route('/camera.<encoding>')
+def camera(encoding):
+	"""
+	Serve the current frame in any of the supported encodings (see image_encoding.ENCODINGS), ex.
+	/camera.png, /camera.jpg?quality=80, /camera.webp or /camera.gray. Lossy formats accept a quality
+	(0-100) query parameter, and gray=1 gets any of them as a single channel.
+	"""
+	if encoding not in ENCODINGS:
+		return f"Unknown encoding: {encoding}", 404
 
-	return buffer.tobytes(), { 'Content-Type': 'image/png' }
+	img = get_frame()
+	return encode_image(img, encoding, get_quality(), get_grayscale())
 
+@app.route('/camera.mjpg')
+def camera_stream():
+	"""
+	Stream every new frame as Motion JPEG (multipart/x-mixed-replace). Clients can stay connected and
+	always have a recent frame on hand, instead of paying for a new connection and encode every time.
+	"""
+	quality = get_quality()
+	grayscale = get_grayscale()
+	# Start from a recent frame (with max_age=0, a brand new one)
+	first_newer_than = time() - float(request.args.get('max_age', DEFAULT_MAX_FRAME_AGE))
+
+	def generate():
+		last_frame_time = first_newer_than
+		while True:
+			img, last_frame_time = cam.latest_frame(newer_than=last_frame_time)
+			buffer, _ = encode_image(img, 'jpg', quality, grayscale)
+			yield b''.join([
+				b'--' + MJPEG_BOUNDARY.encode() + b'\r\n',
+				b'Content-Type: image/jpeg\r\n',
+				b'Content-Length: ' + str(len(buffer)).encode() + b'\r\n',
+				b'X-Frame-Time: ' + str(last_frame_time).encode() + b'\r\n\r\n',
+				buffer,
+				b'\r\n'
+			])
+
+	return Response(generate(), mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}')
+
+
+@app.route('/detections.json')
+def detections():
+	"""
+	Run the board detection pipeline here on the Pi and return just the results (see
+	Detector.detect_summary), which is a few hundred bytes instead of a multi-megabyte image.
+	"""
+	global last_detections
+
+	img, frame_time = get_frame_and_time()
+
+	with last_detections_lock:
+		cached_frame_time, result = last_detections
+		if cached_frame_time != frame_time:
+			start = perf_counter()
+			result = detector.detect_summary(img)
+			result['frame_time'] = frame_time
+			result['detect_time'] = perf_counter() - start
+			last_detections = (frame_time, result)
+
+	return result, (200 if result['ok'] else 422)
 
 @app.route('/info.json')
 def info():
 	return { 'ok': True, 'name': 'grandmaster:camserver', 'uptime': time() - start_time, 'favorite_number': fav_number }
 	
 
-@app.route('/')
-def home():
-	return f"""
+HOME_PAGE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -42,9 +163,16 @@ def home():
 <h3>Camera:</h3>
 <img src="/camera.jpg" />
 <button onclick="window.document.location.reload()">Refresh</button>
+<h3>Live:</h3>
+<img src="/camera.mjpg?quality=70" />
 </body>
 </html>
 """
 
+@app.route('/')
+def home():
+	return HOME_PAGE
+
 if __name__ == '__main__':
-	app.run(host='0.0.0.0', port='5555')
\ No newline at end of file
+	setup(grayscale='--gray' in argv, incremental='--incremental' in argv)
+	app.run(host='0.0.0.0', port='5555')
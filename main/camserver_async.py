@@ -0,0 +1,265 @@
+"""
+An asyncio version of the Grandmaster Vision Service (camserver.py), for when more than one client
+is using it at once (ex. the Game Controller, the dashboard's camshow and a browser).
+
+Every result (an encoded image or a set of detections) is computed at most once per frame and
+shared between everyone who asks for it. Requests for the same thing that arrive while it's being
+computed wait for that computation instead of starting their own. Waiting for the next frame happens
+on the event loop itself, and only the slow work (encoding, detection) happens on a thread pool
+(OpenCV and the Apriltag detector release the GIL), so the pool is never tied up by clients that
+are just waiting, and the event loop is always free to answer other clients. MJPEG stream clients
+that can't keep up simply skip frames, so they can't slow down anyone else.
+
+Serves the same routes as camserver.py, and additionally reports per-route latency in /info.json.
+Requires aiohttp.
+"""
+from typing import *
+import asyncio
+import numpy as np
+from time import time, perf_counter
+from random import randint
+from sys import argv
+from threading import Lock
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from camera import Camera, CameraError
+from detector import Detector
+from frame_quality import FrameQualityGate
+from image_encoding import ENCODINGS, encode_image
+from camserver import DEFAULT_MAX_FRAME_AGE, MJPEG_BOUNDARY, HOME_PAGE, is_truthy
+
+WORKER_THREADS = 2
+""" The Pi only has a few cores, and we'd rather finish one frame quickly than start many at once. """
+
+FRAME_TIMEOUT = 5
+""" How long (in seconds) to wait for a new frame before giving up, like Camera.latest_frame. """
+
+LATENCY_WINDOW = 200
+""" How many recent requests (per route) to compute latency statistics over. """
+
+class SharedResults:
+	"""
+	A short-lived cache of results computed from camera frames, keyed by what was computed (ex.
+	('jpg', 90, False)). Each key only remembers the result for its most recent frame.
+	"""
+	def __init__(self, cam: Camera, executor: ThreadPoolExecutor):
+		self.cam = cam
+		self.executor = executor
+		self._results: Dict[Hashable, Tuple[float, asyncio.Future]] = {}
+		self._loop: Optional[asyncio.AbstractEventLoop] = None
+		self._frame_time = 0.0
+		self._stopped = False
+		# Replaced with a fresh one every frame, so whoever is waiting on the old one wakes up
+		self._new_frame: Optional[asyncio.Event] = None
+
+	def start(self):
+		"""
+		Start following the camera's frames. Must be called from the event loop.
+		"""
+		self._loop = asyncio.get_running_loop()
+		self._new_frame = asyncio.Event()
+		self.cam.add_frame_listener(self._on_frame_threadsafe)
+
+	def stop(self):
+		self.cam.remove_frame_listener(self._on_frame_threadsafe)
+
+	def _on_frame_threadsafe(self, frame_time: Optional[float]):
+		# Called from the camera's capture thread
+		try:
+			self._loop.call_soon_threadsafe(self._on_frame, frame_time)
+		except RuntimeError:
+			pass  # The event loop is closed, nobody's waiting anymore
+
+	def _on_frame(self, frame_time: Optional[float]):
+		if frame_time is None:
+			self._stopped = True
+		else:
+			self._frame_time = max(self._frame_time, frame_time)
+		self._new_frame.set()
+		self._new_frame = asyncio.Event()
+
+	async def frame(self, newer_than: float):
+		"""
+		Get the newest frame (and its time) once there's one newer than newer_than. Waits on the
+		event loop rather than on the thread pool, which is only used to process the frame.
+		"""
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + FRAME_TIMEOUT
+		while self._frame_time <= newer_than and not self._stopped:
+			try:
+				await asyncio.wait_for(self._new_frame.wait(), deadline - loop.time())
+			except asyncio.TimeoutError:
+				raise CameraError("Timed out waiting for a camera frame!")
+		# There's a new enough frame (or the camera stopped, and this raises), so this doesn't block
+		return await loop.run_in_executor(self.executor, lambda: self.cam.latest_frame(newer_than=newer_than))
+
+	async def get(self, key: Hashable, compute: Callable, max_age: float = DEFAULT_MAX_FRAME_AGE, newer_than: Optional[float] = None):
+		"""
+		Get compute(frame) for a frame no older than max_age seconds (or newer than newer_than, if
+		given), reusing a cached or in-progress result if there's a recent enough one. Returns the
+		result and the time its frame was captured.
+		"""
+		if newer_than is None:
+			newer_than = time() - max_age
+
+		if key in self._results:
+			frame_time, future = self._results[key]
+			if frame_time > newer_than:
+				return await asyncio.shield(future), frame_time
+
+		frame, frame_time = await self.frame(newer_than)
+
+		# Someone else may have started on this frame while we were waiting for it
+		if key in self._results and self._results[key][0] >= frame_time:
+			cached_frame_time, future = self._results[key]
+			return await asyncio.shield(future), cached_frame_time
+
+		loop = asyncio.get_running_loop()
+		future = loop.run_in_executor(self.executor, compute, frame)
+		self._results[key] = (frame_time, future)
+		try:
+			return await asyncio.shield(future), frame_time
+		except Exception:
+			# Don't cache failures
+			if self._results.get(key, (None, None))[1] is future:
+				del self._results[key]
+			raise
+
+class LatencyStats:
+	"""
+	Rolling per-route request latencies.
+	"""
+	def __init__(self):
+		self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+		self.counts: Dict[str, int] = defaultdict(int)
+
+	def record(self, route: str, seconds: float):
+		self.latencies[route].append(seconds)
+		self.counts[route] += 1
+
+	def summary(self) -> Dict[str, Dict[str, float]]:
+		summary = {}
+		for route, latencies in self.latencies.items():
+			ms = 1000 * np.array(latencies)
+			summary[route] = {
+				'count': self.counts[route],
+				'mean_ms': float(np.mean(ms)),
+				'p50_ms': float(np.percentile(ms, 50)),
+				'p95_ms': float(np.percentile(ms, 95)),
+				'max_ms': float(np.max(ms)),
+			}
+		return summary
+
+def make_app(cam: Camera, detector: Detector) -> web.Application:
+	executor = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix='camserver')
+	results = SharedResults(cam, executor)
+	latency = LatencyStats()
+	start_time = time()
+	fav_number = randint(1, 1000)
+
+	@web.middleware
+	async def measure_latency(request: web.Request, handler):
+		start = perf_counter()
+		try:
+			return await handler(request)
+		finally:
+			# Streams are open for as long as the client wants, so their latency is meaningless
+			if request.path != '/camera.mjpg':
+				route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+				latency.record(route, perf_counter() - start)
+
+	def get_max_age(request: web.Request) -> float:
+		return float(request.query.get('max_age', DEFAULT_MAX_FRAME_AGE))
+
+	def get_quality(request: web.Request) -> Optional[int]:
+		quality = request.query.get('quality')
+		return int(quality) if quality is not None else None
+
+	def get_grayscale(request: web.Request) -> bool:
+		return is_truthy(request.query.get('gray'))
+
+	async def camera(request: web.Request):
+		encoding = request.match_info['encoding']
+		if encoding not in ENCODINGS:
+			raise web.HTTPNotFound(text=f"Unknown encoding: {encoding}")
+		quality = get_quality(request)
+		grayscale = get_grayscale(request)
+		(body, headers), _ = await results.get(
+			(encoding, quality, grayscale), lambda img: encode_image(img, encoding, quality, grayscale), get_max_age(request))
+		return web.Response(body=body, headers=headers)
+
+	async def camera_stream(request: web.Request):
+		quality = get_quality(request)
+		grayscale = get_grayscale(request)
+		response = web.StreamResponse(headers={
+			'Content-Type': f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}'
+		})
+		await response.prepare(request)
+
+		# Start from a recent frame, not whatever was last encoded for someone else however long ago
+		last_frame_time = time() - get_max_age(request)
+		while True:
+			# Always ask for the newest frame after the last one we sent. If this client is slow, the
+			# frames it missed are skipped rather than queued up.
+			(body, _), last_frame_time = await results.get(
+				('jpg', quality, grayscale), lambda img: encode_image(img, 'jpg', quality, grayscale), newer_than=last_frame_time)
+			await response.write(b''.join([
+				b'--' + MJPEG_BOUNDARY.encode() + b'\r\n',
+				b'Content-Type: image/jpeg\r\n',
+				b'Content-Length: ' + str(len(body)).encode() + b'\r\n',
+				b'X-Frame-Time: ' + str(last_frame_time).encode() + b'\r\n\r\n',
+				body,
+				b'\r\n'
+			]))
+
+	# The detector remembers things between frames (ex. the board geometry), so two worker threads
+	# can't use it at once (ex. on two different frames)
+	detector_lock = Lock()
+
+	def detect(img):
+		start = perf_counter()
+		with detector_lock:
+			summary = detector.detect_summary(img)
+		summary['detect_time'] = perf_counter() - start
+		return summary
+
+	async def detections(request: web.Request):
+		summary, frame_time = await results.get('detections', detect, get_max_age(request))
+		return web.json_response({ **summary, 'frame_time': frame_time }, status=200 if summary['ok'] else 422)
+
+	async def info(request: web.Request):
+		return web.json_response({
+			'ok': True,
+			'name': 'grandmaster:camserver',
+			'mode': 'async',
+			'uptime': time() - start_time,
+			'favorite_number': fav_number,
+			'latency': latency.summary(),
+		})
+
+	async def home(request: web.Request):
+		return web.Response(text=HOME_PAGE, content_type='text/html')
+
+	async def start_results(app: web.Application):
+		results.start()
+
+	async def stop_results(app: web.Application):
+		results.stop()
+
+	app = web.Application(middlewares=[measure_latency])
+	app.on_startup.append(start_results)
+	app.on_cleanup.append(stop_results)
+	app.add_routes([
+		web.get('/camera.mjpg', camera_stream),
+		web.get('/camera.{encoding}', camera),
+		web.get('/detections.json', detections),
+		web.get('/info.json', info),
+		web.get('/', home),
+	])
+	return app
+
+if __name__ == '__main__':
+	detector = Detector()
+	detector.quality_gate = FrameQualityGate()
+	web.run_app(make_app(Camera(continuous=True, grayscale='--gray' in argv), detector), host='0.0.0.0', port=5555)
@@ -17,6 +17,10 @@ from sys import exit
 import chess
 from threading import Thread, Lock
 from game_controller import GameController, State
+from camclient import MJPEGStream
+from recording import RecordingWriter, ReplaySource
+from engine import RandomEngine, SearchEngine
+from parallel_search import ParallelSearchEngine
 from arduino_manager import Button, LEDPallete
 from helpers import print_to_dashboard as print, show_image
 
@@ -64,6 +68,7 @@ class DashboardDelegate:
 		Execute a command given through the dashboard. This method receives the raw text of the command.
 		"""
 		cmd, *args = command.strip().lower().split(' ')
+		_, *raw_args = command.strip().split(' ')  # For case-sensitive arguments, like paths
 
 		if cmd == 'move':  # Move the gantry to a square
 			square = chess.parse_square(args[0])
@@ -84,6 +89,45 @@ class DashboardDelegate:
 			self.game.arduino.set_led_pallete(pallete)
 		elif cmd == 'autoplay':  # (De-)activate autoplay mode
 			self.game.set_autoplay(args[0] == 'on')
+		elif cmd == 'stream':  # Subscribe to (or unsubscribe from) the Vision Service's MJPEG stream
+			if self.game.image_stream is not None:
+				self.game.image_stream.close()
+				self.game.image_stream = None
+			if args[0] == 'on':
+				self.game.image_stream = MJPEGStream(quality=int(args[1]) if len(args) > 1 else None, grayscale=self.game.grayscale)
+			print('Streaming images:', 'ON' if self.game.image_stream is not None else 'OFF')
+		elif cmd == 'remote':  # Have the Vision Service detect the board itself (or not)
+			self.game.remote_detection = args[0] == 'on'
+			print('Remote detection:', 'ON' if self.game.remote_detection else 'OFF')
+		elif cmd == 'record':  # Record every frame we detect a board from into a directory (or stop)
+			if self.game.recorder is not None:
+				self.game.recorder.close()
+				self.game.recorder = None
+			if args[0] != 'off':
+				self.game.recorder = RecordingWriter(raw_args[0])
+			print('Recording:', self.game.recorder.path if self.game.recorder is not None else 'OFF')
+		elif cmd == 'replay':  # Take images from a recording instead of the camera (or stop)
+			self.game.replay = ReplaySource(raw_args[0], loop=True) if args[0] != 'off' else None
+			print('Replaying:', self.game.replay.recording.path if self.game.replay is not None else 'OFF')
+		elif cmd == 'engine':  # Switch engines (random, search or parallel), and optionally set the think time in seconds
+			engines = { 'random': RandomEngine, 'search': SearchEngine, 'parallel': ParallelSearchEngine }
+			if args[0] not in engines:
+				print(f"Unknown Engine: '{args[0]}' (try {', '.join(engines)})")
+				return
+			if isinstance(self.game.engine, ParallelSearchEngine):
+				self.game.engine.close()
+			self.game.engine = engines[args[0]]()
+			if len(args) > 1:
+				self.game.think_time = float(args[1])
+			print('Engine:', type(self.game.engine).__name__, f'({self.game.think_time}s)')
+		elif cmd == 'ponder':  # Think on the human's time (or not)
+			self.game.ponder = args[0] == 'on'
+			if not self.game.ponder:
+				self.game.ponderer.stop()
+			print('Pondering:', 'ON' if self.game.ponder else 'OFF')
+		elif cmd == 'preposition':  # Move the gantry towards the likely move while the engine thinks (or not)
+			self.game.preposition = args[0] == 'on'
+			print('Prepositioning:', 'ON' if self.game.preposition else 'OFF')
 		elif cmd == 'camshow':  # Show what the camera currently sees, with annotations from the CV pipeline
 			print("Fetching image...")
 			try:
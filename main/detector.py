@@ -2,12 +2,23 @@ from subprocess import call
 from typing import *
 from helpers import print_to_dashboard as print, show_image
 from enum import IntEnum
+from collections import deque, defaultdict
+from itertools import islice
+from time import monotonic
+from multiprocessing import Pool, cpu_count, shared_memory, resource_tracker
 import cv2
 import chess
 import numpy as np
-from math import sqrt
-from helpers import distance
-from apriltag import detect_apriltags, apriltag
+from apriltag import detect_apriltags, apriltag, DetectorOptions, DEFAULT_DETECTOR_OPTIONS, with_undistorted_points, with_translated_points, detection_to_json
+from camera_calibration import CameraCalibration
+from board_geometry import BoardGeometry, SQUARE_NAMES
+from frame_quality import FrameQualityGate, FrameQuality
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    has_scipy = True
+except ImportError:
+    has_scipy = False
 
 # Chess notation doesn't differentiate between identical pieces
 # (ex. two black rooks) because it doesn't matter for the game,
@@ -59,6 +70,18 @@ Piece.symbol = property(lambda self: symbols_for_piece[self])
 # All pieces (and only pieces) have Apriltag IDs >= 100
 MIN_PIECE_TAG_ID = 100
 
+class BoardNotFoundError(ValueError):
+    """
+    Raised when the board corner tags can't be found in an image (ex. because of a hand in the way).
+    """
+    pass
+
+class PoorFrameError(BoardNotFoundError):
+    """
+    Raised when a frame is rejected by the Detector's quality gate before even looking for the board.
+    """
+    pass
+
 class Detector:
     """
     This class is responsible for the computer vision pipeline which identifies the location of each
@@ -67,11 +90,95 @@ class Detector:
     piece_apriltag_family = 'tag36h11'
     corner_apriltag_family = 'tag36h11'
 
+    # Detectors are cached process-wide (see apriltag.get_detector), so changing this just selects a
+    # different cached detector rather than paying to create one on every frame.
+    apriltag_options: DetectorOptions = DEFAULT_DETECTOR_OPTIONS
+
     CORNER_I0_TAG_ID = 2  # bottom right
     CORNER_a0_TAG_ID = 3  # bottom left
     CORNER_a9_TAG_ID = 0  # top left
     CORNER_I9_TAG_ID = 1  # top right
 
+    calibration: Optional[CameraCalibration] = None
+    """
+    If set, images are assumed to still be distorted (ie. from a Camera in UndistortMode.POINTS), and
+    the locations of detected tags are undistorted using this calibration instead.
+    """
+
+    geometry: Optional[BoardGeometry] = None
+    """ The most recently fitted board geometry, reused until the corner tags move. """
+
+    geometry_tolerance_px: float = 3.0
+    """ How far (in pixels) a corner tag can move before the board geometry is re-fitted. """
+
+    trust_cached_geometry: bool = False
+    """
+    If the corner tags can't be found (ex. someone's hand is covering one), assume the board hasn't
+    moved and keep using the cached geometry instead of failing, as long as the corner tags were
+    last seen less than cached_geometry_max_age seconds ago.
+    """
+
+    cached_geometry_max_age: float = 10.0
+    """ How long (in seconds) after the corner tags were last seen trust_cached_geometry still applies. """
+
+    quality_gate: Optional[FrameQualityGate] = None
+    """
+    If set, frames are checked with this first, and blurry, badly exposed or moving ones are
+    rejected (with a PoorFrameError) without running the Apriltag detector on them.
+    """
+
+    coarse_to_fine: bool = False
+    """
+    Find the tags on a downscaled copy of the image first (see coarse_scale), then refine just those
+    at full resolution, each in a small window around it (see coarse_roi_margin). Pieces are only
+    looked for inside the board. Much faster on high-resolution cameras, as long as the piece tags
+    are still big enough to be found in the downscaled image. Ignored if there's a calibration,
+    like incremental.
+    """
+
+    coarse_scale: float = 0.5
+    """ How much the image is downscaled by to find the tags in coarse_to_fine mode. """
+
+    coarse_roi_margin: float = 0.2
+    """
+    How much (as a fraction of the tag's size) the window a tag is refined in extends past it on
+    each side, to allow for the coarse detection being off by a few pixels.
+    """
+
+    coarse_apriltag_options: DetectorOptions = DetectorOptions(quad_decimate=4.0)
+    """
+    Detector options for the corner tags in the downscaled image. The corner tags are big, so they
+    survive heavier decimation than apriltag_options'. (The pieces are still found with
+    apriltag_options.)
+    """
+
+    incremental: bool = False
+    """
+    Only re-scan the squares that changed since the previous frame, and reuse the previous
+    detections everywhere else (see detect_tags). Much faster on a mostly static board. Ignored if
+    there's a calibration, since the board geometry is then in different coordinates than the image.
+    """
+
+    incremental_threshold: float = 6.0
+    """ Mean absolute difference (out of 255) over a square above which it counts as changed. """
+
+    incremental_max_squares: int = 16
+    """ If more squares than this changed (ex. a hand is over the board), just scan the whole frame. """
+
+    incremental_full_scan_interval: int = 30
+    """ Scan the whole frame at least this often (in frames) anyway, in case something was missed. """
+
+    last_scanned_squares: Optional[List[str]] = None
+    """ The squares the most recent incremental scan looked at, or None if it scanned the whole frame. """
+
+    _geometry_time: float = 0.0
+    _reference: Optional[np.ndarray] = None
+    _reference_tags: Dict[int, apriltag.Detection]
+    _frames_since_full_scan: int = 0
+
+    def __init__(self):
+        self._reference_tags = {}
+
     def detect_board(self, img, turn=chess.BLACK, show=False):
         """
         Generate a Python Chess Board object from an image. Simple wrapper around detect_piece_positions
@@ -81,6 +188,113 @@ class Detector:
         board = self.generate_board(positions, turn=turn)
         return board
 
+    def detect_boards(self, images: Iterable, turn=chess.BLACK, processes: Optional[int] = None) -> Iterator[Optional[chess.Board]]:
+        """
+        Detect the board in many images in parallel (see detect_summaries). Yields a board for each
+        image, in order, or None if the board couldn't be found in that image.
+        """
+        for summary in self.detect_summaries(images, processes):
+            if not summary['ok']:
+                yield None
+                continue
+            positions = [(piece['square'], piece['tag_id']) for piece in summary['pieces']]
+            yield self.generate_board(positions, turn=turn)
+
+    def detect_summaries(self, images: Iterable, processes: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Run detect_summary on many images in parallel, yielding the results in the same order as the
+        images as soon as each one (and everything before it) is done.
+
+        Images are handed to a pool of worker processes through shared memory rather than being
+        pickled. The pool is kept around between calls (until close_pool), and each worker has its
+        own copy of this Detector, so workers stay warm: their Apriltag detectors and calibration
+        are only set up once.
+
+        Since any worker can get any image, each one is detected from scratch, as if by a Detector
+        that was just reset (see reset): nothing carries over from frame to frame (no cached
+        geometry, no incremental scanning and no motion check in the quality gate). The results
+        are the same no matter how many processes there are.
+        """
+        pool = self._get_pool(processes)
+        images = iter(images)
+        # Only a few images are in shared memory at a time, so this works on arbitrarily long inputs
+        max_in_flight = 2 * self._pool_processes
+        in_flight: Deque[Tuple[Any, shared_memory.SharedMemory]] = deque()
+
+        def submit(img):
+            img = np.ascontiguousarray(img)
+            shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+            np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[...] = img
+            result = pool.apply_async(_detect_summary_in_worker, (shm.name, img.shape, img.dtype.str))
+            in_flight.append((result, shm))
+
+        try:
+            for img in islice(images, max_in_flight):
+                submit(img)
+
+            while len(in_flight) > 0:
+                result, shm = in_flight.popleft()
+                try:
+                    summary = result.get()
+                finally:
+                    shm.close()
+                    shm.unlink()
+
+                for img in islice(images, 1):
+                    submit(img)
+
+                yield summary
+        finally:
+            # If we're abandoned partway through, don't leak shared memory
+            for _, shm in in_flight:
+                shm.close()
+                shm.unlink()
+
+    def reset(self):
+        """
+        Forget everything remembered from previous frames: the cached board geometry, the reference
+        frame for incremental scanning and the quality gate's previous frame.
+        """
+        self.geometry = None
+        self._reference = None
+        self._reference_tags = {}
+        self._frames_since_full_scan = 0
+        self.last_scanned_squares = None
+        if self.quality_gate is not None:
+            self.quality_gate.reset()
+
+    def close_pool(self):
+        """
+        Shut down the worker processes used by detect_boards and detect_summaries (if any).
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    _pool: Optional[Pool] = None
+    _pool_processes: int = 0
+
+    def _get_pool(self, processes: Optional[int] = None) -> Pool:
+        processes = processes or self._pool_processes or cpu_count()
+        if self._pool is not None and processes != self._pool_processes:
+            self.close_pool()
+        if self._pool is None:
+            self._pool = Pool(processes, initializer=_init_worker, initargs=(self,))
+            self._pool_processes = processes
+        return self._pool
+
+    def __getstate__(self):
+        # Pools can't be pickled (and workers shouldn't have their own anyway)
+        state = self.__dict__.copy()
+        state.pop('_pool', None)
+        state.pop('_pool_processes', None)
+        # Workers detect every frame from scratch anyway (see detect_summaries)
+        state.pop('_reference', None)
+        state['_reference_tags'] = {}
+        state.pop('geometry', None)
+        return state
+
     def generate_board(self, positions: List[Tuple[str, int]], turn=chess.BLACK):
         """
         Generate a Python Chess Board object from a list of piece positions.
@@ -101,21 +315,23 @@ class Detector:
 
         If show is True, the image will be (destructively) annotated to indicate the detected
         locations of each Apriltag (board or piece) and the calculated position of each square. It
-        will then be shown to the user (using helpers.show_image).
+        will then be shown to the user (using helpers.show_image). If the image is still distorted
+        (see Detector.calibration), the annotations will be slightly off near the edges.
         """
-        # Apriltags can only be detected on grayscale images
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        tags = detect_apriltags(self.corner_apriltag_family, gray)
-        squares = self.calculate_square_locations(tags)
-        # These are the four squares around the center of the chessboard
-        board_center = np.mean([squares['d4'], squares['d5'], squares['e4'], squares['e5']], axis=0)
+        self.check_frame_quality(img)
+        tags = self.detect_tags(img)
+        geometry = self.locate_board(tags)
 
         if show is not False:
+            # Annotations are in color, so we need a color image even if we were given a grayscale one
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            elif not img.flags.writeable:
+                img = img.copy()  # ex. a frame from a memory-mapped recording
+
             # Very hack-y code to annotate the image with helpful information
-            bottom_right_I0 = tags[self.CORNER_I0_TAG_ID].center
-            bottom_left_a0 = tags[self.CORNER_a0_TAG_ID].center
-            top_left_a9 = tags[self.CORNER_a9_TAG_ID].center
-            top_right_I9 = tags[self.CORNER_I9_TAG_ID].center
+            bottom_left_a0, bottom_right_I0, top_right_I9, top_left_a9 = geometry.corners
+            board_center = geometry.center
 
             for tag in [bottom_left_a0, bottom_right_I0, top_left_a9, top_right_I9, board_center]:
                 x = round(tag[0])
@@ -133,7 +349,7 @@ class Detector:
                 y = round(tag.center[1])
                 img[y-10:y+11, x-10:x+11, :] = [0, 255, 0]
 
-            for pos in squares.values():
+            for pos in geometry.square_centers:
                 x = round(pos[0])
                 y = round(pos[1])
                 img[y-10:y+11, x-10:x+11, :] = [255, 0, 0]
@@ -142,23 +358,202 @@ class Detector:
                 show = show_image
             show(img, 'Analyzed Board:')
 
-        # We process piece tags in descending order of distance from the center. This is because our
-        # camera has a fisheye lens, and so pieces (especially tall pieces) that are near the edge
-        # of the board (ie. a king on a1) might appear farther from the center than they actually are.
-        # However, they can't be closer to a different square, so as long as we process them first
-        # they'll get assigned to the right square. Then if a piece next to them has the same issue,
-        # it will get assigned to the best remaining square which will also be correct.
-        for tag in sorted(
-            (tag for tag_id, tag in tags.items() if tag_id >= MIN_PIECE_TAG_ID),
-            key=lambda tag: distance(board_center, tag.center),
-            reverse=True):
-            def _key(item):
-                _, pos = item
-                x, y = pos
-                return sqrt(((x - tag.center[0]) ** 2) + ((y - tag.center[1]) ** 2))
-            square = sorted(squares.items(), key=_key)[0][0]
-            del squares[square]
-            yield square, tag.tag_id
+        for square, tag_id, _ in self.assign_squares(tags, geometry):
+            yield square, tag_id
+
+    def check_frame_quality(self, img) -> Optional[FrameQuality]:
+        """
+        Run the quality gate (if there is one) on a frame, raising a PoorFrameError if it's rejected.
+        """
+        if self.quality_gate is None:
+            return None
+        quality = self.quality_gate.check(img)
+        if not quality.ok:
+            raise PoorFrameError(quality.problem)
+        return quality
+
+    def detect_tags(self, img) -> Dict[int, Optional[apriltag.Detection]]:
+        """
+        Find every Apriltag (board corners and pieces) in an image. Tag locations are undistorted if
+        the Detector has a calibration.
+
+        In incremental mode, the image is compared to the previous one square by square (by mean
+        absolute difference), and only the squares that changed are scanned again. The whole frame
+        is still scanned if a corner tag's square changed (the board may have moved), if too many
+        squares changed, or every incremental_full_scan_interval frames.
+
+        In coarse_to_fine mode, whole frames are scanned as described there instead.
+        """
+        # Apriltags can only be detected on grayscale images
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        if self.calibration is None:
+            if self.incremental:
+                return self._detect_tags_incrementally(gray)
+            if self.coarse_to_fine:
+                return self._detect_tags_coarse_to_fine(gray)
+        tags = detect_apriltags(self.corner_apriltag_family, gray, self.apriltag_options)
+        if self.calibration is not None:
+            for tag_id, tag in tags.items():
+                tags[tag_id] = with_undistorted_points(tag, self.calibration.undistort_points)
+        return tags
+
+    def _detect_tags_incrementally(self, gray) -> Dict[int, Optional[apriltag.Detection]]:
+        geometry = self.geometry
+        if self._reference is None or self._reference.shape != gray.shape or geometry is None \
+                or self._frames_since_full_scan >= self.incremental_full_scan_interval:
+            return self._scan_full_frame(gray)
+
+        # Sum the difference over every square with an integral image, so each one costs four lookups
+        height, width = gray.shape
+        diff = cv2.integral(cv2.absdiff(gray, self._reference))
+
+        def clip(bounds: np.array) -> np.array:
+            return np.clip(bounds, 0, [width, height, width, height])
+
+        def mean_differences(bounds: np.array) -> np.array:
+            x0, y0, x1, y1 = clip(bounds).T
+            sums = diff[y1, x1] - diff[y0, x1] - diff[y1, x0] + diff[y0, x0]
+            return sums / np.maximum((x1 - x0) * (y1 - y0), 1)
+
+        if np.any(mean_differences(geometry.corner_bounds()) > self.incremental_threshold):
+            return self._scan_full_frame(gray)
+
+        square_bounds = geometry.square_bounds()
+        changed = np.flatnonzero(mean_differences(square_bounds) > self.incremental_threshold)
+        if len(changed) > self.incremental_max_squares:
+            return self._scan_full_frame(gray)
+
+        self._frames_since_full_scan += 1
+        self.last_scanned_squares = [SQUARE_NAMES[i] for i in changed]
+
+        # Forget whatever used to be in the changed squares...
+        x0, y0, x1, y1 = square_bounds[changed].T
+        tags = {}
+        for tag_id, tag in self._reference_tags.items():
+            x, y = tag.center
+            if tag_id < MIN_PIECE_TAG_ID or not np.any((x0 <= x) & (x < x1) & (y0 <= y) & (y < y1)):
+                tags[tag_id] = tag
+
+        # ...and look at them again, with some margin so off-center tags are still entirely in view
+        for x0, y0, x1, y1 in clip(geometry.square_bounds(margin=0.5)[changed]):
+            patch = gray[y0:y1, x0:x1]
+            for tag_id, tag in detect_apriltags(self.piece_apriltag_family, patch, self.apriltag_options).items():
+                if tag is not None:
+                    tags[tag_id] = with_translated_points(tag, (x0, y0))
+            self._reference[y0:y1, x0:x1] = patch
+
+        self._reference_tags = tags
+        return defaultdict(lambda: None, tags)
+
+    def _scan_full_frame(self, gray) -> Dict[int, Optional[apriltag.Detection]]:
+        if self.coarse_to_fine:
+            tags = self._detect_tags_coarse_to_fine(gray)
+        else:
+            tags = detect_apriltags(self.corner_apriltag_family, gray, self.apriltag_options)
+        self._reference = gray.copy()
+        self._reference_tags = {tag_id: tag for tag_id, tag in tags.items() if tag is not None}
+        self._frames_since_full_scan = 0
+        self.last_scanned_squares = None
+        return tags
+
+    def _detect_tags_coarse_to_fine(self, gray) -> Dict[int, Optional[apriltag.Detection]]:
+        height, width = gray.shape
+        scale = self.coarse_scale
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        coarse = detect_apriltags(self.corner_apriltag_family, small, self.coarse_apriltag_options)
+        coarse_corners = [coarse.get(tag_id) for tag_id in self.corner_tag_ids]
+        if any(tag is None for tag in coarse_corners):
+            # Without the board's outline there's nothing to narrow the search down to
+            return detect_apriltags(self.corner_apriltag_family, gray, self.apriltag_options)
+
+        def clip(x0, y0, x1, y1) -> Tuple[int, int, int, int]:
+            return max(int(x0), 0), max(int(y0), 0), min(int(np.ceil(x1)), width), min(int(np.ceil(y1)), height)
+
+        def refine(tag: apriltag.Detection, family: str, options: DetectorOptions) -> apriltag.Detection:
+            # Look for the tag again at full resolution, in a window just around it
+            corners = np.asarray(tag.corners, dtype=np.float64) / scale
+            margin = self.coarse_roi_margin * np.max(corners.max(axis=0) - corners.min(axis=0))
+            x0, y0, x1, y1 = clip(*(corners.min(axis=0) - margin), *(corners.max(axis=0) + margin))
+            refined = detect_apriltags(family, gray[y0:y1, x0:x1], options).get(tag.tag_id)
+            if refined is None:
+                # Better a slightly less precise location than none at all
+                return with_undistorted_points(tag, lambda points: np.asarray(points) / scale)
+            return with_translated_points(refined, (x0, y0))
+
+        tags = {tag.tag_id: refine(tag, self.corner_apriltag_family, self.apriltag_options) for tag in coarse_corners}
+
+        # Pieces can only be on the board, so only that part of the downscaled image is searched. They're
+        # smaller than the corner tags, so they get the full-resolution options.
+        geometry = BoardGeometry([tags[tag_id].center for tag_id in self.corner_tag_ids])
+        bounds = geometry.square_bounds(margin=0.5)
+        x0, y0, x1, y1 = clip(*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0))
+        x0, y0, x1, y1 = int(x0 * scale), int(y0 * scale), int(np.ceil(x1 * scale)), int(np.ceil(y1 * scale))
+        for tag_id, tag in detect_apriltags(self.piece_apriltag_family, small[y0:y1, x0:x1], self.apriltag_options).items():
+            if tag is None or tag_id < MIN_PIECE_TAG_ID:
+                continue
+            tags[tag_id] = refine(with_translated_points(tag, (x0, y0)), self.piece_apriltag_family, self.apriltag_options)
+
+        return defaultdict(lambda: None, tags)
+
+    def detect_summary(self, img) -> Dict[str, Any]:
+        """
+        Run the pipeline and summarize the results as a JSON-serializable dict (used by the Vision
+        Service to send detections instead of images).
+
+        Includes every tag that was seen (with its corners and decision margin), the location of each
+        square and which square each piece was assigned to. If the board couldn't be found, 'ok' is
+        false, 'error' says why and 'squares' and 'pieces' are None, but 'tags' is still filled in
+        (unless the frame was rejected by the quality gate, in which case it's empty).
+        """
+        summary = {
+            'ok': True,
+            'error': None,
+            'tags': [],
+            'squares': None,
+            'pieces': None,
+        }
+        try:
+            self.check_frame_quality(img)
+        except PoorFrameError as err:
+            summary['ok'] = False
+            summary['error'] = str(err)
+            return summary
+
+        tags = self.detect_tags(img)
+        summary['tags'] = [detection_to_json(tag) for tag in tags.values() if tag is not None]
+        try:
+            geometry = self.locate_board(tags)
+        except BoardNotFoundError as err:
+            summary['ok'] = False
+            summary['error'] = str(err)
+            return summary
+
+        summary['squares'] = {name: [float(x), float(y)] for name, (x, y) in geometry.squares.items()}
+        summary['pieces'] = [
+            { 'square': square, 'tag_id': tag_id, 'residual': residual }
+            for square, tag_id, residual in self.assign_squares(tags, geometry)
+        ]
+        return summary
+
+    def assign_squares(self, tags: Dict[int, Optional[apriltag.Detection]], geometry: BoardGeometry) -> List[Tuple[str, int, float]]:
+        """
+        Match every piece tag to a square, all at once.
+
+        Returns a list of (square name, tag ID, residual) tuples, where residual is the distance (in
+        pixels) between the tag and the center of the square it was assigned to. Large residuals
+        usually mean a misread.
+        """
+        piece_tags = [tag for tag_id, tag in tags.items() if tag is not None and tag_id >= MIN_PIECE_TAG_ID]
+        if len(piece_tags) == 0:
+            return []
+
+        tag_centers = np.array([tag.center for tag in piece_tags], dtype=np.float64)
+        square_idxs, residuals = assign_pieces_to_squares(tag_centers, geometry.square_centers)
+
+        return [
+            (SQUARE_NAMES[square_idx], tag.tag_id, float(residual))
+            for tag, square_idx, residual in zip(piece_tags, square_idxs, residuals)
+        ]
 
     def calculate_square_locations(self, tags: Dict[int, Optional[apriltag.Detection]]) -> Dict[str, np.array]:
         """
@@ -167,62 +562,160 @@ class Detector:
 
         Returns a mapping of square names (ex. 'c3') to center locations (in pixels).
         """
-        # Board corner tracking tags are centered in (imaginary) squares one rank and one form off
-        # the edge of the board (α0, I0, α9, I9). This leaves them 9 square widths apart on each axis.
-        # Conventionally, chess boards are drawn with white (Rank 1) at the bottom.
-        try:
-            bottom_right_I0 = np.array(tags[self.CORNER_I0_TAG_ID].center)
-            bottom_left_a0  = np.array(tags[self.CORNER_a0_TAG_ID].center)
-            top_left_a9     = np.array(tags[self.CORNER_a9_TAG_ID].center)
-            top_right_I9    = np.array(tags[self.CORNER_I9_TAG_ID].center)
-        except:
-            raise ValueError("Couldn't find board corners!")
-
-        # This algorithm isn't precisely methodologically sound, but it's a good heuristic and close
-        # enough for our purposes. It's complicated by the fact that the camera won't be perfectly
-        # aligned with the board (both in the sense that the plane of the camera won't be parallel
-        # to the plane of the board, and that the y-axis of the camera won't be parallel to the
-        # y-axis of the board).
-        #
-        # Essentially, we calculate distance (along both the x- and y-axis) between each pair of
-        # corner tags (ie. left edge, top edge, right edge, bottom edge). Taking the left edge as an
-        # example, we take the difference between the bottom left and top right corner square, and
-        # assume that the squares of the A-file (various ranks) are evenly spaced throughout that range.
-        # 
-        # That would handle the y-axis of the camera not being aligned with the y-axis of the board,
-        # but doesn't address the misaligned planes. To account for that we also calculate the
-        # difference between the top _right_ and bottom _right_ corners. If the planes of the camera
-        # and board were perfectly parallel, the left edge and the right edge would be the same.
-        # Instead, we assume the difference between the two is linearly distributed across the image.
-        # (So if the left edge is fewer pixels long than the right edge, the ranks of the A-file are
-        # slightly closer together than the ranks of the B-file, and so on.) We do the samething for
-        # each rank.
-        #
-        # Except, we don't: in some practical testing, the best result was given by only doing the
-        # second-order correction for ranks (the amount that the distance between each rank changes
-        # with each file) and not for files, so we do that. Again, this is a theoretically-wrong
-        # heuristic that works pretty well in practice.
-        
-        origin = bottom_left_a0 # a0 is the origin
+        return self.locate_board(tags).squares
 
-        d_rank_a = (top_left_a9 - bottom_left_a0) / 9
-        d_rank_I = (top_right_I9 - bottom_right_I0) / 9
+    def locate_board(self, tags: Dict[int, Optional[apriltag.Detection]]) -> BoardGeometry:
+        """
+        Find the board in the image from the corner Apriltags.
 
-        d_file_0 = (bottom_right_I0 - bottom_left_a0) / 9
-        d_file_9 = (top_right_I9 - top_left_a9) / 9
+        The previous frame's geometry is reused as long as none of the corner tags have moved more
+        than geometry_tolerance_px. If the corner tags are missing, the cached geometry is used if
+        trust_cached_geometry is set (and it isn't too old), otherwise this raises a
+        BoardNotFoundError.
+        """
+        corner_tags = [tags.get(tag_id) for tag_id in self.corner_tag_ids]
 
-        d_rank_d_file = (d_rank_I - d_rank_a) / 9 # for every file, d_rank changes by this
-        d_file_d_rank = (d_file_9 - d_file_0) / 9 # for every rank, d_file changes by this
+        if any(tag is None for tag in corner_tags):
+            if self.trust_cached_geometry and self.geometry is not None:
+                age = monotonic() - self._geometry_time
+                if age <= self.cached_geometry_max_age:
+                    print(f"Couldn't find board corners, using the board geometry from {age:.1f}s ago")
+                    return self.geometry
+            raise BoardNotFoundError("Couldn't find board corners!")
 
-        squares = {}
+        corners = np.array([tag.center for tag in corner_tags])
 
-        for rank_i, rank in enumerate(chess.RANK_NAMES, start=1):
-            for file_i, file in enumerate(chess.FILE_NAMES, start=1):
-                # Solution: methodologically wrong, good enough
-                pos = origin + \
-                    rank_i * (d_rank_a + (1 * d_rank_d_file * file_i)) + \
-                    file_i * (d_file_0 + (0 * d_file_d_rank * rank_i))
+        if self.geometry is None or self.geometry.max_corner_shift(corners) > self.geometry_tolerance_px:
+            self.geometry = BoardGeometry(corners)
+        self._geometry_time = monotonic()
 
-                squares[file + rank] = pos
-        
-        return squares
+        return self.geometry
+
+    @property
+    def corner_tag_ids(self) -> Tuple[int, int, int, int]:
+        """ Corner tag IDs in the order BoardGeometry expects them (a0, I0, I9, a9). """
+        return (self.CORNER_a0_TAG_ID, self.CORNER_I0_TAG_ID, self.CORNER_I9_TAG_ID, self.CORNER_a9_TAG_ID)
+
+def assign_pieces_to_squares(tag_centers: np.array, square_centers: np.array) -> Tuple[np.array, np.array]:
+    """
+    Optimally assign each piece (an (N, 2) array of tag centers) to a distinct square (an (M, 2) array
+    of square centers, M >= N), minimizing the total squared distance.
+
+    Returns the index of the square assigned to each piece, and the residual distance of each piece
+    from its square.
+
+    Our camera has a fisheye lens, so pieces (especially tall pieces) near the edge of the board (ie.
+    a king on a1) appear farther from the center than they actually are, which can put them closer
+    to a neighbouring square than their own. We used to work around that by greedily assigning
+    pieces in descending order of distance from the center. Solving the assignment globally handles
+    the same case without depending on processing order: two pieces can't share a square, and since
+    the cost is squared distance the badly displaced piece gets priority on its nearest square, just
+    like the old heuristic.
+    """
+    # (N, M) matrix of squared distances
+    deltas = tag_centers[:, np.newaxis, :] - square_centers[np.newaxis, :, :]
+    cost = np.einsum('ijk,ijk->ij', deltas, deltas)
+
+    # Fast path: if every piece's nearest square is distinct, that's trivially the optimal assignment.
+    # This is by far the most common case.
+    nearest = np.argmin(cost, axis=1)
+    if len(np.unique(nearest)) == len(nearest):
+        square_idxs = nearest
+    elif has_scipy:
+        _, square_idxs = linear_sum_assignment(cost)
+    else:
+        square_idxs = _hungarian(cost)
+
+    residuals = np.sqrt(cost[np.arange(len(square_idxs)), square_idxs])
+    return square_idxs, residuals
+
+def _hungarian(cost: np.array) -> np.array:
+    """
+    Minimal-cost assignment of rows to distinct columns of an (N, M) cost matrix (N <= M). Returns
+    the column assigned to each row.
+
+    This is the classic O(N^2 M) shortest augmenting path formulation of the Hungarian algorithm,
+    with the inner loop over columns vectorized. Only used if SciPy isn't available.
+    """
+    n, m = cost.shape
+    # Potentials and matchings are one-indexed, with column 0 as a sentinel
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_for_col = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+
+    for row in range(1, n + 1):
+        row_for_col[0] = row
+        col0 = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+
+        while True:
+            used[col0] = True
+            row0 = row_for_col[col0]
+            free = ~used[1:]
+
+            slack = cost[row0 - 1] - u[row0] - v[1:]
+            improved = free & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            way[1:][improved] = col0
+
+            candidates = np.where(free, min_slack[1:], np.inf)
+            col1 = int(np.argmin(candidates)) + 1
+            delta = candidates[col1 - 1]
+
+            u[row_for_col[used]] += delta
+            v[used] -= delta
+            min_slack[~used] -= delta
+
+            col0 = col1
+            if row_for_col[col0] == 0:
+                break
+
+        # Walk back along the augmenting path
+        while col0 != 0:
+            col1 = way[col0]
+            row_for_col[col0] = row_for_col[col1]
+            col0 = col1
+
+    assignment = np.zeros(n, dtype=int)
+    for col in range(1, m + 1):
+        if row_for_col[col] != 0:
+            assignment[row_for_col[col] - 1] = col - 1
+    return assignment
+
+
+# Each worker process's copy of the Detector (see Detector.detect_summaries)
+_worker_detector: Optional[Detector] = None
+
+def _init_worker(detector: Detector):
+    global _worker_detector
+    _worker_detector = detector
+    _worker_detector.reset()
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    # The parent owns (and unlinks) the memory. Before Python 3.13, merely attaching to it registers
+    # it with the resource tracker, which then complains about (and tries to unlink) it when the
+    # worker exits. Unregistering it again doesn't work either: forked workers share the parent's
+    # tracker, so that would forget the parent's own registration. So don't register it at all.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _detect_summary_in_worker(shm_name: str, shape: Tuple[int, ...], dtype: str) -> Dict[str, Any]:
+    shm = _attach_shared_memory(shm_name)
+    try:
+        img = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        # Whichever frame this worker saw last has nothing to do with this one
+        _worker_detector.reset()
+        summary = _worker_detector.detect_summary(img)
+        del img  # Release our view of the buffer so it can be closed
+        return summary
+    finally:
+        shm.close()
@@ -0,0 +1,570 @@
+"""
+Chess engines, which is to say, how GameController.pick_move decides what to play.
+
+Engine is the interface: given a board, a time budget and (optionally) a filter for which moves it's
+allowed to make, return a move. SearchEngine is the real one, a classic iterative-deepening
+alpha-beta search on top of python-chess' Board:
+
+- A transposition table keyed by (polyglot-compatible) Zobrist hashes, updated incrementally as
+  moves are made rather than recomputed for every position.
+- Move ordering: the transposition table's move first, then captures (most valuable victim, least
+  valuable attacker), promotions, killer moves and finally the history heuristic.
+- Quiescence search, so it doesn't stop halfway through an exchange of pieces.
+- A hard time budget. The gantry (and the human) are waiting, so it always returns the best move
+  found so far at the deadline rather than finishing what it was doing.
+
+RandomEngine is Grandmaster's original, novel and unconventional chess algorithm, kept for testing.
+"""
+from typing import *
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from time import perf_counter
+from random import choice
+import chess
+import chess.polyglot
+
+MoveFilter = Callable[[chess.Board, chess.Move], bool]
+"""
+Decides whether the engine may make a move (ex. whether the gantry can physically make it). Only
+applies to the move being picked, not the moves the search expects to be made after it.
+"""
+
+MoveCost = Callable[[chess.Board, chess.Move], int]
+"""
+An extra cost (in centipawns) of making a move, on top of what it does to the position (ex. how
+long the gantry takes to make it). Like MoveFilter, only applies to the move being picked.
+"""
+
+class Engine(ABC):
+	"""
+	Picks moves. Subclasses implement pick_move.
+	"""
+	@abstractmethod
+	def pick_move(self, board: chess.Board, time_limit: float, move_filter: Optional[MoveFilter] = None) -> Optional[chess.Move]:
+		"""
+		Pick a move for whoever's turn it is on board, taking no more than (about) time_limit seconds.
+		Returns None if there are no moves (that pass move_filter). Doesn't modify board.
+		"""
+
+class RandomEngine(Engine):
+	"""
+	Picks a (pseudo-legal) move at random.
+	"""
+	def pick_move(self, board: chess.Board, time_limit: float, move_filter: Optional[MoveFilter] = None) -> Optional[chess.Move]:
+		moves = [move for move in board.pseudo_legal_moves if move_filter is None or move_filter(board, move)]
+		if len(moves) == 0:
+			return None
+		return choice(moves)
+
+MATE_SCORE = 100_000
+""" The score for delivering checkmate right now. Mates further away score one less per ply. """
+
+MAX_PLY = 128
+""" The deepest the search will ever go (including checks and quiescence). """
+
+INFINITY = MATE_SCORE + 1
+
+PIECE_VALUES = {
+	chess.PAWN: 100,
+	chess.KNIGHT: 320,
+	chess.BISHOP: 330,
+	chess.ROOK: 500,
+	chess.QUEEN: 900,
+	chess.KING: 0,
+}
+
+# Piece-square tables (from Tomasz Michniewski's Simplified Evaluation Function), from white's
+# perspective, laid out as you'd look at the board: a8 is the first entry and h1 the last.
+_PIECE_SQUARE_TABLES = {
+	chess.PAWN: [
+		 0,  0,  0,  0,  0,  0,  0,  0,
+		50, 50, 50, 50, 50, 50, 50, 50,
+		10, 10, 20, 30, 30, 20, 10, 10,
+		 5,  5, 10, 25, 25, 10,  5,  5,
+		 0,  0,  0, 20, 20,  0,  0,  0,
+		 5, -5,-10,  0,  0,-10, -5,  5,
+		 5, 10, 10,-20,-20, 10, 10,  5,
+		 0,  0,  0,  0,  0,  0,  0,  0,
+	],
+	chess.KNIGHT: [
+		-50,-40,-30,-30,-30,-30,-40,-50,
+		-40,-20,  0,  0,  0,  0,-20,-40,
+		-30,  0, 10, 15, 15, 10,  0,-30,
+		-30,  5, 15, 20, 20, 15,  5,-30,
+		-30,  0, 15, 20, 20, 15,  0,-30,
+		-30,  5, 10, 15, 15, 10,  5,-30,
+		-40,-20,  0,  5,  5,  0,-20,-40,
+		-50,-40,-30,-30,-30,-30,-40,-50,
+	],
+	chess.BISHOP: [
+		-20,-10,-10,-10,-10,-10,-10,-20,
+		-10,  0,  0,  0,  0,  0,  0,-10,
+		-10,  0,  5, 10, 10,  5,  0,-10,
+		-10,  5,  5, 10, 10,  5,  5,-10,
+		-10,  0, 10, 10, 10, 10,  0,-10,
+		-10, 10, 10, 10, 10, 10, 10,-10,
+		-10,  5,  0,  0,  0,  0,  5,-10,
+		-20,-10,-10,-10,-10,-10,-10,-20,
+	],
+	chess.ROOK: [
+		 0,  0,  0,  0,  0,  0,  0,  0,
+		 5, 10, 10, 10, 10, 10, 10,  5,
+		-5,  0,  0,  0,  0,  0,  0, -5,
+		-5,  0,  0,  0,  0,  0,  0, -5,
+		-5,  0,  0,  0,  0,  0,  0, -5,
+		-5,  0,  0,  0,  0,  0,  0, -5,
+		-5,  0,  0,  0,  0,  0,  0, -5,
+		 0,  0,  0,  5,  5,  0,  0,  0,
+	],
+	chess.QUEEN: [
+		-20,-10,-10, -5, -5,-10,-10,-20,
+		-10,  0,  0,  0,  0,  0,  0,-10,
+		-10,  0,  5,  5,  5,  5,  0,-10,
+		 -5,  0,  5,  5,  5,  5,  0, -5,
+		  0,  0,  5,  5,  5,  5,  0, -5,
+		-10,  5,  5,  5,  5,  5,  0,-10,
+		-10,  0,  5,  0,  0,  0,  0,-10,
+		-20,-10,-10, -5, -5,-10,-10,-20,
+	],
+	chess.KING: [
+		-30,-40,-40,-50,-50,-40,-40,-30,
+		-30,-40,-40,-50,-50,-40,-40,-30,
+		-30,-40,-40,-50,-50,-40,-40,-30,
+		-30,-40,-40,-50,-50,-40,-40,-30,
+		-20,-30,-30,-40,-40,-30,-30,-20,
+		-10,-20,-20,-20,-20,-20,-20,-10,
+		 20, 20,  0,  0,  0,  0, 20, 20,
+		 20, 30, 10,  0,  0, 10, 30, 20,
+	],
+}
+
+_KING_ENDGAME_TABLE = [
+	-50,-40,-30,-20,-20,-30,-40,-50,
+	-30,-20,-10,  0,  0,-10,-20,-30,
+	-30,-10, 20, 30, 30, 20,-10,-30,
+	-30,-10, 30, 40, 40, 30,-10,-30,
+	-30,-10, 30, 40, 40, 30,-10,-30,
+	-30,-10, 20, 30, 30, 20,-10,-30,
+	-30,-30,  0,  0,  0,  0,-30,-30,
+	-50,-30,-30,-30,-30,-30,-30,-50,
+]
+
+ENDGAME_MATERIAL = 1300
+""" Once neither side has more than this much (non-pawn) material, kings should head for the center. """
+
+def _square_values(table: List[int], value: int) -> Dict[chess.Color, List[int]]:
+	# The tables start at a8, so they're upside down for white and exactly right (seen from black's side) for black
+	return {
+		chess.WHITE: [value + table[square ^ 56] for square in chess.SQUARES],
+		chess.BLACK: [value + table[square] for square in chess.SQUARES],
+	}
+
+_SQUARE_VALUES = {
+	piece_type: _square_values(table, PIECE_VALUES[piece_type])
+	for piece_type, table in _PIECE_SQUARE_TABLES.items()
+}
+_KING_ENDGAME_VALUES = _square_values(_KING_ENDGAME_TABLE, 0)
+
+def evaluate(board: chess.Board) -> int:
+	"""
+	Statically evaluate a position, in centipawns, from the perspective of the side to move.
+	"""
+	score = 0
+	non_pawn_material = { chess.WHITE: 0, chess.BLACK: 0 }
+	for color, sign in ((chess.WHITE, 1), (chess.BLACK, -1)):
+		for piece_type in (chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN):
+			values = _SQUARE_VALUES[piece_type][color]
+			for square in chess.scan_reversed(board.pieces_mask(piece_type, color)):
+				score += sign * values[square]
+				if piece_type != chess.PAWN:
+					non_pawn_material[color] += PIECE_VALUES[piece_type]
+
+	is_endgame = max(non_pawn_material.values()) <= ENDGAME_MATERIAL
+	for color, sign in ((chess.WHITE, 1), (chess.BLACK, -1)):
+		values = (_KING_ENDGAME_VALUES if is_endgame else _SQUARE_VALUES[chess.KING])[color]
+		for square in chess.scan_reversed(board.pieces_mask(chess.KING, color)):
+			score += sign * values[square]
+
+	return score if board.turn == chess.WHITE else -score
+
+_ZOBRIST_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+_zobrist = chess.polyglot.ZobristHasher(_ZOBRIST_ARRAY)
+
+def _piece_key(piece_type: chess.PieceType, color: chess.Color, square: chess.Square) -> int:
+	return _ZOBRIST_ARRAY[64 * ((piece_type - 1) * 2 + int(color)) + square]
+
+def pieces_key_after(board: chess.Board, pieces_key: int, move: chess.Move) -> int:
+	"""
+	Incrementally update the piece placement part of a Zobrist hash (see zobrist_key) for a move
+	that's about to be made on board.
+	"""
+	color = board.turn
+	piece_type = board.piece_type_at(move.from_square)
+	key = pieces_key ^ _piece_key(piece_type, color, move.from_square)
+
+	if board.is_castling(move):
+		rank = chess.square_rank(move.from_square)
+		if board.is_kingside_castling(move):
+			king_to, rook_from, rook_to = chess.square(6, rank), chess.square(7, rank), chess.square(5, rank)
+		else:
+			king_to, rook_from, rook_to = chess.square(2, rank), chess.square(0, rank), chess.square(3, rank)
+		return key ^ _piece_key(chess.KING, color, king_to) \
+			^ _piece_key(chess.ROOK, color, rook_from) ^ _piece_key(chess.ROOK, color, rook_to)
+
+	captured_square = move.to_square
+	if board.is_en_passant(move):
+		captured_square = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+	captured = board.piece_type_at(captured_square)
+	if captured is not None:
+		key ^= _piece_key(captured, not color, captured_square)
+
+	return key ^ _piece_key(move.promotion or piece_type, color, move.to_square)
+
+def zobrist_key(board: chess.Board, pieces_key: Optional[int] = None) -> int:
+	"""
+	The polyglot Zobrist hash of a position (same as chess.polyglot.zobrist_hash), optionally reusing
+	an already known (ex. incrementally updated) hash of just the piece placement.
+	"""
+	if pieces_key is None:
+		pieces_key = _zobrist.hash_board(board)
+	return pieces_key ^ _zobrist.hash_castling(board) ^ _zobrist.hash_ep_square(board) ^ _zobrist.hash_turn(board)
+
+def encode_move(move: Optional[chess.Move]) -> int:
+	""" Pack a move into a small integer (0 for no move), ex. to store it in a table. """
+	if move is None:
+		return 0
+	return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def decode_move(value: int) -> Optional[chess.Move]:
+	""" The inverse of encode_move. """
+	if value == 0:
+		return None
+	return chess.Move(value & 63, (value >> 6) & 63, (value >> 12) or None)
+
+# Transposition table entry flags: whether the stored score is exact or only a bound
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+class TranspositionTable:
+	"""
+	Remembers what the search found out about positions, keyed by Zobrist hash, so positions that
+	are reached more than once (or again in the next iteration) don't have to be searched again.
+	When it fills up, it's simply cleared.
+	"""
+	max_entries: int
+
+	def __init__(self, max_entries=1_000_000):
+		self.max_entries = max_entries
+		self._entries: Dict[int, Tuple[int, int, int, int]] = {}
+
+	def get(self, key: int) -> Optional[Tuple[int, int, int, int]]:
+		""" Returns (depth, score, flag, encoded move) or None. """
+		return self._entries.get(key)
+
+	def put(self, key: int, depth: int, score: int, flag: int, move: int):
+		existing = self._entries.get(key)
+		# Don't replace a deeper result for the same position with a shallower one
+		if existing is not None and existing[0] > depth:
+			return
+		if existing is None and len(self._entries) >= self.max_entries:
+			self._entries.clear()
+		self._entries[key] = (depth, score, flag, move)
+
+	def clear(self):
+		self._entries.clear()
+
+	def __len__(self):
+		return len(self._entries)
+
+@dataclass
+class SearchResult:
+	move: Optional[chess.Move]
+	score: int = 0
+	""" In centipawns, from the perspective of the side to move. Mates are near +/-MATE_SCORE. """
+	depth: int = 0
+	""" The deepest iteration that was completed (or 0 if there was no need to search). """
+	nodes: int = 0
+	time: float = 0.0
+	pv: List[chess.Move] = field(default_factory=list)
+	""" The line the search expects to be played, starting with move. """
+
+class SearchTimeout(Exception):
+	pass
+
+class SearchEngine(Engine):
+	"""
+	Iterative-deepening alpha-beta search. See the top of this file.
+	"""
+	table: TranspositionTable
+
+	max_depth: int = 64
+	""" Stop deepening after this many plies, even if there's time left. """
+
+	last_result: Optional[SearchResult] = None
+	""" The result of the most recent search. """
+
+	move_cost: Optional[MoveCost] = None
+	"""
+	If set, subtracted from the score of each move search chooses between, so of two moves that are
+	about as good, it picks the cheaper one. Scores in results don't include it.
+	"""
+
+	def __init__(self, table_size=1_000_000):
+		self.table = TranspositionTable(table_size)
+
+	def pick_move(self, board: chess.Board, time_limit: float, move_filter: Optional[MoveFilter] = None) -> Optional[chess.Move]:
+		return self.search(board, time_limit, move_filter=move_filter).move
+
+	def search(self, board: chess.Board, time_limit: float, max_depth: Optional[int] = None, move_filter: Optional[MoveFilter] = None,
+			on_iteration: Optional[Callable[[SearchResult], None]] = None, start_depth=1, stop: Optional[Callable[[], bool]] = None) -> SearchResult:
+		"""
+		Search board for up to time_limit seconds (or max_depth plies) and return the best move found.
+		on_iteration is called with the result so far every time an iteration finishes.
+
+		The search also ends early (as if it ran out of time) as soon as stop returns True, if given.
+		Iterations start from start_depth plies.
+		"""
+		start = perf_counter()
+		self._deadline = start + time_limit
+		self._stop = stop
+		self._nodes = 0
+		self._killers = [[None, None] for _ in range(MAX_PLY + 1)]
+		self._history: Dict[Tuple[chess.Color, chess.Square, chess.Square], int] = {}
+		self._path: List[int] = []
+		self._game_keys = _game_keys(board)
+		board = board.copy()
+
+		moves = self.root_moves(board, move_filter)
+		if len(moves) <= 1:
+			self.last_result = SearchResult(moves[0] if len(moves) == 1 else None, time=perf_counter() - start)
+			return self.last_result
+
+		self._root_costs = { move: self.move_cost(board, move) for move in moves } if self.move_cost is not None else {}
+		pieces_key = _zobrist.hash_board(board)
+		root = board.copy(stack=False)
+		result = SearchResult(moves[0])
+		for depth in range(start_depth, (max_depth or self.max_depth) + 1):
+			self._iteration_best = None
+			try:
+				score = self._search_root(board, moves, depth, pieces_key)
+			except SearchTimeout:
+				# The first move searched is last iteration's best, so anything that beat it is better
+				if self._iteration_best is not None:
+					result.move, result.score = self._iteration_best
+					# (board is wherever the search was interrupted, so start from a fresh copy)
+					after = root.copy(stack=False)
+					after.push(result.move)
+					result.pv = [result.move] + self._principal_variation(after)
+				break
+			result = SearchResult(moves[0], score, depth, self._nodes, perf_counter() - start, self._principal_variation(board))
+			if on_iteration is not None:
+				on_iteration(result)
+			# There's no point looking for a faster mate than the one we found, and the next iteration
+			# would almost certainly take longer than all the time that's left
+			if abs(score) >= MATE_SCORE - MAX_PLY or perf_counter() - start > time_limit / 2:
+				break
+
+		result.nodes = self._nodes
+		result.time = perf_counter() - start
+		self.last_result = result
+		return result
+
+	def root_moves(self, board: chess.Board, move_filter: Optional[MoveFilter] = None) -> List[chess.Move]:
+		"""
+		The moves search chooses between.
+		"""
+		moves = [move for move in board.legal_moves if move_filter is None or move_filter(board, move)]
+		if len(moves) == 0 and not board.is_valid():
+			# The board might not be quite right (ex. a king was misdetected), so be less picky
+			moves = [move for move in board.pseudo_legal_moves if move_filter is None or move_filter(board, move)]
+		return moves
+
+	def _search_root(self, board: chess.Board, moves: List[chess.Move], depth: int, pieces_key: int) -> int:
+		"""
+		Search every root move to depth, then sort moves from best to worst (for the next iteration).
+		"""
+		alpha = -INFINITY
+		scores = {}
+		costs = self._root_costs
+		self._path.append(zobrist_key(board, pieces_key))
+		for move in moves:
+			child_key = pieces_key_after(board, pieces_key, move)
+			board.push(move)
+			# A costlier move has to be better by at least the difference to be worth it
+			bound = alpha + costs.get(move, 0) if alpha > -INFINITY else -INFINITY
+			score = -self._negamax(board, depth - 1, -INFINITY, -bound, 1, child_key)
+			board.pop()
+			scores[move] = score - costs.get(move, 0)
+			if scores[move] > alpha:
+				alpha = scores[move]
+				self._iteration_best = (move, score)
+		self._path.pop()
+
+		moves.sort(key=lambda move: scores[move], reverse=True)
+		score = alpha + costs.get(moves[0], 0)
+		self.table.put(zobrist_key(board, pieces_key), depth, score, EXACT, encode_move(moves[0]))
+		return score
+
+	def _negamax(self, board: chess.Board, depth: int, alpha: int, beta: int, ply: int, pieces_key: int) -> int:
+		self._nodes += 1
+		if self._nodes & 255 == 0:
+			self._check_time()
+
+		key = zobrist_key(board, pieces_key)
+		if board.halfmove_clock >= 100 or key in self._path or key in self._game_keys:
+			return 0
+
+		in_check = board.is_check()
+		if in_check and ply < MAX_PLY // 2:
+			depth += 1  # Don't stop searching right in the middle of a check
+		if depth <= 0 or ply >= MAX_PLY:
+			return self._quiescence(board, alpha, beta, ply)
+
+		original_alpha = alpha
+		tt_move = None
+		entry = self.table.get(key)
+		if entry is not None:
+			entry_depth, entry_score, flag, entry_move = entry
+			tt_move = decode_move(entry_move)
+			if entry_depth >= depth:
+				score = _score_from_table(entry_score, ply)
+				if flag == EXACT:
+					return score
+				if flag == LOWER_BOUND:
+					alpha = max(alpha, score)
+				else:
+					beta = min(beta, score)
+				if alpha >= beta:
+					return score
+
+		best_score = -INFINITY
+		best_move = None
+		self._path.append(key)
+		for move in self._ordered_moves(board, tt_move, ply):
+			child_key = pieces_key_after(board, pieces_key, move)
+			is_quiet = not board.is_capture(move) and move.promotion is None
+			board.push(move)
+			score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1, child_key)
+			board.pop()
+
+			if score > best_score:
+				best_score = score
+				best_move = move
+			if score > alpha:
+				alpha = score
+			if alpha >= beta:
+				if is_quiet:
+					killers = self._killers[ply]
+					if killers[0] != move:
+						killers[0], killers[1] = move, killers[0]
+					history_key = (board.turn, move.from_square, move.to_square)
+					self._history[history_key] = self._history.get(history_key, 0) + depth * depth
+				break
+		self._path.pop()
+
+		if best_move is None:
+			return -MATE_SCORE + ply if in_check else 0  # Checkmate or stalemate
+
+		if best_score <= original_alpha:
+			flag = UPPER_BOUND
+		elif best_score >= beta:
+			flag = LOWER_BOUND
+		else:
+			flag = EXACT
+		self.table.put(key, depth, _score_to_table(best_score, ply), flag, encode_move(best_move))
+		return best_score
+
+	def _quiescence(self, board: chess.Board, alpha: int, beta: int, ply: int) -> int:
+		"""
+		Only look at captures until the position is quiet, so we don't evaluate it mid-exchange.
+		"""
+		self._nodes += 1
+		if self._nodes & 255 == 0:
+			self._check_time()
+
+		stand_pat = evaluate(board)
+		if stand_pat >= beta or ply >= MAX_PLY:
+			return stand_pat
+		alpha = max(alpha, stand_pat)
+
+		captures = sorted(board.generate_legal_captures(), key=lambda move: _capture_order(board, move), reverse=True)
+		for move in captures:
+			board.push(move)
+			score = -self._quiescence(board, -beta, -alpha, ply + 1)
+			board.pop()
+			if score >= beta:
+				return score
+			alpha = max(alpha, score)
+		return alpha
+
+	def _check_time(self):
+		if perf_counter() > self._deadline or (self._stop is not None and self._stop()):
+			raise SearchTimeout()
+
+	def _ordered_moves(self, board: chess.Board, tt_move: Optional[chess.Move], ply: int) -> List[chess.Move]:
+		killers = self._killers[ply]
+
+		def order(move: chess.Move) -> int:
+			if move == tt_move:
+				return 3_000_000
+			if board.is_capture(move):
+				return 2_000_000 + _capture_order(board, move)
+			if move.promotion is not None:
+				return 1_500_000 + PIECE_VALUES[move.promotion]
+			if move == killers[0] or move == killers[1]:
+				return 1_000_000
+			return self._history.get((board.turn, move.from_square, move.to_square), 0)
+
+		return sorted(board.legal_moves, key=order, reverse=True)
+
+	def _principal_variation(self, board: chess.Board) -> List[chess.Move]:
+		"""
+		Follow the transposition table's best moves from board.
+		"""
+		board = board.copy(stack=False)
+		pv = []
+		seen = set()
+		while len(pv) < MAX_PLY:
+			key = zobrist_key(board)
+			entry = self.table.get(key)
+			move = decode_move(entry[3]) if entry is not None else None
+			if move is None or key in seen or not board.is_legal(move):
+				break
+			seen.add(key)
+			pv.append(move)
+			board.push(move)
+		return pv
+
+def _capture_order(board: chess.Board, move: chess.Move) -> int:
+	""" Most valuable victim, least valuable attacker. """
+	victim = board.piece_type_at(move.to_square) or chess.PAWN  # En passant
+	attacker = board.piece_type_at(move.from_square)
+	return 10 * PIECE_VALUES[victim] - PIECE_VALUES[attacker] + (PIECE_VALUES[move.promotion] if move.promotion else 0)
+
+def _score_to_table(score: int, ply: int) -> int:
+	# Mate scores are stored relative to the position (not the root), since it may be reached at other plies
+	if score >= MATE_SCORE - MAX_PLY:
+		return score + ply
+	if score <= -MATE_SCORE + MAX_PLY:
+		return score - ply
+	return score
+
+def _score_from_table(score: int, ply: int) -> int:
+	if score >= MATE_SCORE - MAX_PLY:
+		return score - ply
+	if score <= -MATE_SCORE + MAX_PLY:
+		return score + ply
+	return score
+
+def _game_keys(board: chess.Board) -> Set[int]:
+	"""
+	Zobrist keys of every position earlier in the game (from board's move stack), so the search can
+	see repetitions.
+	"""
+	keys = set()
+	replay = board.root()
+	for move in board.move_stack:
+		keys.add(zobrist_key(replay))
+		replay.push(move)
+	return keys
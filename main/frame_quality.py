@@ -0,0 +1,125 @@
+"""
+A cheap check of whether a frame is worth running the Apriltag detector on at all.
+
+Blurry frames (the camera or a piece was moving), badly exposed ones and ones with a hand moving
+over the board almost never produce a usable board, but the detector takes just as long to find that
+out. FrameQualityGate measures a few things that are much cheaper to compute (on a downscaled copy of
+the frame) and rejects the frame outright if any of them are out of range, so another one can be
+captured instead.
+
+Run this file on some images to see how they measure up (ex. to tune the thresholds for a camera):
+
+    python3 frame_quality.py frames/*.png
+"""
+from typing import *
+from dataclasses import dataclass
+import cv2
+from time import perf_counter
+
+@dataclass(frozen=True)
+class FrameQualityOptions:
+	scale: float = 0.5
+	""" Every measure is computed on a copy of the frame downscaled by this factor. """
+
+	min_sharpness: float = 15.0
+	"""
+	Frames with a lower variance of the Laplacian than this are too blurry. Sharp frames from the
+	Grandmaster camera measure 60-110, and tags stop being readable at around 10.
+	"""
+
+	max_clipped: float = 0.4
+	"""
+	Frames with a larger fraction of their pixels than this at the very ends of the histogram (see
+	clip_margin) are too over- or under-exposed. The board itself is mostly white, so this is fairly
+	lenient.
+	"""
+
+	clip_margin: int = 5
+	""" Pixels within this much of 0 or 255 count as clipped. """
+
+	max_motion: float = 8.0
+	"""
+	Frames with a larger mean absolute difference than this (out of 255) from the previous frame
+	were captured while something was moving (usually a hand over the board).
+	"""
+
+	max_motion_interval: float = 1.0
+	"""
+	Frames are only compared with the previous one if it was checked at most this many seconds
+	earlier. Any longer and the board may well have changed on purpose (ex. a move was made since).
+	"""
+
+DEFAULT_FRAME_QUALITY_OPTIONS = FrameQualityOptions()
+
+@dataclass
+class FrameQuality:
+	sharpness: float
+	clipped: float
+	motion: Optional[float]
+	""" None if there was no recent previous frame (of the same size) to compare with. """
+
+	problem: Optional[str] = None
+	""" Why the frame was rejected, or None if it's good. """
+
+	@property
+	def ok(self) -> bool:
+		return self.problem is None
+
+class FrameQualityGate:
+	"""
+	Measures frames, one after another, against FrameQualityOptions. Remembers the previous frame
+	(downscaled) to estimate motion, so use one gate per camera, and reset it whenever the next
+	frame isn't a continuation of the previous ones.
+	"""
+	options: FrameQualityOptions
+
+	def __init__(self, options: FrameQualityOptions = DEFAULT_FRAME_QUALITY_OPTIONS):
+		self.options = options
+		self._previous = None
+		self._previous_time = 0.0
+
+	def reset(self):
+		"""
+		Forget the previous frame, so the next one isn't checked for motion (ex. when frames aren't
+		consecutive).
+		"""
+		self._previous = None
+
+	def check(self, img) -> FrameQuality:
+		"""
+		Measure a frame (grayscale or BGR). Takes a few milliseconds even on large frames.
+		"""
+		options = self.options
+		gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+		small = cv2.resize(gray, None, fx=options.scale, fy=options.scale, interpolation=cv2.INTER_AREA)
+
+		sharpness = float(cv2.Laplacian(small, cv2.CV_16S).var())
+
+		histogram = cv2.calcHist([small], [0], None, [256], [0, 256]).ravel()
+		margin = options.clip_margin
+		clipped = float((histogram[:margin + 1].sum() + histogram[255 - margin:].sum()) / small.size)
+
+		motion = None
+		now = perf_counter()
+		if self._previous is not None and self._previous.shape == small.shape \
+				and now - self._previous_time <= options.max_motion_interval:
+			motion = float(cv2.absdiff(small, self._previous).mean())
+		self._previous = small
+		self._previous_time = now
+
+		quality = FrameQuality(sharpness, clipped, motion)
+		if sharpness < options.min_sharpness:
+			quality.problem = f"Frame is too blurry (sharpness {sharpness:.1f} < {options.min_sharpness})"
+		elif clipped > options.max_clipped:
+			quality.problem = f"Frame is badly exposed ({clipped:.0%} of pixels clipped)"
+		elif motion is not None and motion > options.max_motion:
+			quality.problem = f"Something is moving (motion {motion:.1f} > {options.max_motion})"
+		return quality
+
+if __name__ == '__main__':
+	import sys
+	gate = FrameQualityGate()
+	for file in sys.argv[1:]:
+		quality = gate.check(cv2.imread(file, cv2.IMREAD_GRAYSCALE))
+		motion = f"{quality.motion:6.1f}" if quality.motion is not None else "     -"
+		print(f"{file}: sharpness {quality.sharpness:7.1f}, clipped {quality.clipped:6.1%}, motion {motion}  {quality.problem or 'OK'}")
@@ -2,15 +2,22 @@ from typing import *
 from helpers import print_to_dashboard as print
 
 import sys
-import cv2
 import chess
-import requests
-import numpy as np
 import traceback
-from time import sleep
+from time import sleep, time, perf_counter
+from os.path import exists
 from enum import Enum
-from random import choice
-from detector import Detector
+from detector import Detector, BoardNotFoundError
+from camclient import fetch_image, fetch_detections, MJPEGStream
+from recording import RecordingWriter, ReplaySource
+from board_fusion import BoardFusion
+from board_tracker import BoardTracker
+from frame_quality import FrameQualityGate
+from engine import Engine, SearchEngine, SearchResult
+from ponder import Ponderer
+from position_cache import PositionCache, PositionBook, BOOK_FILE
+from gantry_model import GantryModel, GANTRY_MODEL_FILE, Position
+from path_planner import PathPlanner, GRAVEYARD_FILES
 from arduino_manager import ArduinoManager, Button, LEDPallete
 
 class State(Enum):
@@ -29,8 +36,144 @@ class GameController:
 	arduino: ArduinoManager
 	autoplay: bool = False
 
+	image_encoding: str = 'png'
+	""" Encoding to fetch images from the Vision Service in (see image_encoding.ENCODINGS). """
+
+	grayscale: bool = True
+	"""
+	Have the Vision Service send images as a single channel (see camserver's gray parameter). The
+	Detector only needs grayscale, so color is just three times as many bytes to transfer and decode.
+	"""
+
+	image_stream: Optional[MJPEGStream] = None
+	""" If set, images are taken from this (already connected) stream instead of being fetched. """
+
+	remote_detection: bool = False
+	"""
+	If set, the Vision Service runs the Detector itself and we only fetch the results, instead of
+	transferring and decoding a full image.
+	"""
+
+	recorder: Optional[RecordingWriter] = None
+	"""
+	If set, every image we detect a board from is recorded, along with the detections, the resulting
+	board, timings and turn context, so misdetections can be reproduced later. (Only images we fetch
+	ourselves can be recorded, so this does nothing with remote_detection.)
+	"""
+
+	replay: Optional[ReplaySource] = None
+	""" If set, images are played back from a recording instead of coming from the Vision Service. """
+
+	fusion_max_frames: int = 5
+	""" The most frames detect_board will look at before deciding what's on the board. """
+
+	fusion_timeout: float = 1.0
+	""" detect_board won't start looking at another frame after this many seconds. """
+
+	fusion_min_confidence: float = 0.75
+	""" detect_board stops early once every square has at least this share of the vote. """
+
+	detect_retries: int = 8
+	""" How many more times play_computer_turn tries to see the board before giving up on the turn. """
+
+	detect_retry_delay: float = 0.5
+	""" How long (in seconds) to wait before trying to see the board again, doubling every time. """
+
+	detect_retry_max_delay: float = 5.0
+
+	move_retries: int = 2
+	"""
+	How many more times play_computer_turn tries its turn after something else goes wrong (ex. the
+	engine crashing) before giving up on the turn. Once the gantry has started moving pieces, it
+	doesn't retry at all, since the board is no longer where the turn started from.
+	"""
+
+	board_confidence: Dict[str, float]
+	""" How confident (0 to 1) the most recent detect_board was about each square. """
+
+	engine: Engine
+	""" What picks our moves (see pick_move). """
+
+	think_time: float = 5.0
+	"""
+	How long (in seconds) the engine gets to pick a move. The gantry and the human are waiting, so
+	it always answers by then.
+	"""
+
+	preposition: bool = True
+	"""
+	While the engine is thinking, send the gantry to where it'll probably pick up the first piece
+	(see preposition_gantry), so less of the turn is spent waiting for it once the move is decided.
+	"""
+
+	preposition_min_depth: int = 3
+	""" Don't preposition the gantry until the search is this deep, since it changes its mind a lot before. """
+
+	preposition_timeout: float = 3.0
+	"""
+	How much longer (in seconds) than the gantry model predicts to wait for a prepositioning trip to
+	finish before making the move anyway, in case the gantry's position report got lost.
+	"""
+
+	move_timeout: float = 10.0
+	"""
+	How much longer (in seconds) than the gantry model predicts to wait for a move's trajectory to
+	finish before giving up on the gantry (see ArduinoManager.run_trajectory).
+	"""
+
+	_preposition_target: Optional[Position] = None
+
+	ponder: bool = True
+	"""
+	Think about our answers to the human's likely moves while they're deciding (see Ponderer), so
+	we can move right away if they play one of them.
+	"""
+
+	ponderer: Ponderer
+
+	path_planner: PathPlanner
+	""" Works out how to make moves without knocking pieces over (see plan_move). """
+
+	graveyard: Set[Position]
+	""" The graveyard slots with a captured piece in them. Emptied when a game starts. """
+
+	gantry_model: GantryModel
+	""" How long the gantry takes to make moves (see estimate_move_time). """
+
+	travel_cost: float = 2.0
+	"""
+	What each second the gantry spends making a move costs, in centipawns (see move_cost). Small, so
+	it only makes a difference between moves that are about as good.
+	"""
+
+	position_cache: PositionCache
+	"""
+	Moves we don't need to search for: the book (see position_cache.py), if there is one, and the
+	moves we've already searched for this session.
+	"""
+
+	last_search: Optional[SearchResult] = None
+	""" What the engine (or the ponderer) came up with for the most recent move we picked. """
+
+	tracker: BoardTracker
+	"""
+	The game so far. detect_board works out the human's move from what changed since the last turn,
+	and only re-reads the whole board when it can't.
+	"""
+
 	def __init__(self):
 		self.detector = Detector()
+		# Don't bother detecting frames that are blurry or have a hand moving over the board, just
+		# look at another one (see detect_board)
+		self.detector.quality_gate = FrameQualityGate()
+		self.tracker = BoardTracker(min_confidence=self.fusion_min_confidence)
+		self.board_confidence = {}
+		self.engine = SearchEngine()
+		self.ponderer = Ponderer()
+		self.path_planner = PathPlanner()
+		self.graveyard = set()
+		self.gantry_model = GantryModel.read(GANTRY_MODEL_FILE) if exists(GANTRY_MODEL_FILE) else GantryModel()
+		self.position_cache = PositionCache(PositionBook(BOOK_FILE) if exists(BOOK_FILE) else None)
 		self.arduino = ArduinoManager(self.enter_ready_state, {
 			(Button.PLAYER): self.play_computer_turn,
 			# For ease of debugging, the computer button behaves the same as the player button
@@ -47,6 +190,8 @@ class GameController:
 		was_autoplay = self.autoplay
 		self.autoplay = autoplay
 		if autoplay:
+			self.tracker.reset()
+			self.graveyard = set()
 			self.state = State.HUMAN_TURN
 			self.play_computer_turn()
 		else:
@@ -59,6 +204,7 @@ class GameController:
 		"""
 		self.state = State.READY
 		self.autoplay = False
+		self.ponderer.stop()
 		self.arduino.set_button_light(Button.START, True, others=False)
 		self.arduino.set_button_light(Button.FUN, True)
 		self.arduino.set_led_pallete(LEDPallete.READY)
@@ -70,6 +216,8 @@ class GameController:
 		"""
 		print("Starting a game...")
 		self.set_autoplay(False)
+		self.tracker.reset()
+		self.graveyard = set()
 		self.start_human_turn()
 
 	def start_human_turn(self):
@@ -83,6 +231,7 @@ class GameController:
 		if not self.autoplay:
 			self.arduino.set_button_light(Button.PLAYER, True, others=False)
 			self.arduino.set_led_pallete(LEDPallete.HUMAN_TURN)
+			self.start_pondering()
 		else:
 			self.play_computer_turn(True)
 
@@ -97,6 +246,8 @@ class GameController:
 		
 		print("My turn!" if not is_autoplaying_human else "My turn (on the human's behalf)!")
 		if not is_autoplaying_human:
+			# Free up the CPU for detecting the board (what we've pondered so far is kept)
+			self.ponderer.stop()
 			self.state = State.COMPUTER_TURN
 			self.arduino.set_button_light(Button.COMPUTER, True, others=False)
 			self.arduino.set_led_pallete(LEDPallete.COMPUTER_THINK)
@@ -104,62 +255,196 @@ class GameController:
 			self.arduino.set_button_light(Button.PLAYER, True, others=False)
 			self.arduino.set_led_pallete(LEDPallete.AUTOPLAY_HUMAN_THINK)
 
-		try:
-			print("Fetching image...")
-			img = self.get_image()
-			print("Got image!")
-
-			print("Analyzing Image...")
-			# On the Grandmaster Chess Board, the human is always white (so they go first) and the computer is black
-			board = self.detector.detect_board(img, chess.BLACK if not is_autoplaying_human else chess.WHITE)
-			print("Got Board (from computer perspective):")
-			print(board.transform(chess.flip_horizontal).transform(chess.flip_vertical))
-
-			move: chess.Move = self.pick_move(board)
+		# On the Grandmaster Chess Board, the human is always white (so they go first) and the computer is black
+		turn = chess.BLACK if not is_autoplaying_human else chess.WHITE
+		failed_detections = 0
+		failed_moves = 0
+		moving = False
 
-			if move == None:
-				print("Couldn't find valid move!")
+		def give_up():
+			if self.autoplay:
+				self.enter_ready_state()
 			else:
-				print("Making Move:", board.piece_at(move.from_square), '@', move)
-				self.arduino.set_led_pallete(LEDPallete.COMPUTER_MOVE if not is_autoplaying_human else LEDPallete.HUMAN_TURN)
-				self.arduino.set_electromagnet(False)
-				self.move_to_square(move.from_square)
-				self.arduino.set_electromagnet(True)
-				self.move_to_square(move.to_square)
-				self.arduino.set_electromagnet(False)
-			print("DONE with my turn!")
-			if not is_autoplaying_human:
 				self.start_human_turn()
-			else:
-				self.play_computer_turn(False)
-		except Exception as err:
-			print("Failed to execute move! Retrying in 3 seconds...!")
-			traceback.print_exception(*sys.exc_info())
-			# If we just don't acknowledge the failure it's like it never happened! #HashtagLifeHax
-			# self.arduino.set_led_pallete(LEDPallete.FAIL)
-			sleep(3)
-			self.state = State.HUMAN_TURN # So we pass the guard condition at the beginning
-			self.play_computer_turn(is_autoplaying_human) # Try again
+
+		while True:
+			try:
+				board = self.detect_board(turn)
+				print("Got Board (from computer perspective):")
+				print(board.transform(chess.flip_horizontal).transform(chess.flip_vertical))
+
+				move: chess.Move = self.pick_move(board)
+
+				if move == None:
+					print("Couldn't find valid move!")
+				else:
+					print("Making Move:", board.piece_at(move.from_square), '@', move)
+					self.arduino.set_led_pallete(LEDPallete.COMPUTER_MOVE if not is_autoplaying_human else LEDPallete.HUMAN_TURN)
+					moving = True
+					self.execute_move(board, move)
+					self.tracker.push(move)
+				break
+			except BoardNotFoundError as err:
+				# Something (ex. a hand) is probably in the way, so back off rather than keep the CPU
+				# and the Vision Service busy, and eventually give up until the button is pressed again
+				failed_detections += 1
+				if failed_detections > self.detect_retries:
+					print("Still couldn't see the board! Giving up, press the button to try again.", err)
+					give_up()
+					return
+				delay = min(self.detect_retry_delay * 2 ** (failed_detections - 1), self.detect_retry_max_delay)
+				print(f"Couldn't see the board! Retrying in {delay:.1f} seconds...", err)
+				sleep(delay)
+			except Exception as err:
+				traceback.print_exception(*sys.exc_info())
+				if moving:
+					# Pieces may have been left anywhere, so the tracked game can't be trusted anymore:
+					# the whole board is re-read next time
+					print("Failed partway through the move! Giving up, fix the board and press the button to try again.")
+					self.tracker.reset()
+					give_up()
+					return
+				failed_moves += 1
+				if failed_moves > self.move_retries:
+					print("Still failing! Giving up, press the button to try again.")
+					give_up()
+					return
+				print("Failed to make move! Retrying in 3 seconds...")
+				# If we just don't acknowledge the failure it's like it never happened! #HashtagLifeHax
+				# self.arduino.set_led_pallete(LEDPallete.FAIL)
+				sleep(3)
+
+		print("DONE with my turn!")
+		if not is_autoplaying_human:
+			self.start_human_turn()
+		else:
+			self.play_computer_turn(False)
 	
 	def pick_move(self, board: chess.Board):
 		"""
-		Select the best move to make from a set of options.
+		Select the best move to make, within think_time seconds, from the moves the gantry can
+		physically make (see can_execute_move).
+		"""
+		pondered = self.ponderer.lookup(board)
+		if pondered is not None and pondered.move is not None and pondered.move in board.pseudo_legal_moves:
+			print(f"Already thought about this position (to depth {pondered.depth}, score {pondered.score})")
+			self.last_search = pondered
+			self.position_cache.put(board, pondered)
+			return pondered.move
 
-		Currently, Grandmaster employes a novel and unconventional chess algorithm: it picks moves
-		at random, excluding moves involving a knight or a capture. (Both of which are more complex
-		to physically execute.)
-		
-		This is an area with significant possible future improvement.
+		if isinstance(self.engine, SearchEngine):
+			cached = self.position_cache.lookup(board)
+			# The book isn't limited to moves the gantry can make
+			if cached is not None and board.is_legal(cached.move) and self.can_execute_move(board, cached.move):
+				print(f"Already know this position (to depth {cached.depth}, score {cached.score})")
+				self.last_search = cached
+				return cached.move
+
+		if not isinstance(self.engine, SearchEngine):
+			self.last_search = None
+			return self.engine.pick_move(board, self.think_time, self.can_execute_move)
+
+		self.engine.move_cost = self.move_cost
+		on_iteration = (lambda result: self.preposition_gantry(board, result)) if self.preposition else None
+		result = self.last_search = self.engine.search(board, self.think_time, move_filter=self.can_execute_move, on_iteration=on_iteration)
+		self.position_cache.put(board, result)
+		print(f"Searched {result.nodes} positions to depth {result.depth} in {result.time:.1f}s (score {result.score})")
+		return result.move
+
+	def preposition_gantry(self, board: chess.Board, result: SearchResult):
+		"""
+		Start the gantry towards where it would pick up the first piece for the search's current best
+		move, unless it's still on its way somewhere. Called after every iteration of the search (see
+		pick_move), and corrected by execute_move if the search changes its mind.
+		"""
+		# Not update, since button handlers could change the game's state in the middle of the search
+		self.arduino.update_gantry()
+		if result.depth < self.preposition_min_depth or result.move is None:
+			return
+		# The gantry can't change course in the middle of a trip
+		if self._preposition_target is not None and self.arduino.gantry_pos != self._preposition_target:
+			return
+		transfers = self.plan_move(board, result.move)
+		if transfers is None or transfers[0][0] == self.arduino.gantry_pos:
+			return
+		self._preposition_target = transfers[0][0]
+		print("Prepositioning gantry at", self._preposition_target)
+		self.arduino.move_gantry(*self._preposition_target, block=False)
+
+	def start_pondering(self):
+		"""
+		Start thinking about our answers to the human's likely moves in the background, if we know
+		what the board looks like.
 		"""
-		moves = [
-			move for move in board.pseudo_legal_moves 
-			if board.piece_at(move.from_square).piece_type != chess.KNIGHT \
-				and board.piece_at(move.to_square) is None
-		]
-		if len(moves) == 0:
-			return 
-		return choice(moves)
+		if not self.ponder or not isinstance(self.engine, SearchEngine) or self.tracker.board is None:
+			return
+		# Share what we learn with the engine's next search (and start from what it already knows)
+		self.ponderer.engine.table = self.engine.table
+		# The gantry won't move until our next turn, so the costs of our moves are already known
+		self.ponderer.engine.move_cost = self.move_cost
+		expected_reply = None
+		if self.last_search is not None and len(self.last_search.pv) > 1:
+			expected_reply = self.last_search.pv[1]
+		self.ponderer.start(self.tracker.board, self.think_time, self.can_execute_move, expected_reply)
 
+	def can_execute_move(self, board: chess.Board, move: chess.Move) -> bool:
+		"""
+		Whether the gantry can physically make a move, ie. whether there's a way to carry the pieces
+		involved without knocking into any others (see plan_move).
+		"""
+		return self.plan_move(board, move) is not None
+
+	def plan_move(self, board: chess.Board, move: chess.Move) -> Optional[List[List[Position]]]:
+		"""
+		The pieces the gantry has to carry to make a move: for each, the gantry positions from where
+		it's picked up to where it's put down (see PathPlanner.plan_move). None if it can't be done.
+		"""
+		return self.path_planner.plan_move(board, move, self.graveyard)
+
+	def execute_move(self, board: chess.Board, move: chess.Move):
+		"""
+		Physically make a move on the board, including clearing off a captured piece to the graveyard.
+		"""
+		transfers = self.plan_move(board, move)
+		if transfers is None:
+			raise ValueError(f"There's no way to make {move} without knocking into a piece!")
+
+		# Let the gantry finish any trip preposition_gantry started, since it can't be interrupted
+		if self._preposition_target is not None:
+			target, self._preposition_target = self._preposition_target, None
+			deadline = time() + self.gantry_model.travel_time(self.arduino.gantry_pos, target) + self.preposition_timeout
+			while self.arduino.gantry_pos != target and time() < deadline:
+				self.arduino.update_gantry()
+			if self.arduino.gantry_pos != target:
+				# The trajectory works from wherever the gantry actually is
+				print(f"Gantry never reported reaching {target}, carrying on from {self.arduino.gantry_pos}")
+
+		# All in one go, so the gantry only stops to pick up and put down pieces
+		waypoints = []
+		for path in transfers:
+			waypoints.append((*path[0], True))
+			waypoints.extend((*position, None) for position in path[1:-1])
+			waypoints.append((*path[-1], False))
+		self.arduino.set_electromagnet(False)
+		timeout = self.gantry_model.transfers_time(self.arduino.gantry_pos, transfers) + self.move_timeout
+		self.arduino.run_trajectory(waypoints, timeout=timeout)
+		self.graveyard.update(path[-1] for path in transfers if path[-1][0] in GRAVEYARD_FILES)
+
+	def estimate_move_time(self, board: chess.Board, move: chess.Move) -> Optional[float]:
+		"""
+		How long (in seconds) the gantry would take to make a move, from where it is now. None if it
+		can't make it.
+		"""
+		transfers = self.plan_move(board, move)
+		if transfers is None:
+			return None
+		return self.gantry_model.transfers_time(self.arduino.gantry_pos, transfers)
+
+	def move_cost(self, board: chess.Board, move: chess.Move) -> int:
+		"""
+		What the time the gantry takes to make a move costs, in centipawns (see travel_cost).
+		"""
+		return round(self.travel_cost * (self.estimate_move_time(board, move) or 0))
 
 	def move_to_square(self, square: chess.Square, block=True):
 		"""
@@ -171,18 +456,106 @@ class GameController:
 		y = chess.square_rank(square)
 		self.arduino.move_gantry(x, y, block)
 	
-	def get_image(self, retry=5):
+	def detect_board(self, turn: chess.Color) -> chess.Board:
+		"""
+		Find out what the board currently looks like.
+
+		Rather than trusting a single frame, this looks at a short burst of them (up to
+		fusion_max_frames, for up to fusion_timeout seconds) and has them vote on each square (see
+		BoardFusion), stopping as soon as the result is stable. The confidence in each square is
+		stored in board_confidence.
+		"""
+		fusion = BoardFusion(min_confidence=self.fusion_min_confidence)
+		deadline = time() + self.fusion_timeout
+		# Don't mistake the difference from the last frame of the previous burst for motion
+		self.detector.quality_gate.reset()
+
+		for i in range(self.fusion_max_frames):
+			# After the first frame, make sure we're not just sent the same one again
+			fusion.add(self.detect_frame(turn, fresh=i > 0))
+			if fusion.is_stable() or time() > deadline:
+				break
+			if fusion.frames_with_board > 0:
+				positions, confidence = fusion.result()
+				if len(self.tracker.explanations(positions, turn, confidence)) == 1:
+					break
+
+		if fusion.frames_with_board == 0:
+			raise BoardNotFoundError(fusion.last_error)
+
+		positions, self.board_confidence = fusion.result()
+		print(f"Fused {fusion.frames_with_board} of {fusion.frames} frames" + ("" if fusion.is_stable() else " (NOT STABLE)"))
+		unsure = [square for square, confidence in self.board_confidence.items() if confidence < self.fusion_min_confidence]
+		if len(unsure) > 0:
+			print("Unsure about squares:", ', '.join(unsure))
+
+		if self.tracker.update(positions, turn, self.board_confidence):
+			if self.tracker.last_move is not None:
+				print("Saw move:", self.tracker.last_move)
+		else:
+			print("Couldn't tell what move was made, re-reading the whole board")
+		return self.tracker.board.copy()
+
+	def detect_frame(self, turn: chess.Color, fresh=False) -> Dict[str, Any]:
+		"""
+		Detect the board in a single frame, either by fetching an image and running the Detector on
+		it, or (with remote_detection) by having the Vision Service do it for us. Returns the
+		detection summary (see Detector.detect_summary), even if the board wasn't found.
+
+		If fresh is set, the frame is guaranteed to be newly captured rather than a cached one.
+		"""
+		if self.remote_detection:
+			print("Fetching detections...")
+			detections = fetch_detections(raise_on_error=False, **({ 'max_age': 0 } if fresh else {}))
+			print(f"Got detections! (took {detections['detect_time'] * 1000:.0f}ms on the Pi)")
+			return detections
+
+		print("Fetching image...")
+		start = perf_counter()
+		img = self.get_image(fresh=fresh)
+		fetch_time = perf_counter() - start
+		print("Got image!")
+
+		print("Analyzing Image...")
+		start = perf_counter()
+		detections = self.detector.detect_summary(img)
+		detect_time = perf_counter() - start
+
+		if self.recorder is not None:
+			board = None
+			if detections['ok']:
+				positions = [(piece['square'], piece['tag_id']) for piece in detections['pieces']]
+				board = self.detector.generate_board(positions, turn=turn)
+			self.recorder.append(img, {
+				'state': self.state.name,
+				'turn': chess.COLOR_NAMES[turn],
+				'autoplay': self.autoplay,
+				'fetch_time': fetch_time,
+				'detect_time': detect_time,
+				'detections': detections,
+				'board': board.fen() if board is not None else None,
+			})
+
+		return detections
+
+	def get_image(self, retry=5, fresh=False):
 		"""
 		Fetch an image from the Grandmaster Vision Service (Raspberry Pi). Because the Vision
 		Service is often flakey, this method automatically retries if nessecary.
+
+		If fresh is set, the Vision Service won't reuse a frame it already had.
 		"""
 		try:
-			r = requests.get('http://grandmaster.local:5555/camera.png', stream=True).raw
-			return cv2.imdecode(np.asarray(bytearray(r.read()), dtype='uint8'), cv2.IMREAD_COLOR)
+			if self.replay is not None:
+				return self.replay.next_frame()
+			if self.image_stream is not None:
+				img, _ = self.image_stream.latest_frame(newer_than=time())
+				return img
+			return fetch_image(self.image_encoding, grayscale=self.grayscale, **({ 'max_age': 0 } if fresh else {}))
 		except Exception as err:
 			if retry > 0:
 				print(f"Failed to fetch image, retrying {retry} more times in 3 seconds!", err)
 				sleep(3)
-				return self.get_image(retry - 1)
+				return self.get_image(retry - 1, fresh)
 			else:
 				raise
@@ -0,0 +1,163 @@
+"""
+How long the gantry takes to physically make a move.
+
+The gantry firmware (see arduino/gantry/gantry.ino) moves both axes together, so they start and
+stop at the same time: a trip takes as long as the longer of the two axes, with a trapezoidal speed
+profile (accelerate, cruise, decelerate). GantryModel predicts trip times from that profile, scaled
+and offset to match timings measured on the real gantry (see the bottom of this file), since there
+is also serial latency, the firmware only reporting its position every so often, etc.
+"""
+from typing import *
+import json
+import numpy as np
+from math import sqrt
+from os.path import join, dirname
+
+GANTRY_MODEL_FILE = join(dirname(__file__), 'gantry_model.json')
+""" Where the Game Controller looks for a fitted model. """
+
+Position = Tuple[float, float]
+"""
+A gantry position: (file, rank), with files 8-9 being the graveyard. Halves are between squares
+(see ArduinoManager.run_trajectory).
+"""
+
+class GantryModel:
+	"""
+	Predicts how long gantry trips take (see the top of this file). Use fit to match it to the real
+	gantry, and read/write to save it.
+	"""
+	JSON_TYPE = 'gantry_model'
+
+	# The firmware's constants (see gantry.ino)
+	steps_per_square: int = 255
+	speed: float = 200
+	""" In steps per second. """
+	acceleration: float = 100
+	""" In steps per second per second. """
+
+	scale: float = 1.0
+	""" How much longer than the speed profile predicts trips actually take. """
+
+	overhead: float = 0.2
+	""" How long every trip takes on top of that, in seconds. """
+
+	magnet_time: float = 0.1
+	"""
+	How long turning the electromagnet on or off takes, in seconds (including, in a trajectory,
+	letting the gantry know it's done).
+	"""
+
+	def __init__(self, scale=1.0, overhead=0.2, magnet_time=0.1):
+		self.scale = scale
+		self.overhead = overhead
+		self.magnet_time = magnet_time
+
+	def write(self, file):
+		with open(file, 'w') as f:
+			json.dump({
+				'type': self.JSON_TYPE,
+				'scale': self.scale,
+				'overhead': self.overhead,
+				'magnet_time': self.magnet_time,
+			}, f)
+
+	@classmethod
+	def read(cls, file):
+		with open(file, 'r') as f:
+			data = json.load(f)
+			assert data['type'] == cls.JSON_TYPE
+			return cls(data['scale'], data['overhead'], data['magnet_time'])
+
+	def profile_time(self, squares: float) -> float:
+		"""
+		How long the firmware's speed profile takes to cover a distance (in squares, along the longer
+		axis), ignoring everything else.
+		"""
+		steps = squares * self.steps_per_square
+		# Far enough to get up to full speed (and back down again)
+		if steps >= self.speed ** 2 / self.acceleration:
+			return steps / self.speed + self.speed / self.acceleration
+		# Never gets to full speed
+		return 2 * sqrt(steps / self.acceleration)
+
+	def travel_time(self, start: Position, end: Position) -> float:
+		"""
+		How long the gantry takes to get from start to end.
+		"""
+		return self.trip_time([start, end])
+
+	def trip_time(self, path: List[Position]) -> float:
+		"""
+		How long the gantry takes to go through every position on path without stopping (see
+		ArduinoManager.run_trajectory). Slowing down at corners is ignored.
+		"""
+		squares = sum(max(abs(b[0] - a[0]), abs(b[1] - a[1])) for a, b in zip(path, path[1:]))
+		if squares == 0:
+			return 0
+		return self.overhead + self.scale * self.profile_time(squares)
+
+	def transfers_time(self, start: Position, transfers: List[List[Position]]) -> float:
+		"""
+		How long the gantry takes to carry pieces along each of transfers (each a list of positions,
+		from where the piece is picked up to where it's put down), starting from start. It only stops
+		to pick up and put down pieces.
+		"""
+		total = 0
+		position = start
+		for path in transfers:
+			total += self.travel_time(position, path[0]) + self.trip_time(path) + 2 * self.magnet_time
+			position = path[-1]
+		return total
+
+	def fit(self, samples: List[Tuple[Position, Position, float]]):
+		"""
+		Fit scale and overhead to measured trips: (start, end, seconds it took).
+		"""
+		samples = [(start, end, seconds) for start, end, seconds in samples if start != end]
+		assert len(samples) >= 2, "need at least two trips to fit"
+		predicted = [self.profile_time(max(abs(end[0] - start[0]), abs(end[1] - start[1]))) for start, end, _ in samples]
+		measured = [seconds for _, _, seconds in samples]
+		self.scale, self.overhead = (float(value) for value in np.polyfit(predicted, measured, 1))
+
+if __name__ == '__main__':
+	"""
+	Time the real gantry making random trips (and toggling the electromagnet), then fit a model to
+	the timings and save it, for the Game Controller to use.
+
+	    python3 gantry_model.py             # 30 trips
+	    python3 gantry_model.py 100         # 100 trips
+	"""
+	import sys
+	import random
+	from time import perf_counter
+	from arduino_manager import ArduinoManager
+
+	trips = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+
+	arduino = ArduinoManager()
+	while not arduino.is_ready:
+		arduino.update()
+
+	samples = []
+	for i in range(trips):
+		start = arduino.gantry_pos
+		end = (random.randrange(8), random.randrange(8))
+		began = perf_counter()
+		arduino.move_gantry(*end)
+		samples.append((start, end, perf_counter() - began))
+		print(f"{start} -> {end}: {samples[-1][2]:.2f}s")
+
+	magnet_times = []
+	for enabled in (True, False) * 5:
+		began = perf_counter()
+		arduino.set_electromagnet(enabled)
+		magnet_times.append(perf_counter() - began)
+
+	model = GantryModel()
+	model.fit(samples)
+	model.magnet_time = float(np.median(magnet_times))
+	errors = [abs(model.travel_time(start, end) - seconds) for start, end, seconds in samples if start != end]
+	print(f"scale {model.scale:.3f}, overhead {model.overhead:.3f}s, electromagnet {model.magnet_time:.3f}s (mean error {np.mean(errors):.2f}s)")
+	model.write(GANTRY_MODEL_FILE)
+	print("Wrote", GANTRY_MODEL_FILE)
@@ -0,0 +1,85 @@
+"""
+Image encodings supported by the Grandmaster Vision Service (camserver.py), shared with the clients
+that decode them and the encoding benchmark.
+
+PNG is lossless but slow to encode on the Raspberry Pi and large on the wire. JPEG and WebP are much
+cheaper and, at high enough quality, don't affect Apriltag detection. Raw grayscale skips encoding
+entirely, which is the fastest option when the network isn't the bottleneck.
+"""
+from typing import *
+from dataclasses import dataclass
+import cv2
+import numpy as np
+
+@dataclass(frozen=True)
+class Encoding:
+	name: str
+	extension: str
+	content_type: str
+	quality_param: Optional[int] = None
+	""" The cv2.IMWRITE_* parameter that controls quality, if the format is lossy. """
+	default_quality: Optional[int] = None
+
+ENCODINGS: Dict[str, Encoding] = {encoding.name: encoding for encoding in [
+	Encoding('png', '.png', 'image/png'),
+	Encoding('jpg', '.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY, 90),
+	Encoding('webp', '.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY, 90),
+	Encoding('gray', '.gray', 'application/octet-stream'),
+]}
+
+RAW_WIDTH_HEADER = 'X-Image-Width'
+RAW_HEIGHT_HEADER = 'X-Image-Height'
+
+class EncodingError(Exception):
+	pass
+
+def encode_image(img, encoding: str, quality: Optional[int] = None, grayscale=False) -> Tuple[bytes, Dict[str, str]]:
+	"""
+	Encode an image in one of the ENCODINGS. Returns the encoded bytes and the HTTP headers to send
+	with them. If grayscale is set, color images are converted to a single channel first, which is
+	a third of the bytes for lossless encodings.
+
+	The 'gray' encoding is the raw single-channel pixels, with the dimensions in headers.
+	"""
+	if encoding not in ENCODINGS:
+		raise EncodingError(f"Unknown encoding: {encoding}")
+	enc = ENCODINGS[encoding]
+
+	if (grayscale or enc.name == 'gray') and img.ndim == 3:
+		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+	if enc.name == 'gray':
+		return np.ascontiguousarray(img).tobytes(), {
+			'Content-Type': enc.content_type,
+			RAW_WIDTH_HEADER: str(img.shape[1]),
+			RAW_HEIGHT_HEADER: str(img.shape[0]),
+		}
+
+	params = []
+	if enc.quality_param is not None:
+		params = [enc.quality_param, int(quality if quality is not None else enc.default_quality)]
+
+	success, buffer = cv2.imencode(enc.extension, img, params)
+	if not success:
+		raise EncodingError(f"Failed to encode image as {encoding}!")
+
+	return buffer.tobytes(), { 'Content-Type': enc.content_type }
+
+def decode_image(data: bytes, headers: Mapping[str, str] = {}, flags=cv2.IMREAD_COLOR):
+	"""
+	Decode an image produced by encode_image. The headers are only needed for raw grayscale. Pass
+	flags=cv2.IMREAD_GRAYSCALE to get a single-channel image (which, for JPEG, also skips decoding
+	the chroma entirely).
+	"""
+	if headers.get('Content-Type') == ENCODINGS['gray'].content_type:
+		width = int(headers[RAW_WIDTH_HEADER])
+		height = int(headers[RAW_HEIGHT_HEADER])
+		img = np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+		if flags == cv2.IMREAD_COLOR:
+			img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+		return img
+
+	img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+	if img is None:
+		raise EncodingError("Failed to decode image!")
+	return img
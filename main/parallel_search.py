@@ -0,0 +1,184 @@
+"""
+Searching on every core at once.
+
+A SearchEngine runs on one core (python-chess, and therefore the search, is pure Python), but the
+Game Controller's machine has several. ParallelSearchEngine uses them "Lazy SMP" style: a persistent
+pool of helper processes all search the same position at the same time as the main search, sharing
+a single transposition table in shared memory. There's no other coordination, but since every
+helper stores what it finds in the shared table, the main search finds much of its work already
+done (and the helpers, which start at staggered depths, sometimes finish a deeper iteration first).
+
+The shared table is a fixed-size array of (check, data) pairs of 64-bit integers, indexed by the low
+bits of the Zobrist key. It's read and written without locks; a torn write (ie. check and data from
+different writes) is detected because check is stored as key XOR data.
+
+Compare against the single-process search with benchmark_engine.py.
+"""
+from typing import *
+from time import time
+from multiprocessing import Pool, cpu_count, shared_memory
+import numpy as np
+import chess
+from engine import SearchEngine, SearchResult, TranspositionTable, MoveFilter
+
+_SCORE_OFFSET = 1 << 23
+""" Scores (which can be negative) are stored offset by this much, in the low 24 bits of data. """
+
+class SharedTranspositionTable(TranspositionTable):
+	"""
+	A TranspositionTable in shared memory. Create it in one process, then attach to it from others
+	by name. Holds at most one entry per slot: newer results for a different position (or deeper
+	ones for the same position) replace what's there.
+	"""
+	name: str
+	size: int
+
+	def __init__(self, size=1 << 20, name: Optional[str] = None):
+		assert size & (size - 1) == 0, "size must be a power of two"
+		self.size = size
+		self.max_entries = size
+		self._mask = size - 1
+		nbytes = 8 * (1 + 2 * size)
+		if name is None:
+			self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+			self._owner = True
+		else:
+			self._shm = _attach_shared_memory(name)
+			self._owner = False
+		self.name = self._shm.name
+		# The first word is the stop flag (see ParallelSearchEngine), then the table itself
+		self._flags = np.ndarray((1,), dtype=np.uint64, buffer=self._shm.buf)
+		self._table = np.ndarray((size, 2), dtype=np.uint64, buffer=self._shm.buf, offset=8)
+		if self._owner:
+			self._flags[0] = 0
+			self._table[:] = 0
+
+	def get(self, key: int) -> Optional[Tuple[int, int, int, int]]:
+		check, data = self._table[key & self._mask]
+		data = int(data)
+		if int(check) ^ data != key or data == 0:
+			return None
+		return (data >> 24) & 0xFF, (data & 0xFFFFFF) - _SCORE_OFFSET, (data >> 32) & 0x3, data >> 34
+
+	def put(self, key: int, depth: int, score: int, flag: int, move: int):
+		slot = self._table[key & self._mask]
+		existing = int(slot[1])
+		if int(slot[0]) ^ existing == key and (existing >> 24) & 0xFF > depth:
+			return
+		data = (score + _SCORE_OFFSET) | (min(depth, 0xFF) << 24) | (flag << 32) | (move << 34)
+		slot[0] = key ^ data
+		slot[1] = data
+
+	def clear(self):
+		self._table[:] = 0
+
+	def __len__(self):
+		return int(np.count_nonzero(self._table[:, 1]))
+
+	@property
+	def stopped(self) -> bool:
+		return self._flags[0] != 0
+
+	@stopped.setter
+	def stopped(self, stopped: bool):
+		self._flags[0] = 1 if stopped else 0
+
+	def close(self):
+		"""
+		Detach from the shared memory (and free it, if this is the process that created it).
+		"""
+		del self._flags, self._table
+		self._shm.close()
+		if self._owner:
+			self._shm.unlink()
+
+class ParallelSearchEngine(SearchEngine):
+	"""
+	A SearchEngine that searches with helper processes as well (see the top of this file). Works
+	exactly like SearchEngine otherwise. Call close when you're done with it.
+	"""
+	processes: int
+	""" Total number of processes searching, including this one. """
+
+	table: SharedTranspositionTable
+
+	def __init__(self, processes: Optional[int] = None, table_size=1 << 20):
+		self.processes = processes or cpu_count()
+		self.table = SharedTranspositionTable(table_size)
+		self._pool = None
+
+	def search(self, board: chess.Board, time_limit: float, max_depth: Optional[int] = None, move_filter: Optional[MoveFilter] = None,
+			on_iteration: Optional[Callable[[SearchResult], None]] = None, start_depth=1, stop: Optional[Callable[[], bool]] = None) -> SearchResult:
+		moves = self.root_moves(board, move_filter)
+		if len(moves) <= 1 or self.processes <= 1:
+			return super().search(board, time_limit, max_depth, move_filter, on_iteration, start_depth, stop)
+
+		# Helpers are given the root moves (and their costs) rather than move_filter and move_cost,
+		# which might not be picklable
+		allowed = set(moves)
+		root_costs = { move.uci(): self.move_cost(board, move) if self.move_cost is not None else 0 for move in moves }
+		pool = self._get_pool()
+		deadline = time() + time_limit
+		self.table.stopped = False
+		helpers = [
+			# Stagger the depths the helpers start at so they don't all do exactly the same work
+			pool.apply_async(_search_in_worker, (board, deadline, max_depth, root_costs, start_depth + 1 + i % 2))
+			for i in range(self.processes - 1)
+		]
+
+		try:
+			result = super().search(
+				board, time_limit, max_depth, lambda board, move: move in allowed, on_iteration, start_depth,
+				lambda: self.table.stopped or (stop is not None and stop()))
+		finally:
+			# Once we've decided, the helpers are just wasting time
+			self.table.stopped = True
+			helper_results = [helper.get() for helper in helpers]
+
+		# A helper may have finished a deeper iteration than we did
+		best = max([result] + helper_results, key=lambda result: result.depth)
+		if best is not result:
+			best = SearchResult(best.move, best.score, best.depth, 0, result.time, best.pv)
+		best.nodes = result.nodes + sum(helper.nodes for helper in helper_results)
+		self.last_result = best
+		return best
+
+	def close(self):
+		"""
+		Shut down the helper processes and free the shared transposition table.
+		"""
+		if self._pool is not None:
+			self._pool.terminate()
+			self._pool.join()
+			self._pool = None
+		self.table.close()
+
+	def _get_pool(self) -> Pool:
+		if self._pool is None:
+			self._pool = Pool(self.processes - 1, initializer=_init_worker, initargs=(self.table.name, self.table.size))
+		return self._pool
+
+# Each helper process's engine, searching with the shared table (see ParallelSearchEngine)
+_worker_engine: Optional[SearchEngine] = None
+
+def _init_worker(table_name: str, table_size: int):
+	global _worker_engine
+	_worker_engine = SearchEngine()
+	_worker_engine.table = SharedTranspositionTable(table_size, name=table_name)
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+	# The table is created before the pool, so the helpers share our resource tracker, and attaching
+	# just registers the memory with it a second time (which is harmless). Unlike in
+	# detector._attach_shared_memory, unregistering it here would unregister it for us too.
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		return shared_memory.SharedMemory(name=name)
+
+def _search_in_worker(board: chess.Board, deadline: float, max_depth: Optional[int], root_costs: Dict[str, int], start_depth: int) -> SearchResult:
+	table = _worker_engine.table
+	allowed = {chess.Move.from_uci(uci) for uci in root_costs}
+	_worker_engine.move_cost = lambda board, move: root_costs[move.uci()]
+	return _worker_engine.search(
+		board, max(deadline - time(), 0), max_depth, lambda board, move: move in allowed,
+		start_depth=start_depth, stop=lambda: table.stopped)
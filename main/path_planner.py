@@ -0,0 +1,197 @@
+"""
+Planning how the gantry drags pieces around without knocking into other pieces.
+
+The electromagnet drags a piece in a straight line from one gantry position to the next, so a piece
+can't simply go straight to its destination if something's in the way (ex. most knight moves), and
+captured pieces have to be cleared off to the graveyard (files 8-9, beside the board) first.
+
+PathPlanner finds the quickest path with A* over a grid of gantry positions covering the board and
+the graveyard. A carried piece may pass between two others (ex. diagonally, between the corners of
+squares), but not over one. Since the gantry slows down at every waypoint, changing direction costs
+extra, so paths are as straight as they can be.
+"""
+from typing import *
+import heapq
+import chess
+from math import floor, ceil, hypot
+from functools import lru_cache
+from gantry_model import Position
+
+GRAVEYARD_FILES = (8, 9)
+""" The files of the graveyard, where captured pieces go. """
+
+FILES = 10
+""" Including the graveyard. """
+
+RANKS = 8
+
+GRAVEYARD = [(file, rank) for file in GRAVEYARD_FILES for rank in range(RANKS)]
+""" Every slot in the graveyard. """
+
+_DIRECTIONS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+
+def square_position(square: chess.Square) -> Position:
+	""" The gantry position of a square. """
+	return chess.square_file(square), chess.square_rank(square)
+
+class PathPlanner:
+	"""
+	Plans paths for carrying pieces (see plan), and for all the pieces a move involves (see
+	plan_move). Plans are cached, since the same ones come up again and again (ex. castling, or
+	the same move being considered in search after search).
+	"""
+	subdivisions: int
+	"""
+	How many waypoints there are per square along each axis. With 1, the gantry only ever stops on
+	square centers, so it can't get pieces around others (ex. knights, or castling). With 2, it can
+	also stop between squares.
+	"""
+
+	piece_radius: float = 0.225
+	"""
+	The radius (in squares) of the widest pieces' bases: 0.9in across, on 2in squares (pawns are
+	only 0.75in). See docs/Mechanical.html.
+	"""
+
+	clearance_margin: float = 0.025
+	""" How big a gap (in squares) to always leave between the bases of the carried piece and others. """
+
+	turn_cost: float = 0.5
+	""" How much (in squares travelled) each extra waypoint costs, since the gantry slows down at each. """
+
+	def __init__(self, subdivisions=2, cache_size=4096):
+		self.subdivisions = subdivisions
+		self._cached_plan = lru_cache(maxsize=cache_size)(self._plan)
+
+	@property
+	def clearance(self) -> float:
+		"""
+		How close (in squares) the center of a carried piece may come to the center of another piece.
+		Just enough to pass between two pieces on neighboring squares (0.5 squares from each), which
+		is what the pieces were sized for.
+		"""
+		return 2 * self.piece_radius + self.clearance_margin
+
+
+	def plan(self, start: Position, end: Position, occupied: Iterable[Position]) -> Optional[List[Position]]:
+		"""
+		The quickest path for carrying a piece from start to end, without passing over any of the
+		occupied positions (square centers). The path is a list of gantry positions, including start
+		and end, with a waypoint only where it changes direction. Returns None if there's no way.
+		"""
+		return self._cached_plan(start, end, frozenset(occupied) - { start })
+
+	def plan_move(self, board: chess.Board, move: chess.Move, graveyard: Collection[Position] = ()) -> Optional[List[List[Position]]]:
+		"""
+		Plan all the pieces the gantry has to carry to make a move on board, given which graveyard
+		slots are already taken, in order: a captured piece to the graveyard, the piece that moves,
+		and the rook when castling. Returns None if any of them can't be done.
+		"""
+		occupied = { square_position(square) for square in chess.SQUARES if board.piece_type_at(square) is not None }
+		occupied.update(graveyard)
+		transfers = []
+
+		if board.is_capture(move):
+			captured = move.to_square
+			if board.is_en_passant(move):
+				captured = chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))
+			start = square_position(captured)
+			occupied.discard(start)
+			# The nearest free slot we can get to
+			for slot in sorted(set(GRAVEYARD) - occupied, key=lambda slot: _distance(start, slot)):
+				path = self.plan(start, slot, occupied)
+				if path is not None:
+					break
+			else:
+				return None
+			transfers.append(path)
+			occupied.add(slot)
+
+		carries = [(square_position(move.from_square), square_position(move.to_square))]
+		if board.is_castling(move):
+			rank = chess.square_rank(move.from_square)
+			rook_files = (7, 5) if board.is_kingside_castling(move) else (0, 3)
+			carries.append(((rook_files[0], rank), (rook_files[1], rank)))
+
+		for start, end in carries:
+			path = self.plan(start, end, occupied)
+			if path is None:
+				return None
+			occupied.discard(start)
+			occupied.add(end)
+			transfers.append(path)
+		return transfers
+
+	def _plan(self, start: Position, end: Position, occupied: FrozenSet[Position]) -> Optional[List[Position]]:
+		if end in occupied:
+			return None
+		n = self.subdivisions
+		start_node = (round(start[0] * n), round(start[1] * n))
+		end_node = (round(end[0] * n), round(end[1] * n))
+		max_x, max_y = (FILES - 1) * n, (RANKS - 1) * n
+
+		def heuristic(node):
+			return max(abs(end_node[0] - node[0]), abs(end_node[1] - node[1])) / n
+
+		# States are (node, direction arrived from), since turning costs extra
+		best_cost = { (start_node, None): 0 }
+		came_from = {}
+		queue = [(heuristic(start_node), 0, start_node, None)]
+		while len(queue) > 0:
+			_, cost, node, direction = heapq.heappop(queue)
+			if node == end_node:
+				return self._waypoints(came_from, (node, direction))
+			if cost > best_cost[(node, direction)]:
+				continue
+			for step in _DIRECTIONS:
+				next_node = (node[0] + step[0], node[1] + step[1])
+				if not (0 <= next_node[0] <= max_x and 0 <= next_node[1] <= max_y):
+					continue
+				if not self._is_clear(node, next_node, occupied):
+					continue
+				next_cost = cost + 1 / n + (self.turn_cost if direction is not None and step != direction else 0)
+				state = (next_node, step)
+				if next_cost < best_cost.get(state, float('inf')):
+					best_cost[state] = next_cost
+					came_from[state] = (node, direction)
+					heapq.heappush(queue, (next_cost + heuristic(next_node), next_cost, next_node, step))
+		return None
+
+	def _is_clear(self, a: Tuple[int, int], b: Tuple[int, int], occupied: FrozenSet[Position]) -> bool:
+		"""
+		Whether a piece can be carried in a straight line between two (neighboring) nodes.
+		"""
+		n = self.subdivisions
+		clearance = self.clearance
+		ax, ay, bx, by = a[0] / n, a[1] / n, b[0] / n, b[1] / n
+		for file in range(floor(min(ax, bx) - clearance), ceil(max(ax, bx) + clearance) + 1):
+			for rank in range(floor(min(ay, by) - clearance), ceil(max(ay, by) + clearance) + 1):
+				if (file, rank) in occupied and _segment_distance((file, rank), (ax, ay), (bx, by)) < clearance:
+					return False
+		return True
+
+	def _waypoints(self, came_from: Dict, state) -> List[Position]:
+		"""
+		Follow came_from back from state to the start, keeping only the nodes where the direction
+		changes (and the ends), as gantry positions.
+		"""
+		n = self.subdivisions
+		nodes = [state[0]]
+		later_direction = state[1]
+		state = came_from.get(state)
+		while state is not None:
+			node, direction = state
+			if direction != later_direction:
+				nodes.append(node)
+			later_direction = direction
+			state = came_from.get(state)
+		return [(x // n if x % n == 0 else x / n, y // n if y % n == 0 else y / n) for x, y in reversed(nodes)]
+
+def _distance(a: Position, b: Position) -> float:
+	return hypot(b[0] - a[0], b[1] - a[1])
+
+def _segment_distance(point: Position, a: Position, b: Position) -> float:
+	""" The distance from point to the line segment from a to b. """
+	dx, dy = b[0] - a[0], b[1] - a[1]
+	t = max(0, min(1, ((point[0] - a[0]) * dx + (point[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+	return hypot(point[0] - a[0] - t * dx, point[1] - a[1] - t * dy)
@@ -0,0 +1,97 @@
+"""
+Thinking on the human's time.
+
+While the human is deciding on their move, the computer would otherwise sit idle. A Ponderer uses
+that time to work out, in a background thread, how it would answer each of the human's most likely
+moves. When the human presses the button and the board matches one of those positions, the answer is
+ready immediately instead of after a full search.
+"""
+from typing import *
+from threading import Thread, Event, Lock
+import chess
+from engine import SearchEngine, SearchResult, MoveFilter, evaluate, zobrist_key
+
+class Ponderer:
+	"""
+	Searches the positions after the human's likely replies in the background (see start), and
+	remembers the best answer to each (see lookup).
+	"""
+	engine: SearchEngine
+	""" Used only by the pondering thread. Share its table with the main engine's for extra benefit. """
+
+	max_replies: int = 8
+	""" How many of the human's possible replies to think about, most likely first. """
+
+	def __init__(self, engine: Optional[SearchEngine] = None):
+		self.engine = engine or SearchEngine()
+		self._answers: Dict[int, SearchResult] = {}
+		self._lock = Lock()
+		self._stop = Event()
+		self._thread: Optional[Thread] = None
+
+	def start(self, board: chess.Board, time_limit: float, move_filter: Optional[MoveFilter] = None, expected_reply: Optional[chess.Move] = None):
+		"""
+		Start pondering the position on board (with the human to move), giving each answer time_limit
+		seconds, like a normal turn. Answers from any previous pondering are forgotten.
+
+		If we already have an idea what the human will play (ex. from the principal variation of our
+		last search), pass it as expected_reply so it's considered first.
+		"""
+		self.stop()
+		with self._lock:
+			self._answers = {}
+		self._stop.clear()
+		self._thread = Thread(
+			target=self._ponder, args=(board.copy(), time_limit, move_filter, expected_reply), name='ponder', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		"""
+		Stop pondering (if we are), and wait for the thread to finish. Answers found so far are kept.
+		"""
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def lookup(self, board: chess.Board) -> Optional[SearchResult]:
+		"""
+		The answer we came up with for this position, if we thought about it.
+		"""
+		with self._lock:
+			return self._answers.get(zobrist_key(board))
+
+	@property
+	def answers(self) -> int:
+		""" How many positions we have an answer for. """
+		with self._lock:
+			return len(self._answers)
+
+	def _ponder(self, board: chess.Board, time_limit: float, move_filter: Optional[MoveFilter], expected_reply: Optional[chess.Move]):
+		for reply in self._likely_replies(board, expected_reply)[:self.max_replies]:
+			after = board.copy()
+			after.push(reply)
+			if after.is_game_over():
+				continue
+
+			result = self.engine.search(after, time_limit, move_filter=move_filter, stop=self._stop.is_set)
+			# An interrupted search isn't as good as a real one, so don't pretend it is
+			if self._stop.is_set():
+				return
+			with self._lock:
+				self._answers[zobrist_key(after)] = result
+
+	def _likely_replies(self, board: chess.Board, expected_reply: Optional[chess.Move]) -> List[chess.Move]:
+		"""
+		The human's legal moves, most likely first: the expected reply, then by how good the position
+		looks (to them) right after.
+		"""
+		def score(move: chess.Move) -> int:
+			if move == expected_reply:
+				return 1_000_000
+			board.push(move)
+			value = -evaluate(board)
+			board.pop()
+			return value
+
+		return sorted(board.legal_moves, key=score, reverse=True)
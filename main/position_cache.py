@@ -0,0 +1,224 @@
+"""
+Remembering the moves we've already worked out, so we don't have to search for them again.
+
+There are two layers, both keyed by (polyglot-compatible) Zobrist hash (see engine.zobrist_key):
+
+- A PositionBook: a read-only file of precomputed moves, built offline (see the bottom of this file)
+  for the common openings and for every position in our recordings (see recording.py).
+- An in-memory cache of whatever the engine found during live play, which forgets the least
+  recently used positions once it's full.
+
+The book file is a sorted array of fixed-size BOOK_DTYPE records with no header. It's memory-mapped
+rather than loaded, so opening even a big book is instant and a lookup (a binary search over the
+keys) only touches a handful of pages.
+"""
+from typing import *
+import os
+import numpy as np
+import chess
+from collections import OrderedDict
+from os.path import join, dirname
+from engine import SearchResult, zobrist_key, encode_move, decode_move
+
+BOOK_FILE = join(dirname(__file__), 'book.bin')
+""" Where the Game Controller looks for a book. """
+
+BOOK_DTYPE = np.dtype([
+	('key', '<u8'),
+	('move', '<u2'),
+	('depth', '<u2'),
+	('score', '<i4'),
+])
+
+class PositionBook:
+	"""
+	Read-only, memory-mapped access to a book of precomputed moves.
+	"""
+	path: str
+	entries: np.ndarray
+
+	def __init__(self, path: str):
+		self.path = path
+		# np.memmap can't map empty files
+		if os.path.getsize(path) == 0:
+			self.entries = np.zeros(0, dtype=BOOK_DTYPE)
+		else:
+			self.entries = np.memmap(path, dtype=BOOK_DTYPE, mode='r')
+		self._keys = self.entries['key']
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key: int) -> Optional[SearchResult]:
+		i = int(np.searchsorted(self._keys, np.uint64(key)))
+		if i == len(self._keys) or int(self._keys[i]) != key:
+			return None
+		entry = self.entries[i]
+		move = decode_move(int(entry['move']))
+		return SearchResult(move, int(entry['score']), int(entry['depth']), pv=[move])
+
+	def lookup(self, board: chess.Board) -> Optional[SearchResult]:
+		"""
+		The book's move for this position, if it has one.
+		"""
+		return self.get(zobrist_key(board))
+
+def write_book(path: str, results: Dict[int, SearchResult]):
+	"""
+	Write a book (see PositionBook) of the moves in results, keyed by Zobrist hash.
+	"""
+	entries = np.zeros(len(results), dtype=BOOK_DTYPE)
+	for i, (key, result) in enumerate(results.items()):
+		entries[i] = (key, encode_move(result.move), result.depth, result.score)
+	entries.sort(order='key')
+	with open(path, 'wb') as f:
+		f.write(entries.tobytes())
+
+class PositionCache:
+	"""
+	Looks positions up in the book (if there is one), then in the moves found during live play.
+	"""
+	book: Optional[PositionBook]
+
+	max_entries: int
+	""" How many positions from live play to remember before forgetting the least recently used. """
+
+	def __init__(self, book: Optional[PositionBook] = None, max_entries=10_000):
+		self.book = book
+		self.max_entries = max_entries
+		self._recent: 'OrderedDict[int, SearchResult]' = OrderedDict()
+
+	def __len__(self):
+		return len(self._recent)
+
+	def lookup(self, board: chess.Board) -> Optional[SearchResult]:
+		key = zobrist_key(board)
+		result = self._recent.get(key)
+		if result is not None:
+			self._recent.move_to_end(key)
+			return result
+		return self.book.get(key) if self.book is not None else None
+
+	def put(self, board: chess.Board, result: SearchResult):
+		"""
+		Remember the result of searching board.
+		"""
+		if result.move is None:
+			return
+		key = zobrist_key(board)
+		self._recent[key] = result
+		self._recent.move_to_end(key)
+		while len(self._recent) > self.max_entries:
+			self._recent.popitem(last=False)
+
+	def clear(self):
+		""" Forget everything from live play (but not the book). """
+		self._recent.clear()
+
+# The lines the builder precomputes, in UCI. Every position along each of them goes in the book.
+OPENINGS = [
+	('Italian game', 'e2e4 e7e5 g1f3 b8c6 f1c4 f8c5 c2c3 g8f6 d2d3 d7d6'),
+	('Two knights defense', 'e2e4 e7e5 g1f3 b8c6 f1c4 g8f6 d2d3 f8e7 e1g1 e8g8'),
+	('Ruy Lopez', 'e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 a4b3 d7d6'),
+	('Scotch game', 'e2e4 e7e5 g1f3 b8c6 d2d4 e5d4 f3d4 g8f6 d4c6 b7c6'),
+	('Petrov defense', 'e2e4 e7e5 g1f3 g8f6 f3e5 d7d6 e5f3 f6e4 d2d4 d6d5'),
+	('Sicilian defense', 'e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6'),
+	('Sicilian, closed', 'e2e4 c7c5 b1c3 b8c6 g2g3 g7g6 f1g2 f8g7 d2d3 d7d6'),
+	('French defense', 'e2e4 e7e6 d2d4 d7d5 b1c3 g8f6 c1g5 f8e7 e4e5 f6d7'),
+	('Caro-Kann defense', 'e2e4 c7c6 d2d4 d7d5 b1c3 d5e4 c3e4 c8f5 e4g3 f5g6'),
+	('Scandinavian defense', 'e2e4 d7d5 e4d5 d8d5 b1c3 d5a5 d2d4 g8f6 g1f3 c8f5'),
+	('Pirc defense', 'e2e4 d7d6 d2d4 g8f6 b1c3 g7g6 g1f3 f8g7 f1e2 e8g8'),
+	("Queen's gambit declined", 'd2d4 d7d5 c2c4 e7e6 b1c3 g8f6 c1g5 f8e7 e2e3 e8g8'),
+	("Queen's gambit accepted", 'd2d4 d7d5 c2c4 d5c4 g1f3 g8f6 e2e3 e7e6 f1c4 c7c5'),
+	('Slav defense', 'd2d4 d7d5 c2c4 c7c6 g1f3 g8f6 b1c3 d5c4 a2a4 c8f5'),
+	("King's Indian defense", 'd2d4 g8f6 c2c4 g7g6 b1c3 f8g7 e2e4 d7d6 g1f3 e8g8'),
+	('Nimzo-Indian defense', 'd2d4 g8f6 c2c4 e7e6 b1c3 f8b4 e2e3 e8g8 f1d3 d7d5'),
+	('London system', 'd2d4 d7d5 c1f4 g8f6 e2e3 e7e6 g1f3 c7c5 c2c3 b8c6'),
+	('English opening', 'c2c4 e7e5 b1c3 g8f6 g1f3 b8c6 g2g3 d7d5 c4d5 f6d5'),
+	('Reti opening', 'g1f3 d7d5 g2g3 g8f6 f1g2 e7e6 e1g1 f8e7 d2d3 e8g8'),
+	("King's pawn, other replies", 'e2e4 a7a6'),
+	("Queen's pawn, other replies", 'd2d4 e7e6'),
+]
+
+def opening_positions(max_plies: Optional[int] = None) -> Iterator[chess.Board]:
+	"""
+	Every position along the OPENINGS (up to max_plies into each), plus every position one move
+	away from the starting position, since the human could open with anything.
+	"""
+	board = chess.Board()
+	yield board.copy()
+	for move in board.legal_moves:
+		board.push(move)
+		yield board.copy()
+		board.pop()
+
+	for _, line in OPENINGS:
+		board = chess.Board()
+		for uci in line.split()[:max_plies]:
+			board.push_uci(uci)
+			yield board.copy()
+
+def recorded_positions(path: str) -> Iterator[chess.Board]:
+	"""
+	Every board the Game Controller saw in a recording (see GameController.recorder).
+	"""
+	from recording import Recording
+	recording = Recording(path)
+	try:
+		for i in range(len(recording)):
+			fen = recording.metadata(i).get('board')
+			if fen is not None:
+				yield chess.Board(fen)
+	finally:
+		recording.close()
+
+if __name__ == '__main__':
+	"""
+	Build a book, by searching every position along the common openings and in any recordings given.
+
+	    python3 position_cache.py                          # Write book.bin (see BOOK_FILE)
+	    python3 position_cache.py path/to/recording ...   # Also include every board from recordings
+	    python3 position_cache.py --depth 6                # Search each position this deep
+	    python3 position_cache.py --plies 8                # Only go this many moves into each opening
+	    python3 position_cache.py --output other.bin       # Write the book somewhere else
+
+	Moves in the book aren't restricted to ones the gantry can make. The Game Controller searches as
+	usual when the book's move isn't one it can make.
+	"""
+	import sys
+	from time import perf_counter
+	from engine import SearchEngine
+
+	args = sys.argv[1:]
+
+	def pop_option(name: str) -> Optional[str]:
+		if name not in args:
+			return None
+		value = args[args.index(name) + 1]
+		args.remove(name)
+		args.remove(value)
+		return value
+
+	output = pop_option('--output') or BOOK_FILE
+	depth = int(pop_option('--depth') or 5)
+	plies = pop_option('--plies')
+	max_plies = int(plies) if plies is not None else None
+
+	boards = list(opening_positions(max_plies))
+	for path in args:
+		boards.extend(recorded_positions(path))
+
+	engine = SearchEngine()
+	results: Dict[int, SearchResult] = {}
+	start = perf_counter()
+	for board in boards:
+		key = zobrist_key(board)
+		if key in results or not board.is_valid() or board.is_game_over():
+			continue
+		result = engine.search(board, time_limit=3600, max_depth=depth)
+		if result.move is not None:
+			results[key] = result
+			print(f"{len(results):>5} {board.fen():<72} {board.san(result.move):>7} ({result.score})")
+
+	write_book(output, results)
+	print(f"Wrote {len(results)} positions to {output} in {perf_counter() - start:.0f}s")
@@ -0,0 +1,189 @@
+"""
+Recording and replaying the frames the Game Controller sees, so misdetections can be reproduced (and
+regression tested) after the fact.
+
+A recording is a directory with three append-only files:
+
+- frames.bin: the raw pixels of every frame (uint8), one after the other, with no header.
+- index.bin: one fixed-size INDEX_DTYPE record per frame (where its pixels are in frames.bin, its
+  shape and when it was captured).
+- metadata.jsonl: one JSON object per frame, with whatever the recorder wanted to store alongside it
+  (ex. detections, the board it produced, timings and what turn it was).
+
+Both binary files are memory-mapped when reading, so even very long sessions replay at disk speed
+without being loaded into RAM, and frames are returned as zero-copy views.
+"""
+from typing import *
+import os
+import json
+import numpy as np
+from time import time
+from os.path import join, exists
+
+FRAMES_FILE = 'frames.bin'
+INDEX_FILE = 'index.bin'
+METADATA_FILE = 'metadata.jsonl'
+
+INDEX_DTYPE = np.dtype([
+	('offset', '<u8'),
+	('height', '<u4'),
+	('width', '<u4'),
+	('channels', '<u4'),
+	('time', '<f8'),
+])
+
+class RecordingWriter:
+	"""
+	Append frames to a recording, creating it if it doesn't exist yet. Every append is flushed
+	immediately, so nothing is lost if the Game Controller crashes.
+	"""
+	path: str
+
+	def __init__(self, path: str):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		self._frames = open(join(path, FRAMES_FILE), 'ab')
+		self._index = open(join(path, INDEX_FILE), 'ab')
+		self._metadata = open(join(path, METADATA_FILE), 'a')
+
+	def append(self, frame: np.ndarray, metadata: Dict[str, Any] = {}, frame_time: Optional[float] = None):
+		"""
+		Add a frame (grayscale or color) to the end of the recording, along with any JSON-serializable
+		metadata.
+		"""
+		frame = np.ascontiguousarray(frame, dtype=np.uint8)
+		height, width = frame.shape[:2]
+		channels = frame.shape[2] if frame.ndim == 3 else 1
+
+		record = np.zeros(1, dtype=INDEX_DTYPE)
+		record['offset'] = self._frames.seek(0, os.SEEK_END)
+		record['height'] = height
+		record['width'] = width
+		record['channels'] = channels
+		record['time'] = frame_time if frame_time is not None else time()
+
+		self._frames.write(frame.tobytes())
+		self._index.write(record.tobytes())
+		self._metadata.write(json.dumps(metadata) + '\n')
+
+		for f in (self._frames, self._index, self._metadata):
+			f.flush()
+
+	def close(self):
+		for f in (self._frames, self._index, self._metadata):
+			f.close()
+
+class Recording:
+	"""
+	Read-only, memory-mapped access to a recording. Indexable and iterable: each item is a
+	(frame, metadata) tuple.
+	"""
+	path: str
+	index: np.ndarray
+
+	def __init__(self, path: str):
+		self.path = path
+		if not exists(join(path, INDEX_FILE)):
+			raise FileNotFoundError(f"Not a recording: {path}")
+
+		self.index = self._map(INDEX_FILE, INDEX_DTYPE)
+		self.frames = self._map(FRAMES_FILE, np.uint8)
+
+		self._metadata_file = open(join(path, METADATA_FILE), 'rb')
+		self._metadata_offsets = None
+
+	def __len__(self):
+		return len(self.index)
+
+	def __getitem__(self, i: int) -> Tuple[np.ndarray, Dict[str, Any]]:
+		return self.frame(i), self.metadata(i)
+
+	def __iter__(self) -> Iterator[Tuple[np.ndarray, Dict[str, Any]]]:
+		for i in range(len(self)):
+			yield self[i]
+
+	def frame(self, i: int) -> np.ndarray:
+		"""
+		Get a frame as a read-only view into the memory-mapped file (no copy).
+		"""
+		record = self.index[i]
+		height, width, channels = int(record['height']), int(record['width']), int(record['channels'])
+		size = height * width * channels
+		offset = int(record['offset'])
+		frame = self.frames[offset:offset + size]
+		return frame.reshape((height, width, channels) if channels > 1 else (height, width))
+
+	def frame_time(self, i: int) -> float:
+		return float(self.index[i]['time'])
+
+	def metadata(self, i: int) -> Dict[str, Any]:
+		"""
+		Get the metadata stored with a frame. Only the offsets of each line are kept in memory.
+		"""
+		if self._metadata_offsets is None:
+			self._metadata_file.seek(0)
+			offsets = [0]
+			for line in self._metadata_file:
+				offsets.append(offsets[-1] + len(line))
+			self._metadata_offsets = offsets
+		self._metadata_file.seek(self._metadata_offsets[i])
+		return json.loads(self._metadata_file.readline())
+
+	def close(self):
+		self._metadata_file.close()
+
+	def _map(self, file: str, dtype) -> np.ndarray:
+		path = join(self.path, file)
+		# np.memmap can't map empty files
+		if os.path.getsize(path) == 0:
+			return np.zeros(0, dtype=dtype)
+		return np.memmap(path, dtype=dtype, mode='r')
+
+class ReplaySource:
+	"""
+	Plays a recording back one frame at a time, standing in for the Vision Service (see
+	GameController.replay). Loops back to the beginning once it runs out, if loop is set.
+	"""
+	recording: Recording
+	position: int = 0
+
+	def __init__(self, recording: Union[Recording, str], loop=False):
+		self.recording = recording if isinstance(recording, Recording) else Recording(recording)
+		self.loop = loop
+
+	def next_frame(self) -> np.ndarray:
+		if self.position >= len(self.recording):
+			if not self.loop or len(self.recording) == 0:
+				raise EOFError("Reached the end of the recording!")
+			self.position = 0
+		frame = self.recording.frame(self.position)
+		self.position += 1
+		return frame
+
+if __name__ == '__main__':
+	"""
+	Re-run the Detector over every frame of a recording, and report any frame where the board it
+	detects now differs from the one that was recorded. Exits with a non-zero status if any do.
+
+	    python3 recording.py path/to/recording
+	"""
+	import sys
+	import chess
+	from detector import Detector
+
+	recording = Recording(sys.argv[1])
+	detector = Detector()
+	mismatches = 0
+
+	for i, (frame, metadata) in enumerate(recording):
+		turn = chess.COLOR_NAMES.index(metadata.get('turn', 'black')) == 1
+		try:
+			board = detector.detect_board(frame, turn).fen()
+		except ValueError:
+			board = None
+		if board != metadata.get('board'):
+			mismatches += 1
+			print(f"Frame {i}: recorded {metadata.get('board')}, detected {board}")
+
+	print(f"Replayed {len(recording)} frames, {mismatches} differed.")
+	sys.exit(1 if mismatches > 0 else 0)
@@ -0,0 +1,114 @@
+"""
+Tests for the Detector, on synthetic board images (so they don't depend on the camera or lighting).
+
+    python3 -m unittest test_detector
+"""
+import sys
+import unittest
+import cv2
+import chess
+import numpy as np
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from detector import Detector, PIECES
+from frame_quality import FrameQualityGate
+
+SQUARE_PX = 60
+
+def _tag_image(tag_id: int) -> np.ndarray:
+	dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+	size = SQUARE_PX * 8 // 10
+	try:
+		marker = cv2.aruco.generateImageMarker(dictionary, tag_id, size)
+	except AttributeError:
+		marker = cv2.aruco.drawMarker(dictionary, tag_id, size)
+	border = SQUARE_PX // 10
+	return cv2.copyMakeBorder(marker, border, border, border, border, cv2.BORDER_CONSTANT, value=255)
+
+def _board_image(board: chess.Board, corners=(0, 1, 2, 3)) -> np.ndarray:
+	"""
+	A top-down, slightly tilted picture of board: the corner tags in the corners of a 10x10 grid
+	(the board, plus the graveyard on either side) and each piece's tag on its square.
+	"""
+	size = SQUARE_PX * 10
+	img = np.full((size, size), 255, np.uint8)
+
+	def put(x: int, y: int, tag_id: int):
+		tag = _tag_image(tag_id)
+		cx, cy = SQUARE_PX // 2 + x * SQUARE_PX, size - SQUARE_PX // 2 - y * SQUARE_PX
+		half = tag.shape[0] // 2
+		img[cy - half:cy - half + tag.shape[0], cx - half:cx - half + tag.shape[1]] = tag
+
+	positions = {
+		Detector.CORNER_a9_TAG_ID: (0, 9),
+		Detector.CORNER_I9_TAG_ID: (9, 9),
+		Detector.CORNER_I0_TAG_ID: (9, 0),
+		Detector.CORNER_a0_TAG_ID: (0, 0),
+	}
+	for tag_id in corners:
+		put(*positions[tag_id], tag_id)
+
+	tag_ids = {}
+	for _, symbol, tag_id in PIECES:
+		tag_ids.setdefault(symbol, []).append(tag_id)
+	for square, piece in sorted(board.piece_map().items()):
+		put(chess.square_file(square) + 1, chess.square_rank(square) + 1, tag_ids[piece.symbol()].pop(0))
+
+	src = np.float32([[0, 0], [size, 0], [size, size], [0, size]])
+	dst = np.float32([[40, 20], [size + 60, 5], [size + 80, size + 30], [10, size + 15]])
+	warp = cv2.getPerspectiveTransform(src, dst)
+	img = cv2.warpPerspective(img, warp, (size + 100, size + 50), borderValue=255)
+	# Like a real camera's, the whites and blacks aren't clipped (which the quality gate rejects)
+	return cv2.convertScaleAbs(img, alpha=0.6, beta=50)
+
+def _frames() -> list:
+	"""
+	A short game, with a hand over a corner tag and a blurry frame thrown in: frames where a
+	stateful Detector would behave differently depending on what it saw before.
+	"""
+	board = chess.Board()
+	frames = [_board_image(board)]
+	for uci in ['e2e4', 'e7e5', 'g1f3', 'b8c6']:
+		board.push_uci(uci)
+		frames.append(_board_image(board))
+	frames.append(_board_image(board, corners=(0, 1, 2)))
+	frames.append(cv2.GaussianBlur(frames[-2], (15, 15), 6))
+	frames.append(frames[0])
+	return frames
+
+class TestDetectSummaries(unittest.TestCase):
+	def setUp(self):
+		self.detector = Detector()
+		self.detector.incremental = True
+		self.detector.trust_cached_geometry = True
+		self.detector.quality_gate = FrameQualityGate()
+
+	def tearDown(self):
+		self.detector.close_pool()
+
+	def test_pooled_matches_sequential(self):
+		frames = _frames()
+		expected = []
+		for img in frames:
+			self.detector.reset()
+			expected.append(self.detector.detect_summary(img))
+		self.assertTrue(any(summary['ok'] for summary in expected))
+		self.assertTrue(any(not summary['ok'] for summary in expected))
+
+		for processes in (1, 3):
+			# Run some frames first, so the workers would have something to remember
+			list(self.detector.detect_summaries(reversed(frames), processes=processes))
+			pooled = list(self.detector.detect_summaries(frames, processes=processes))
+			self.assertEqual(pooled, expected, f"with {processes} processes")
+
+	def test_pooled_ignores_parent_state(self):
+		frames = _frames()
+		pooled = list(self.detector.detect_summaries(frames, processes=2))
+		# The parent having seen (and cached the geometry of) a frame makes no difference to workers
+		self.detector.close_pool()
+		self.detector.detect_summary(frames[0])
+		self.assertEqual(list(self.detector.detect_summaries(frames, processes=2)), pooled)
+
+if __name__ == '__main__':
+	unittest.main()